@@ -0,0 +1,658 @@
+#!/usr/bin/env -S uv run -qqs
+# /// script
+# requires-python = ">=3.12"
+# dependencies = [
+#   "yt-dlp[default,curl-cffi]>=2025.11.12",
+#   "tqdm",
+#   "attrs",
+#   "cattrs",
+#   "ada_url",
+#   "rtoml",
+#   "humanize",
+#   "langcodes",
+#   "beautifulsoup4",
+# ]
+# ///
+#
+"""
+Benchmarks for PYTDL, run offline against synthetic data.
+
+Run all of them, or name those to run, optionally as JSON (to compare between commits):
+
+>>> uv run bench.py | uv run bench.py memory clean | uv run bench.py --json > before.json
+
+Copyright 2019 Alex Blandin
+"""
+
+import atexit
+import json
+import logging
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import tracemalloc
+from collections import Counter
+from collections.abc import Callable, Iterable
+from copy import deepcopy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from random import Random
+from statistics import median, quantiles
+from string import ascii_letters, digits
+from time import perf_counter, sleep, time
+from typing import Any, NamedTuple, Self
+
+from yt_dlp.extractor.common import InfoExtractor
+
+from pytdl import (  # noqa: F401 (PYTDL.log_config uses __main__.filter_maker)
+  PYTDL,
+  Info,
+  Metrics,
+  UrlCleaner,
+  WorkQueue,
+  filter_maker,
+  send,
+  strict_dict_update,
+  unique_list,
+  writelines,
+)
+
+rng = Random(2019)
+
+
+def video_id(n: int = 11) -> str:
+  """A random YouTube-like video ID."""
+  return "".join(rng.choices(f"{ascii_letters}{digits}-_", k=n))
+
+
+def youtube_info(vid: str) -> dict:
+  """A synthetic infodict, shaped (and sized) like one yt-dlp extracts for a YouTube video."""
+  expire = int(time()) + 6 * 3600
+  formats = [
+    {
+      "format_id": str(i),
+      "url": f"https://rr1---sn-{video_id(8)}.googlevideo.com/videoplayback?expire={expire}&id={vid}&itag={i}"
+      f"&sig={video_id(300)}&n={video_id(16)}&lsig={video_id(120)}",
+      "protocol": "https",
+      "ext": "mp4" if i % 2 else "webm",
+      "height": 144 * (i % 8 + 1),
+      "width": 256 * (i % 8 + 1),
+      "tbr": rng.random() * 5000,
+      "filesize": rng.randrange(1 << 20, 1 << 30),
+      "http_headers": {"User-Agent": "Mozilla/5.0", "Accept": "*/*", "Accept-Language": "en-us,en;q=0.5"},
+      "downloader_options": {"http_chunk_size": 10485760},
+    }
+    for i in range(30)
+  ]
+  formats += [
+    {
+      "format_id": f"sb{i}",
+      "protocol": "mhtml",
+      "url": f"https://i.ytimg.com/sb/{vid}/storyboard3_L{i}/M$M.jpg",
+      "fragments": [
+        {"url": f"https://i.ytimg.com/sb/{vid}/storyboard3_L{i}/M{j}.jpg", "duration": 10.0} for j in range(200)
+      ],
+    }
+    for i in range(4)
+  ]
+  captions = {
+    lang: [
+      {"ext": ext, "url": f"https://www.youtube.com/api/timedtext?v={vid}&lang={lang}&fmt={ext}"}
+      for ext in ("json3", "srv1", "srv2", "srv3", "ttml", "vtt")
+    ]
+    for lang in (video_id(2) for _ in range(150))
+  }
+  return {
+    "id": vid,
+    "title": f"Video {vid}",
+    "fulltitle": f"Video {vid}",
+    "description": video_id(2000),
+    "uploader": "Someone",
+    "uploader_id": "@someone",
+    "channel_id": video_id(24),
+    "duration": rng.randrange(60, 3600),
+    "webpage_url": f"https://www.youtube.com/watch?v={vid}",
+    "extractor": "youtube",
+    "extractor_key": "Youtube",
+    "is_live": False,
+    "formats": formats,
+    "automatic_captions": captions,
+    "subtitles": {"en": captions[next(iter(captions))]},
+    "heatmap": [{"start_time": i, "end_time": i + 1, "value": rng.random()} for i in range(100)],
+    "thumbnails": [{"url": f"https://i.ytimg.com/vi/{vid}/{i}.jpg", "preference": -i} for i in range(40)],
+    "tags": [video_id(8) for _ in range(30)],
+    "chapters": [{"start_time": i * 60, "end_time": i * 60 + 60, "title": video_id(20)} for i in range(10)],
+  }
+
+
+def per_second(f: Callable[[str], object], items: Iterable[str], n: int) -> float:
+  """How many of n items f gets through per second."""
+  t = perf_counter()
+  for item in items:
+    f(item)
+  return n / (perf_counter() - t)
+
+
+def rebased(val: Any, moves: dict[Path, Path]) -> Any:  # noqa: ANN401
+  """A copy of a template (or any value in one) with the paths under each of moves (in order) moved to where it says."""
+  if isinstance(val, dict):
+    return {key: rebased(item, moves) for key, item in val.items()}
+  if isinstance(val, list):
+    return [rebased(item, moves) for item in val]
+  if isinstance(val, str):
+    path = Path(val)
+    for old, new in moves.items():
+      if path.is_relative_to(old):
+        return str(new / path.relative_to(old))
+  return deepcopy(val)
+
+
+def scratch_pytdl(tmp: Path | None = None) -> PYTDL:
+  """
+  A configured PYTDL whose queue, history, caches, log, etc. are all in a temporary directory (or tmp, to share it).
+
+  That's everything PYTDL keeps in local (which tmp stands in for), and its templates download into tmp / "home"
+  rather than our home, so nothing of ours is read or written. A temporary directory of its own is removed on exit.
+  """
+  if tmp is None:
+    tmp = Path(tempfile.mkdtemp(prefix="pytdl-bench-"))
+    atexit.register(shutil.rmtree, tmp, ignore_errors=True)
+  (tmp / "config.toml").touch()
+  pytdl = PYTDL()
+  pytdl.local, pytdl.home = tmp, tmp / "home"
+  for field, default in vars(PYTDL).items():
+    if field != "local" and isinstance(default, Path) and default.is_relative_to(PYTDL.local):
+      setattr(pytdl, field, tmp / default.relative_to(PYTDL.local))
+  pytdl.template = rebased(PYTDL.template, {Path(PYTDL.local): tmp, Path(PYTDL.home): tmp / "home"})
+  pytdl.log_config = deepcopy(PYTDL.log_config)
+  pytdl.log_config["handlers"]["file"]["filename"] = tmp / "debug.log"
+  pytdl.do_config(tmp / "config.toml")
+  return pytdl
+
+
+def retained(make: Callable[[], object], n: int) -> float:
+  """How many bytes each of n objects from make() keeps allocated."""
+  tracemalloc.start()
+  before = tracemalloc.get_traced_memory()[0]
+  kept = [make() for _ in range(n)]
+  after = tracemalloc.get_traced_memory()[0]
+  tracemalloc.stop()
+  del kept
+  return (after - before) / n
+
+
+def bench_memory(n: int = 100) -> dict[str, float]:
+  """Bytes per info_cache entry, as full infodicts and as compact Infos from filter_info."""
+  pytdl = PYTDL()
+  full = retained(lambda: youtube_info(video_id()), n)
+  compact = retained(lambda: pytdl.filter_info(youtube_info(video_id())), n)
+  return {"full bytes/entry": full, "compact bytes/entry": compact, "reduction": full / compact}
+
+
+def dirty_url() -> str:
+  """A random URL, of the sorts (and with the sorts of tracking) that end up in the queue."""
+  vid = video_id()
+  return rng.choice(
+    (
+      f"https://youtu.be/{vid}?si={video_id(16)}",
+      f"https://www.youtube.com/watch?v={vid}&list={video_id(34)}&index={rng.randrange(100)}&pp={video_id(12)}",
+      f"https://m.youtube.com/shorts/{vid}?feature=share",
+      f"https://www.youtube.com/playlist?list={video_id(34)}&si={video_id(16)}",
+      f"https://www.twitch.tv/videos/{rng.randrange(10**10)}?filter=archives&sort=time",
+      f"https://nebula.tv/videos/{video_id(20).lower()}?utm_source=share&utm_medium=copy",
+      f"https://twitter.com/{video_id(8)}/status/{rng.randrange(10**18)}?s=20&t={video_id(22)}",
+      f"https://imgur.artemislena.eu/gallery/{video_id(7)}",
+      f"https://example.com/{video_id(8)}/{video_id(8)}?fbclid={video_id(40)}&page=2",
+    )
+  )
+
+
+def bench_clean(n: int = 1_000_000) -> dict[str, float]:
+  """URLs/s that clean_many gets through, with our url_rules and (if we have them) ClearURLs'."""
+  urls = [dirty_url() for _ in range(n)]
+  cleaner = UrlCleaner()
+  cleaner.load(PYTDL.url_rules, PYTDL.site_hosts, Path(PYTDL.clearurls_file))
+  t = perf_counter()
+  for _ in map(cleaner.clean, urls):
+    pass
+  return {"urls/s": n / (perf_counter() - t), "clearurls providers": len(cleaner.providers)}
+
+
+def bench_classify(n: int = 1_000_000, cached: int = 100_000) -> dict[str, float]:
+  """
+  URLs/s that clean_url and each is_* get through, with classify's memo both cold and warm.
+
+  Those that may go online (to extract a URL's info) are run on the first cached URLs, with their infos cached.
+  """
+  pytdl = scratch_pytdl()
+  urls = [dirty_url() for _ in range(n)]
+  results = {"clean_url (cold) urls/s": per_second(pytdl.clean_url, urls, n)}
+  clean = [pytdl.clean_url(url) for url in urls[:cached]]
+  results["clean_url (warm) urls/s"] = per_second(pytdl.clean_url, clean, cached)
+  for name in ("show", "podcast", "crunchyroll", "nebula", "twitch", "twitter", "youtube"):
+    results[f"is_{name} urls/s"] = per_second(getattr(pytdl, f"is_{name}"), clean, cached)
+  for url in clean:
+    pytdl.info_cache.memory[url] = Info({"id": video_id(), "webpage_url": url, "is_live": False}), float("inf")
+  pytdl.extractors.match(clean[0])  # which indexes the extractors the first time
+  for name in ("supported", "playlist", "live", "done"):
+    results[f"is_{name} urls/s"] = per_second(getattr(pytdl, f"is_{name}"), clean, cached)
+  return results
+
+
+def bench_params(n: int = 100_000) -> dict[str, float]:
+  """URLs/s that we can build the (ChainMap of) yt-dlp params for, for cached URLs across our sites."""
+  pytdl = scratch_pytdl()
+  urls = [pytdl.clean_url(dirty_url()) for _ in range(n)]
+  for url in urls:
+    pytdl.info_cache.memory[url] = Info({"id": video_id(), "webpage_url": url, "is_live": False}), float("inf")
+  return {
+    "params urls/s": per_second(lambda url: pytdl.params(url, take_input=False), urls, n),
+    "site_params urls/s": per_second(pytdl.site_params, urls, n),
+  }
+
+
+def bench_files(n: int = 500_000) -> dict[str, float]:
+  """Lines/s for writefile and readfile (which clean and dedupe each line), and unique_list, of a queue-like file."""
+  pytdl = scratch_pytdl()
+  lines = [dirty_url() for _ in range(n // 2)] * 2
+  path = Path(pytdl.queue_file).with_name("bench.txt")
+  t = perf_counter()
+  pytdl.writefile(path, lines)
+  written = perf_counter() - t
+  t = perf_counter()
+  pytdl.readfile(path)
+  read = perf_counter() - t
+  t = perf_counter()
+  unique_list(lines)
+  unique = perf_counter() - t
+  return {"writefile lines/s": n / written, "readfile lines/s": n / read, "unique_list items/s": n / unique}
+
+
+def bench_history(n: int = 500_000, added: int = 10_000) -> dict[str, float]:
+  """Seconds to load an n line history, and then lines/s to add to it, sync it, and take in another's additions."""
+  pytdl = scratch_pytdl()
+  path = Path(pytdl.history_file)
+  writelines(path, [f"https://www.youtube.com/watch?v={video_id()}" for _ in range(n)])
+  pytdl.history.path = None  # so it's opened (and loaded) again
+  t = perf_counter()
+  pytdl.history.open(path)
+  pytdl.history.load()  # as it's only read once it's first needed
+  results = {"load s": perf_counter() - t}
+  results["add urls/s"] = per_second(pytdl.history.add, (dirty_url() for _ in range(added)), added)
+  t = perf_counter()
+  pytdl.update_history()
+  results["update_history s"] = perf_counter() - t
+  writelines(path, [dirty_url() for _ in range(added)], mode="a")  # as another PYTDL would
+  t = perf_counter()
+  pytdl.update_history()
+  results["update_history (taking in another's) urls/s"] = added / (perf_counter() - t)
+  return results
+
+
+def bench_config(n: int = 1_000) -> dict[str, float]:
+  """Updates/s of our templates by strict_dict_update, as loading a config that overrides all of them would."""
+  templates = deepcopy(PYTDL.template)
+  new = deepcopy(templates)
+  logging.disable(logging.WARNING)  # so we time the updating, not the terminal printing what's updated
+  t = perf_counter()
+  for _ in range(n):
+    strict_dict_update(templates, new, ["template"])
+  elapsed = perf_counter() - t
+  logging.disable(logging.NOTSET)
+  return {"template updates/s": n / elapsed}
+
+
+def bench_metrics(n: int = 1_000_000) -> dict[str, float]:
+  """Nanoseconds each of counting, observing, and timing takes, against which the hot loop's per-URL costs compare."""
+  metrics = Metrics()
+
+  def timed() -> None:
+    with metrics.timer("bench"):
+      pass
+
+  results = {}
+  for name, f in (
+    ("count", lambda: metrics.count("bench")),
+    ("observe", lambda: metrics.observe("bench", 0.1)),
+    ("timer", timed),
+  ):
+    t = perf_counter()
+    for _ in range(n):
+      f()
+    results[f"{name} ns"] = (perf_counter() - t) / n * 1e9
+  return results
+
+
+class Faults(NamedTuple):
+  """What the media server gets wrong, and how often."""
+
+  latency: float = 0.005
+  "Average seconds before responding to each request (exponentially distributed)"
+  throttled: float = 0.05
+  "The fraction of videos whose first media request is refused with a 429"
+  failed: float = 0.02
+  "The fraction of videos whose media is always missing (404)"
+  live: float = 0.02
+  "The fraction of videos that are live for their first few extractions"
+  live_for: int = 2
+  "How many extractions a live video stays live for"
+
+
+SEGMENT = bytes(range(256)) * 64
+"A (16KiB) segment of synthetic media"
+
+
+class MediaServer(ThreadingHTTPServer):
+  """
+  A local HTTP server of synthetic videos, each served directly, by HLS, or by DASH (by its ID modulo 3).
+
+  /info/<id>.json says what a video is (and whether it's live), for FakeIE to extract it from, and the media itself
+  is under /media/<id>.mp4, /hls/<id>.m3u8, and /dash/<id>.mpd, with faults injected as given.
+  """
+
+  daemon_threads = True
+  request_queue_size = 1024
+
+  def __init__(self: Self, faults: Faults, seed: int = 2019) -> None:  # noqa: D107
+    super().__init__(("127.0.0.1", 0), MediaHandler)
+    self.faults, self.rng, self.lock = faults, Random(seed), threading.Lock()
+    self.extractions: Counter[str] = Counter()
+    self.throttled: set[str] = set()
+    self.requests: Counter[int] = Counter()
+    self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+  def __enter__(self: Self) -> Self:  # noqa: D105
+    self.thread.start()
+    return self
+
+  def __exit__(self: Self, *args: object) -> None:  # noqa: D105
+    self.shutdown()
+    self.server_close()
+
+  @property
+  def base(self: Self) -> str:
+    """The URL the server's at."""
+    return f"http://127.0.0.1:{self.server_address[1]}"
+
+  def fault(self: Self, vid: str) -> float:
+    """Where a video falls in [0, 1), to decide which faults it has (so it has the same ones every time)."""
+    return Random(vid).random()
+
+
+class MediaHandler(BaseHTTPRequestHandler):
+  """Serves a MediaServer's requests."""
+
+  server: MediaServer
+  protocol_version = "HTTP/1.1"
+
+  def log_message(self: Self, *_args: object) -> None:
+    """Don't, as we'd log thousands of requests."""
+
+  def send(self: Self, status: int, body: bytes = b"", content_type: str = "application/octet-stream") -> None:
+    """Respond with a body."""
+    self.send_response(status)
+    self.send_header("Content-Type", content_type)
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_GET(self: Self) -> None:  # noqa: PLR0911
+    """Respond to a request for a video's info or media, after some latency, unless it's to fail."""
+    faults = self.server.faults
+    with self.server.lock:
+      delay = self.server.rng.expovariate(1 / faults.latency) if faults.latency > 0 else 0
+    sleep(delay)
+    kind, _, name = self.path.strip("/").partition("/")
+    vid = name.split("/")[0].split(".")[0]
+    fault = self.server.fault(vid)
+    if kind == "info":
+      with self.server.lock:
+        self.server.extractions[vid] += 1
+        live = fault < faults.live and self.server.extractions[vid] <= faults.live_for
+      info = {"id": vid, "kind": ("http", "hls", "dash")[int(vid) % 3], "is_live": live}
+      return self.send(200, json.dumps(info).encode(), "application/json")
+    if faults.live <= fault < faults.live + faults.failed:
+      return self.send(404)
+    if faults.live + faults.failed <= fault < faults.live + faults.failed + faults.throttled:
+      with self.server.lock:
+        first = vid not in self.server.throttled
+        self.server.throttled.add(vid)
+      if first:
+        return self.send(429)
+    with self.server.lock:
+      self.server.requests[200] += 1
+    if kind == "media" or name.endswith((".ts", ".m4s", ".mp4")):
+      return self.send(200, SEGMENT, "video/mp4")
+    if kind == "hls":
+      segments = "".join(f"#EXTINF:2.0,\n{vid}/{i}.ts\n" for i in range(4))
+      playlist = f"#EXTM3U\n#EXT-X-VERSION:3\n#EXT-X-TARGETDURATION:2\n{segments}#EXT-X-ENDLIST\n"
+      return self.send(200, playlist.encode(), "application/vnd.apple.mpegurl")
+    if kind == "dash":
+      segments = "".join(f'<SegmentURL media="{vid}/{i}.m4s"/>' for i in range(4))
+      mpd = (
+        '<?xml version="1.0"?><MPD xmlns="urn:mpeg:dash:schema:mpd:2011" type="static" '
+        'mediaPresentationDuration="PT8S" minBufferTime="PT2S" profiles="urn:mpeg:dash:profile:isoff-main:2011">'
+        '<Period><AdaptationSet mimeType="video/mp4"><Representation id="0" bandwidth="100000" width="320" '
+        f'height="240" codecs="avc1.4d401e,mp4a.40.2"><SegmentList duration="2" timescale="1">'
+        f'<Initialization sourceURL="{vid}/init.mp4"/>{segments}</SegmentList></Representation></AdaptationSet>'
+        "</Period></MPD>"
+      )
+      return self.send(200, mpd.encode(), "application/dash+xml")
+    return self.send(404)
+
+
+class FakeIE(InfoExtractor):
+  """A stand-in yt-dlp extractor for a MediaServer's videos."""
+
+  IE_NAME = "pytdl:bench"
+  _VALID_URL = r"https?://127\.0\.0\.1:\d+/watch/(?P<id>\d+)"
+
+  def _real_extract(self: Self, url: str) -> dict[str, Any]:
+    vid = self._match_id(url)
+    base = url.split("/watch/", 1)[0]
+    info = self._download_json(f"{base}/info/{vid}.json", vid)
+    if info["kind"] == "hls":
+      formats = self._extract_m3u8_formats(f"{base}/hls/{vid}.m3u8", vid, "ts", "m3u8_native")
+    elif info["kind"] == "dash":
+      formats = self._extract_mpd_formats(f"{base}/dash/{vid}.mpd", vid)
+    else:
+      formats = [{"url": f"{base}/media/{vid}.mp4", "ext": "mp4", "vcodec": "avc1", "acodec": "mp4a"}]
+    return {
+      "id": vid,
+      "title": f"Video {vid}",
+      "uploader": "Bench",
+      "timestamp": 1546300800 + int(vid),
+      "is_live": info["is_live"],
+      "formats": formats,
+    }
+
+
+def media_pytdl(workers: int, tmp: Path | None = None) -> PYTDL:
+  """A scratch_pytdl for getting a MediaServer's videos (into its temporary directory) with FakeIE, without napping."""
+  pytdl = scratch_pytdl(tmp)
+  tmp = Path(pytdl.queue_file).parent
+  pytdl.template["default"] |= {
+    "outtmpl": str(tmp / "Videos" / "%(title)s [%(id)s].%(ext)s"),
+    "concurrency": workers,
+    "noprogress": True,
+  }
+  pytdl.extra_extractors = pytdl.extractors.extra = [FakeIE]
+  pytdl.workers, pytdl.prefetch, pytdl.limiter.naptime = workers, workers, 0
+  return pytdl
+
+
+def bench_pipeline(n: int = 1_000, workers: int = 8, faults: Faults = Faults()) -> dict[str, float]:  # noqa: B008
+  """
+  URLs/s and the latencies of fetching each, for the whole queue pipeline, against a local MediaServer.
+
+  The URLs are queued, extracted (prefetched), and downloaded with run_downloads, as getall would, and those still
+  live are tried again after they've ended (as wait would, without waiting).
+  """
+  pytdl = media_pytdl(workers)
+  latencies: list[float] = []
+  outcomes: Counter[str] = Counter()
+  fetch = pytdl.fetch
+
+  def timed(url: str, *args: Any, **kwargs: Any) -> str:  # noqa: ANN401
+    t = perf_counter()
+    outcome = fetch(url, *args, **kwargs)
+    latencies.append(perf_counter() - t)
+    outcomes[outcome] += 1
+    return outcome
+
+  pytdl.fetch = timed  # type: ignore[method-assign]
+  with MediaServer(faults) as server:
+    urls = [f"{server.base}/watch/{i}" for i in range(n)]
+    pytdl.queue.extend(dict.fromkeys(urls))
+    t = perf_counter()
+    still_live: list[str] = []
+    pytdl.run_downloads(list(pytdl.queue), still_live)
+    for _ in range(faults.live_for):
+      for url in still_live:
+        del pytdl.info_cache[url]  # as wait checks them again
+      live, still_live = still_live, []
+      pytdl.run_downloads(live, still_live)
+    elapsed = perf_counter() - t
+  p50, p95, p99 = (q for i, q in enumerate(quantiles(latencies, n=100), 1) if i in (50, 95, 99))
+  return {
+    "urls/s": n / elapsed,
+    "p50 s": p50,
+    "p95 s": p95,
+    "p99 s": p99,
+    "downloaded": len(pytdl.history),
+    "unverified": len(pytdl.unverified),
+    **{f"fetches {outcome}": count for outcome, count in outcomes.items()},
+  }
+
+
+def bench_serve(n: int = 200, workers: int = 8, faults: Faults = Faults(live=0)) -> dict[str, float]:  # noqa: B008
+  """
+  Milliseconds for a client to add a URL to a PYTDL that's serving, and URLs/s it then gets them at (in the background).
+
+  None of the videos are live, as serve only tries those again a minute later. The client and MediaServer share our
+  interpreter with the downloads, so adding is slower here than it'd be from another process (i.e., a browser hook).
+  """
+  pytdl = media_pytdl(workers)
+  path = pytdl.serve_socket = Path(pytdl.queue_file).with_name("pytdl.sock")
+  latencies: list[float] = []
+  with MediaServer(faults) as server:
+    serving = threading.Thread(target=pytdl.do_serve, name="serve")
+    serving.start()
+    while not path.exists():
+      sleep(0.01)
+    t = perf_counter()
+    for i in range(n):
+      added = perf_counter()
+      send(path, [f"add {server.base}/watch/{i}"])
+      latencies.append(perf_counter() - added)
+    while len(pytdl.history) + len(pytdl.unverified) < n:
+      sleep(0.01)
+    elapsed = perf_counter() - t
+    send(path, ["serve stop"])
+    serving.join()
+  p50, p99 = (q for i, q in enumerate(quantiles(latencies, n=100), 1) if i in (50, 99))
+  return {"add p50 ms": p50 * 1000, "add p99 ms": p99 * 1000, "urls/s": n / elapsed}
+
+
+def work_through(tmp: str, workers: int) -> None:
+  """Be one of bench_workers' worker processes, getting what's shared in tmp's work_file (into tmp)."""
+  pytdl = media_pytdl(workers, Path(tmp))
+  pytdl.work_file, pytdl.lease = Path(tmp) / "work.sqlite", 30
+  pytdl.do_worker("-")
+
+
+def bench_workers(
+  n: int = 200,
+  processes: Iterable[int] = (1, 2, 4),
+  faults: Faults = Faults(live=0),  # noqa: B008
+) -> dict[str, float]:
+  """
+  URLs/s that a number of worker processes get a shared queue at, and how many URLs more than one of them got.
+
+  They each have 4 workers, and share one directory, as workers on one machine would. None of the videos are live, as
+  workers only try those again a minute later.
+  """
+  results: dict[str, float] = {}
+  with MediaServer(faults) as server:
+    for i, k in enumerate(processes):
+      with tempfile.TemporaryDirectory(prefix="pytdl-bench-", ignore_cleanup_errors=True) as scratch:
+        tmp = Path(scratch)
+        work = WorkQueue()
+        work.open(tmp / "work.sqlite")
+        work.add(f"{server.base}/watch/{i * n + j}" for j in range(n))  # new videos for each, as faults happen once
+        run = f"from bench import filter_maker, work_through; work_through({str(tmp)!r}, 4)"
+        t = perf_counter()
+        workers = [
+          subprocess.Popen(  # noqa: S603
+            [sys.executable, "-c", run], cwd=Path(__file__).parent, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+          )
+          for _ in range(k)
+        ]
+        for worker in workers:
+          worker.wait()
+        elapsed = perf_counter() - t
+        history = (tmp / "history.txt").read_text(encoding="utf8").split()
+        results[f"{k} processes urls/s"] = n / elapsed
+        results[f"{k} processes duplicates"] = len(history) - len(set(history))
+        counts = work.counts()
+        results[f"{k} processes failed"] = counts.get("failed", 0)
+        results[f"{k} processes left"] = counts.get("queued", 0) + counts.get("leased", 0)
+  return results
+
+
+def bench_startup(runs: int = 5) -> dict[str, float]:
+  """
+  Median seconds from starting pytdl.py to it exiting, for a few one-off commands, as run from a shell.
+
+  It runs from a copy in a temporary directory, with a config that doesn't pause on exit (and our extractors.json, if we
+  have one, so that add isn't timing the index being built), so only the cold start and the command itself are timed.
+  """
+  here = Path(__file__).parent
+  url = "https://www.youtube.com/watch?v=dQw4w9WgXcQ&feature=share"
+  commands = {"mode": ["mode"], "echo": ["echo", url], "add": ["add", url]}
+  timings: dict[str, float] = {}
+  with tempfile.TemporaryDirectory() as tmp:
+    script, local = Path(tmp) / "pytdl.py", Path(tmp) / "local"
+    shutil.copy(here / "pytdl.py", script)
+    local.mkdir()
+    (local / "config.toml").write_text("exit_pause = 0.0\n", encoding="utf8")
+    if (extractors := here / "local" / "extractors.json").is_file():
+      shutil.copy(extractors, local)
+    for name, args in commands.items():
+      subprocess.run([sys.executable, script, *args], cwd=tmp, capture_output=True, check=True)  # noqa: S603 (warm the OS's caches)
+      elapsed: list[float] = []
+      for _ in range(runs):
+        (local / "queue.txt").unlink(missing_ok=True)
+        t = perf_counter()
+        subprocess.run([sys.executable, script, *args], cwd=tmp, capture_output=True, check=True)  # noqa: S603
+        elapsed.append(perf_counter() - t)
+      timings[f"{name} s"] = median(elapsed)
+  return timings
+
+
+BENCHMARKS: dict[str, Callable[[], dict[str, float]]] = {
+  "memory": bench_memory,
+  "clean": bench_clean,
+  "classify": bench_classify,
+  "params": bench_params,
+  "files": bench_files,
+  "history": bench_history,
+  "config": bench_config,
+  "metrics": bench_metrics,
+  "pipeline": bench_pipeline,
+  "serve": bench_serve,
+  "workers": bench_workers,
+  "startup": bench_startup,
+}
+
+
+if __name__ == "__main__":
+  names = [arg for arg in sys.argv[1:] if arg != "--json"] or list(BENCHMARKS)
+  if "--json" in sys.argv:
+    print(json.dumps({name: BENCHMARKS[name]() for name in names}, indent=2))  # noqa: T201
+  else:
+    for name in names:
+      for key, val in BENCHMARKS[name]().items():
+        print(f"{name}: {key} = {val:,.1f}")  # noqa: T201
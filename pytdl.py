@@ -37,32 +37,1787 @@ import logging.config
 import logging.handlers
 import os
 import platform
+import re
+import socket
+import sqlite3
+import string
 import sys
+import threading
+import zlib
 from cmd import Cmd
-from collections import ChainMap
-from collections.abc import Callable, Iterable
-from contextlib import suppress
+from collections import ChainMap, Counter, deque
+from collections.abc import Callable, Iterable, Iterator, Mapping, MutableMapping, MutableSet
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
+from contextlib import AbstractContextManager, ExitStack, contextmanager, nullcontext, suppress
+from copy import deepcopy
+from functools import cache
+from heapq import heapify, heappop, heappush, heapreplace
+from hmac import compare_digest
+from importlib.util import find_spec
+from itertools import chain, count, islice, pairwise, repeat, takewhile
+from math import frexp
 from os import system as term
 from pathlib import Path
-from pprint import pprint
 from random import randint, random
+from secrets import token_urlsafe
+from socketserver import BaseServer, StreamRequestHandler, ThreadingTCPServer
 from subprocess import run
-from time import sleep
-from typing import Any, Literal, Self
+from time import monotonic, perf_counter_ns, sleep, time
+from typing import TYPE_CHECKING, Any, BinaryIO, Literal, NamedTuple, Self, TextIO
+from urllib.parse import unquote, unquote_plus
 
-import langcodes  # used to convert IETF BCP 47 (i.e., Crunchyroll's en-US) to ISO 639-2 (for ffmpeg)
-import rtoml
-from ada_url import URL, URLSearchParams
-from humanize import naturaltime
-from tqdm import tqdm
-from yt_dlp import YoutubeDL
-from yt_dlp.version import __version__ as YTDLPVersion
+from ada_url import URL
+
+if TYPE_CHECKING:  # the rest are imported where they're first used, so starting up doesn't wait on them
+  from yt_dlp import YoutubeDL
+  from yt_dlp.extractor.common import InfoExtractor
+  from yt_dlp.utils import PagedList
 
 # TODO(alex): better outtmpl approach, so we can have
 # 1: optional fields without added whitespace
 # 2: dynamic truncation of fields we can safely truncate (title, etc), so we never lose id etc
 
 
+class Info(Mapping[str, Any]):
+  """
+  A compact infodict: the fields PYTDL reads are kept as attributes, and the rest is compressed until it's needed.
+
+  Reading any other key (or `full`) decompresses the whole infodict, so that is best left to when we download.
+  """
+
+  FIELDS = (
+    "id",
+    "fulltitle",
+    "is_live",
+    "playlist",
+    "playlist_id",
+    "playlist_title",
+    "playlist_index",
+    "filesize_approx",
+    "extractor_key",
+    "webpage_url",
+    "epoch",
+  )
+  "The fields we keep uncompressed"
+  __slots__ = (*FIELDS, "blob", "expires")
+
+  def __init__(self: Self, info: dict[str, Any], expires: float = 0) -> None:
+    """Compact an infodict, with its format URLs expiring at expires (seconds since the epoch)."""
+    from yt_dlp import YoutubeDL  # noqa: PLC0415
+
+    for field in self.FIELDS:
+      setattr(self, field, info.get(field))
+    self.blob = zlib.compress(json.dumps(YoutubeDL.sanitize_info(info), separators=(",", ":")).encode())
+    self.expires = expires
+
+  @classmethod
+  def from_blob(cls: type[Self], blob: bytes, expires: float = 0) -> Self:
+    """An Info from what we've compressed before (i.e., its blob)."""
+    info = cls.__new__(cls)
+    full = json.loads(zlib.decompress(blob))
+    for field in cls.FIELDS:
+      setattr(info, field, full.get(field))
+    info.blob, info.expires = blob, expires
+    return info
+
+  @property
+  def full(self: Self) -> dict[str, Any]:
+    """The whole infodict, as a new dict each time."""
+    return json.loads(zlib.decompress(self.blob))
+
+  def __getitem__(self: Self, key: str) -> Any:  # noqa: ANN401, D105
+    if key in self.FIELDS:
+      if (val := getattr(self, key)) is None:
+        raise KeyError(key)
+      return val
+    return self.full[key]
+
+  def __contains__(self: Self, key: object) -> bool:  # noqa: D105
+    if key in self.FIELDS:
+      return getattr(self, key) is not None
+    return key in self.full
+
+  def __iter__(self: Self) -> Iterator[str]:  # noqa: D105
+    return iter(self.full)
+
+  def __len__(self: Self) -> int:  # noqa: D105
+    return len(self.full)
+
+  def __bool__(self: Self) -> bool:  # noqa: D105
+    return True
+
+  def __repr__(self: Self) -> str:  # noqa: D105
+    return f"Info({self.extractor_key} {self.id}: {self.fulltitle!r}, {len(self.blob)} bytes)"
+
+
+class InfoCache(MutableMapping[str, Info]):
+  """
+  URL infodicts, kept in memory (as compact Infos) and persisted to an SQLite database between uses.
+
+  Each entry expires after a TTL chosen when it's stored, and the least recently used are evicted once the
+  database outgrows max_bytes (or by prune, which PYTDL runs on exit). Until opened, it's only an in-memory cache.
+  """
+
+  SCHEMA = 1
+  "The database's user_version for its current schema (0 being from before formats_expire, which we add)"
+  memory_size = 1024
+  "How many Infos we keep in memory at most (the least recently used being dropped first)"
+  batch = 64
+  "How many reads from memory we buffer before recording when they were in the database"
+
+  def __init__(self: Self) -> None:  # noqa: D107
+    self.memory: dict[str, tuple[Info, float]] = {}
+    self.db: sqlite3.Connection | None = None
+    self.path: Path | None = None
+    self.ttl: Callable[[str, Info], float] = lambda _url, _info: 3600
+    self.max_bytes = 0
+    self.bytes: int | None = None  # how big the database is, only added up once we first store something
+    self.stored = 0  # since we last pruned
+    self.touched: dict[str, float] = {}  # when what we've read from memory was read, until it's in the database
+    self.lock = threading.RLock()
+
+  def open(self: Self, path: Path, ttl: Callable[[str, Info], float], max_bytes: int) -> None:
+    """Persist to the SQLite database at path, using ttl(url, info) for how long to keep an entry."""
+    self.ttl, self.max_bytes = ttl, max_bytes
+    with self.lock:
+      if self.path == path:
+        return
+      self.close()
+      path.parent.mkdir(parents=True, exist_ok=True)
+      self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+      self.db.executescript("PRAGMA auto_vacuum=INCREMENTAL; PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL;")
+      self.migrate(self.db)
+      self.db.executescript(
+        f"""
+        PRAGMA user_version={self.SCHEMA};
+        CREATE TABLE IF NOT EXISTS info (
+          url TEXT PRIMARY KEY,
+          blob BLOB NOT NULL,
+          size INTEGER NOT NULL,
+          expires REAL NOT NULL,
+          accessed REAL NOT NULL,
+          formats_expire REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS info_accessed ON info (accessed);
+        """
+      )
+      self.path = path
+
+  def migrate(self: Self, db: sqlite3.Connection) -> None:
+    """Bring an older database up to our SCHEMA, or start over with one that's newer (it's only a cache)."""
+    (version,) = db.execute("PRAGMA user_version").fetchone()
+    if version == self.SCHEMA:
+      return
+    columns = {row[1] for row in db.execute("PRAGMA table_info(info)")}
+    if version > self.SCHEMA:
+      logging.warning(f"The info cache is from a newer PYTDL (schema {version}), so we're starting it over")
+      db.execute("DROP TABLE IF EXISTS info")
+    elif columns and "formats_expire" not in columns:  # their formats are taken as expired, so extracted again
+      db.execute("ALTER TABLE info ADD COLUMN formats_expire REAL NOT NULL DEFAULT 0")
+
+  def close(self: Self) -> None:
+    """Stop persisting to the database."""
+    with self.lock:
+      if self.db is not None:
+        self.touch()
+        self.db.close()
+      self.db, self.path, self.bytes = None, None, None
+      self.touched.clear()
+
+  def touch(self: Self) -> None:
+    """Record when what we've read from memory was last read (holding the lock), so it's evicted by that."""
+    if self.touched and self.db is not None:
+      self.db.executemany("UPDATE info SET accessed=? WHERE url=?", [(t, url) for url, t in self.touched.items()])
+    self.touched.clear()
+
+  def remember(self: Self, url: str, info: Info, expires: float) -> None:
+    """Keep an Info in memory (as the most recently used), dropping the least recently used if we've too many."""
+    self.memory.pop(url, None)
+    self.memory[url] = info, expires
+    if len(self.memory) > self.memory_size:
+      del self.memory[next(iter(self.memory))]
+
+  def __getitem__(self: Self, url: str) -> Info:  # noqa: D105
+    now = time()
+    with self.lock:
+      if url in self.memory:
+        info, expires = self.memory[url]
+        if now < expires:
+          self.remember(url, info, expires)
+          if self.db is not None:
+            self.touched[url] = now
+            if len(self.touched) >= self.batch:
+              self.touch()
+          return info
+        del self[url]
+        raise KeyError(url)
+      if (
+        self.db is None
+        or (row := self.db.execute("SELECT blob, expires, formats_expire FROM info WHERE url=?", (url,)).fetchone())
+        is None
+      ):
+        raise KeyError(url)
+      blob, expires, formats_expire = row
+      if now >= expires:
+        del self[url]
+        raise KeyError(url)
+      self.db.execute("UPDATE info SET accessed=? WHERE url=?", (now, url))
+      info = Info.from_blob(blob, formats_expire)
+      self.remember(url, info, expires)
+      return info
+
+  def __setitem__(self: Self, url: str, info: Info) -> None:  # noqa: D105
+    now = time()
+    expires = now + self.ttl(url, info)
+    with self.lock:
+      self.remember(url, info, expires)
+      self.touched.pop(url, None)
+      if self.db is not None:
+        if self.bytes is None:
+          self.bytes = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM info").fetchone()[0]
+        replaced = self.db.execute("SELECT size FROM info WHERE url=?", (url,)).fetchone()
+        self.db.execute(
+          "INSERT OR REPLACE INTO info VALUES (?, ?, ?, ?, ?, ?)",
+          (url, info.blob, len(info.blob), expires, now, info.expires),
+        )
+        self.bytes += len(info.blob) - (replaced[0] if replaced else 0)
+        self.stored += 1
+        if self.bytes > self.max_bytes:
+          self.prune()
+
+  def __delitem__(self: Self, url: str) -> None:  # noqa: D105
+    with self.lock:
+      self.memory.pop(url, None)
+      self.touched.pop(url, None)
+      if self.db is not None:
+        deleted = self.db.execute("DELETE FROM info WHERE url=? RETURNING size", (url,)).fetchall()
+        if self.bytes is not None:
+          self.bytes -= sum(size for (size,) in deleted)
+
+  def __contains__(self: Self, url: object) -> bool:  # noqa: D105
+    now = time()
+    with self.lock:
+      if url in self.memory:
+        return now < self.memory[url][1]
+      return self.db is not None and bool(
+        self.db.execute("SELECT 1 FROM info WHERE url=? AND expires>?", (url, now)).fetchone()
+      )
+
+  def __iter__(self: Self) -> Iterator[str]:  # noqa: D105
+    with self.lock:
+      urls = dict.fromkeys(self.memory)
+      if self.db is not None:
+        urls |= dict.fromkeys(url for (url,) in self.db.execute("SELECT url FROM info"))
+    return iter(urls)
+
+  def __len__(self: Self) -> int:  # noqa: D105
+    return sum(1 for _ in self)
+
+  def clear(self: Self) -> None:
+    """Forget everything, including what's on disk."""
+    with self.lock:
+      self.memory.clear()
+      self.touched.clear()
+      if self.db is not None:
+        self.db.execute("DELETE FROM info")
+        self.bytes = 0
+
+  def prune(self: Self) -> int:
+    """Remove expired entries, then the least recently used until we fit in max_bytes. Returns how many we removed."""
+    now = time()
+    with self.lock:
+      self.memory = {url: entry for url, entry in self.memory.items() if now < entry[1]}
+      if self.db is None:
+        return 0
+      self.touch()
+      removed = [url for (url,) in self.db.execute("DELETE FROM info WHERE expires<=? RETURNING url", (now,))]
+      removed += [
+        url
+        for (url,) in self.db.execute(
+          """
+          DELETE FROM info WHERE url IN (
+            SELECT url FROM (SELECT url, SUM(size) OVER (ORDER BY accessed DESC, url) AS total FROM info) WHERE total>?
+          ) RETURNING url
+          """,
+          (self.max_bytes,),
+        )
+      ]
+      for url in removed:
+        self.memory.pop(url, None)
+      self.bytes = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM info").fetchone()[0]
+      self.stored = 0
+      if removed:
+        self.db.execute("PRAGMA incremental_vacuum")
+      return len(removed)
+
+  def stats(self: Self) -> dict[str, Any]:
+    """How big the cache is, and how much of it has expired."""
+    now = time()
+    with self.lock:
+      stats: dict[str, Any] = {"path": self.path, "in memory": len(self.memory), "max bytes": self.max_bytes}
+      if self.db is not None:
+        self.touch()
+        entries, size, expired, oldest = self.db.execute(
+          "SELECT COUNT(*), COALESCE(SUM(size), 0), COUNT(CASE WHEN expires<=? THEN 1 END), MIN(accessed) FROM info",
+          (now,),
+        ).fetchone()
+        stats |= {"on disk": entries, "bytes": size, "expired": expired, "oldest access": oldest}
+      return stats
+
+
+class Library:
+  """
+  What's in our output directories, indexed by the [%(id)s] in each file's name, and persisted to an SQLite database.
+
+  It's refreshed incrementally: a directory is only rescanned if its mtime's changed (as adding, removing, or renaming
+  a file in it changes that), so refreshing an unchanged library costs a stat of each directory.
+  As IDs are only unique per extractor, we also note which extractor each file we download is from (see record).
+  """
+
+  SCHEMA = 1
+  "The database's user_version for its current schema (any other's rebuilt, by rescanning)"
+  interval = 60.0
+  "How many seconds we let pass between refreshes before we get URLs (see freshen)"
+
+  def __init__(self: Self) -> None:  # noqa: D107
+    self.db: sqlite3.Connection | None = None
+    self.path: Path | None = None
+    self.refreshed = float("-inf")
+    self.lock = threading.RLock()
+
+  def open(self: Self, path: Path) -> None:
+    """Persist to the SQLite database at path."""
+    with self.lock:
+      if self.path == path:
+        return
+      if self.db is not None:
+        self.db.close()
+      path.parent.mkdir(parents=True, exist_ok=True)
+      self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+      self.db.executescript("PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL;")
+      if self.db.execute("PRAGMA user_version").fetchone()[0] != self.SCHEMA:
+        self.db.executescript("DROP TABLE IF EXISTS dirs; DROP TABLE IF EXISTS files;")
+      self.db.executescript(
+        f"""
+        PRAGMA user_version={self.SCHEMA};
+        CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, parent TEXT, mtime REAL NOT NULL);
+        CREATE TABLE IF NOT EXISTS files (
+          path TEXT PRIMARY KEY,
+          dir TEXT NOT NULL,
+          id TEXT,
+          size INTEGER NOT NULL,
+          mtime REAL NOT NULL,
+          extractor TEXT
+        );
+        CREATE INDEX IF NOT EXISTS files_id ON files (id);
+        CREATE INDEX IF NOT EXISTS files_dir ON files (dir);
+        """
+      )
+      self.path = path
+      self.refreshed = float("-inf")
+
+  def freshen(self: Self, roots: Iterable[Path]) -> None:
+    """Refresh, unless we have in the last interval seconds (as getting URLs, we'd otherwise refresh every batch)."""
+    with self.lock:
+      if monotonic() - self.refreshed >= self.interval:
+        self.refresh(roots)
+
+  def refresh(self: Self, roots: Iterable[Path]) -> list[Path]:
+    """Rescan the directories under roots that have changed since we last did, returning which those were."""
+    with self.lock:
+      if self.db is None:
+        return []
+      self.refreshed = monotonic()
+      # taking the write lock up front, so we wait on any other process sharing the library, rather than it refusing
+      # to let us write after we've read
+      self.db.execute("BEGIN IMMEDIATE")
+      try:
+        mtimes: dict[str, float] = {}
+        children: dict[str, list[str]] = {}
+        for path, parent, mtime in self.db.execute("SELECT path, parent, mtime FROM dirs"):
+          mtimes[path] = mtime
+          children.setdefault(parent, []).append(path)
+        dirs, seen, changed = [(str(root), None) for root in roots], set(), []
+        while dirs:
+          path, parent = dirs.pop()
+          try:
+            mtime = Path(path).stat().st_mtime
+          except OSError:
+            continue
+          seen.add(path)
+          if mtimes.get(path) == mtime:
+            dirs.extend((child, path) for child in children.get(path, ()))
+            continue
+          changed.append(Path(path))
+          files = []
+          known = dict(self.db.execute("SELECT path, extractor FROM files WHERE dir=? AND extractor NOT NULL", (path,)))
+          with suppress(OSError), os.scandir(path) as entries:
+            for entry in entries:
+              if entry.is_dir(follow_symlinks=False):
+                dirs.append((entry.path, path))
+              elif entry.is_file() and not entry.name.endswith((".part", ".ytdl", ".tmp")):
+                stat = entry.stat()
+                match = FILE_ID.search(entry.name) if not entry.name.endswith(SIDECARS) else None
+                vid = match[1] if match else None  # only media files count as having a video
+                files.append((entry.path, path, vid, stat.st_size, stat.st_mtime, known.get(entry.path)))
+          self.db.execute("DELETE FROM files WHERE dir=?", (path,))
+          self.db.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)", files)
+          self.db.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)", (path, parent, mtime))
+        gone = [(path,) for path in mtimes if path not in seen]
+        self.db.executemany("DELETE FROM files WHERE dir=?", gone)
+        self.db.executemany("DELETE FROM dirs WHERE path=?", gone)
+      except BaseException:
+        self.db.execute("ROLLBACK")
+        raise
+      self.db.execute("COMMIT")
+      return changed
+
+  def record(self: Self, path: Path, extractor: str) -> None:
+    """Note which extractor (as in archive IDs, i.e., "youtube") a file we've downloaded is from."""
+    with self.lock:
+      if self.db is None:
+        return
+      with suppress(OSError):
+        stat, match = path.stat(), FILE_ID.search(path.name)
+        self.db.execute(
+          "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+          (str(path), str(path.parent), match[1] if match else None, stat.st_size, stat.st_mtime, extractor),
+        )
+
+  def find(self: Self, vid: str, extractor: str) -> Path | None:
+    """
+    Where the (biggest) file for an extractor's video ID is, if we have one.
+
+    Files we've not recorded the extractor of are only taken if there's no info.json beside them saying otherwise.
+    """
+    with self.lock:
+      if self.db is None:
+        return None
+      rows = self.db.execute(
+        "SELECT path, extractor FROM files WHERE id=? AND (extractor=? OR extractor IS NULL)"
+        " ORDER BY extractor IS NULL, size DESC",
+        (vid, extractor),
+      ).fetchall()
+    return next(
+      (Path(path) for path, known in rows if known is not None or sidecar_extractor(Path(path)) in {None, extractor}),
+      None,
+    )
+
+  def files(self: Self, under: Path) -> list[Path]:
+    """Every file we know of under a directory."""
+    with self.lock:
+      if self.db is None:
+        return []
+      prefix = f"{str(under).rstrip(os.sep)}{os.sep}"
+      rows = self.db.execute("SELECT path FROM files WHERE substr(path, 1, ?)=?", (len(prefix), prefix))
+      return [Path(path) for (path,) in rows]
+
+
+class History(MutableSet[str]):
+  """
+  What we've downloaded (URLs, or archive IDs), as a set in memory, persisted as an append-only log (one a line).
+
+  The log's only read once we first need what's in it. New URLs are appended (and fsynced) in batches, and anything
+  appended to the file elsewhere is picked up on sync.
+  The file is only rewritten (atomically, sorted) to compact it: once it's mostly duplicates, or after a removal.
+  Appending and compacting hold a lock on the file (see locked), as other workers may share it.
+  So it stays an ordinary history file (or download archive) that can be imported and exported as it always has been.
+  """
+
+  batch = 64
+  "How many URLs we buffer before appending them"
+  interval = 5.0
+  "How many seconds we buffer URLs for at most before appending them"
+
+  def __init__(self: Self) -> None:  # noqa: D107
+    self.urls: set[str] = set()
+    self.pending: list[str] = []
+    self.path: Path | None = None
+    self.offset = 0
+    self.lines = 0
+    self.reader: BinaryIO | None = None
+    self.removed: set[str] = set()
+    self.dirty = False
+    self.loaded = True
+    self.flushed = monotonic()
+    self.lock = threading.RLock()
+
+  def open(self: Self, path: Path) -> None:
+    """Persist to the log at path, loading what it has once it's first needed."""
+    with self.lock:
+      if self.path == path:
+        return
+      self.flush()
+      if self.reader is not None:
+        self.reader.close()
+      self.path, self.offset, self.lines, self.reader, self.loaded = path, 0, 0, None, False
+
+  def load(self: Self) -> set[str]:
+    """The URLs we remember, having read the log first if we've yet to."""
+    with self.lock:
+      if not self.loaded:
+        self.urls.update(self.tail())
+        self.loaded = True
+      return self.urls
+
+  def tail(self: Self) -> list[str]:
+    """
+    Read the lines appended to the log since we last looked (rereading it all if it's been rewritten since).
+
+    We keep the log open, so that we can tell it's been rewritten (i.e., compacted elsewhere) by it being another file
+    at path, as its inode can't be reused for another while we have it.
+    """
+    if self.path is None or not self.path.is_file():
+      return []
+    if self.reader is None or not os.path.samestat(os.fstat(self.reader.fileno()), self.path.stat()):
+      if self.reader is not None:
+        self.reader.close()
+      self.reader, self.offset, self.lines = self.path.open("rb"), 0, 0
+    self.reader.seek(self.offset)
+    data = self.reader.read()
+    data = data[: data.rfind(b"\n") + 1]  # a partial line is still being written
+    self.offset += len(data)
+    lines = list(filter(None, map(str.strip, data.decode("utf8").splitlines())))
+    self.lines += len(lines)
+    return lines
+
+  def __contains__(self: Self, url: object) -> bool:  # noqa: D105
+    return url in (self.urls if self.loaded else self.load())
+
+  def __iter__(self: Self) -> Iterator[str]:  # noqa: D105
+    return iter(self.urls if self.loaded else self.load())
+
+  def __len__(self: Self) -> int:  # noqa: D105
+    return len(self.urls if self.loaded else self.load())
+
+  def add(self: Self, url: str) -> None:
+    """Remember a URL, appending it to the log with the rest of its batch."""
+    with self.lock:
+      if url not in self.load():
+        self.urls.add(url)
+        self.pending.append(url)
+        self.removed.discard(url)
+      if len(self.pending) >= self.batch or monotonic() - self.flushed > self.interval:
+        self.flush()
+
+  def update(self: Self, urls: Iterable[str]) -> None:
+    """Remember many URLs, appending them in one go."""
+    with self.lock:
+      self.load()
+      for url in urls:
+        if url not in self.urls:
+          self.urls.add(url)
+          self.pending.append(url)
+          self.removed.discard(url)
+
+  def discard(self: Self, url: str) -> None:
+    """Forget a URL, which the log forgets when next compacted."""
+    with self.lock:
+      if url in self.load():
+        self.urls.discard(url)
+        self.removed.add(url)
+        self.dirty = True
+
+  def clear(self: Self) -> None:
+    """Forget every URL, which the log forgets when next compacted."""
+    with self.lock:
+      self.removed.update(self.load())
+      self.urls.clear()
+      self.pending.clear()
+      self.dirty = True
+
+  def flush(self: Self) -> None:
+    """Append (and fsync) the URLs we've buffered."""
+    with self.lock:
+      self.flushed = monotonic()
+      if self.path is None or not self.pending:
+        return
+      self.path.parent.mkdir(parents=True, exist_ok=True)
+      with locked(self.path):
+        self.urls.update(self.tail())
+        with self.path.open("a", encoding="utf8", newline="\n") as f:
+          f.writelines(f"{url}\n" for url in self.pending)
+          f.flush()
+          os.fsync(f.fileno())
+      self.pending.clear()  # and what we've appended is read back by tail, after anything appended elsewhere first
+
+  def sync(self: Self) -> None:
+    """Pick up what's been appended to the log elsewhere and append what we have, compacting it if it's due."""
+    with self.lock:
+      if not self.loaded:
+        return  # as we've nothing to append (or remove) until we've read it
+      if not self.dirty:
+        self.urls.update(self.tail())
+      if self.dirty or self.lines > 2 * len(self.urls) + 1024:
+        self.compact()
+      else:
+        self.flush()
+
+  def compact(self: Self) -> None:
+    """Rewrite the log as just the URLs we remember (and any appended elsewhere), sorted, replacing it atomically."""
+    with self.lock:
+      if self.path is None:
+        return
+      self.path.parent.mkdir(parents=True, exist_ok=True)
+      temp = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")  # as other workers may be compacting it too
+      with locked(self.path):
+        self.urls.update(url for url in self.tail() if url not in self.removed)  # as the log still has those
+        with temp.open("w", encoding="utf8", newline="\n") as f:
+          f.writelines(f"{url}\n" for url in sorted(self.urls))
+          f.flush()
+          os.fsync(f.fileno())
+          offset = f.tell()
+        if self.reader is not None:
+          self.reader.close()  # as Windows won't replace a file that's open
+        temp.replace(self.path)
+        self.reader = self.path.open("rb")
+      self.offset, self.lines, self.dirty = offset, len(self.urls), False
+      self.removed.clear()
+      self.pending.clear()
+      self.flushed = monotonic()
+
+
+class Queue(MutableMapping[str, str]):
+  """
+  The download queue, in order, persisted as queue_file plus a journal of the changes made to it since.
+
+  Each change is appended to the journal as it's made (as "+ url" to add, "^ url" to move to the front, "- url" to
+  delete, or "= url" when downloaded), and replayed over queue_file when opened. So saving only costs the changes, and
+  a crash loses none of them. The journal's compacted into queue_file (atomically) once it outgrows the queue.
+  """
+
+  def __init__(self: Self) -> None:  # noqa: D107
+    self.urls: dict[str, str] = {}
+    self.path: Path | None = None
+    self.journal: TextIO | None = None
+    self.records = 0
+    self.key: Callable[[str], str | None] = lambda _url: None
+    self.keys: dict[str, str] | None = None
+    self.lock = threading.RLock()
+
+  def open(
+    self: Self, path: Path, clean: Callable[[Iterable[str]], Iterable[str]], key: Callable[[str], str | None]
+  ) -> None:
+    """
+    Load the queue from path (cleaning its URLs, as it may have been edited by hand) and replay its journal.
+
+    URLs for the same content are found by key(url), i.e., their archive IDs.
+    """
+    with self.lock:
+      self.key = key
+      if self.path == path:
+        return
+      self.close()
+      lines = path.read_text(encoding="utf8").splitlines() if path.is_file() else []
+      self.urls = {url: url for url in clean(filter(None, map(str.strip, lines)))}
+      journal = path.with_name(f"{path.name}.journal")
+      records = journal.read_text(encoding="utf8").splitlines() if journal.is_file() else []
+      for record in records:
+        match record.split(" ", 1):
+          case ["+", url]:
+            self.urls.setdefault(url, url)
+          case ["^", url]:
+            self.urls = {url: url} | self.urls
+          case ["-" | "=", url]:
+            self.urls.pop(url, None)
+      path.parent.mkdir(parents=True, exist_ok=True)
+      self.path, self.records, self.keys = path, len(records), None
+      self.journal = journal.open("a", encoding="utf8", newline="\n")
+
+  def close(self: Self) -> None:
+    """Stop journaling (having saved everything so far)."""
+    with self.lock:
+      if self.journal is not None:
+        self.sync()
+        self.journal.close()
+      self.path, self.journal, self.records = None, None, 0
+
+  def log(self: Self, op: str, url: str) -> None:
+    """Append a change to the journal (and keep the index of keys up to date with it)."""
+    if self.keys is not None and (key := self.key(url)) is not None:
+      if op in "+^":
+        self.keys.setdefault(key, url)
+      elif self.keys.get(key) == url:
+        del self.keys[key]
+    if self.journal is not None:
+      self.journal.write(f"{op} {url}\n")
+      self.journal.flush()
+      self.records += 1
+
+  def find(self: Self, url: str) -> str | None:
+    """The URL queued for the same content as url (by key), if any, indexing them all the first time we're asked."""
+    if (key := self.key(url)) is None:
+      return None
+    with self.lock:
+      if self.keys is None:
+        self.keys = {}
+        for queued in self.urls:
+          if (queued_key := self.key(queued)) is not None:
+            self.keys.setdefault(queued_key, queued)
+      return self.keys.get(key)
+
+  def __getitem__(self: Self, url: str) -> str:  # noqa: D105
+    return self.urls[url]
+
+  def __setitem__(self: Self, url: str, value: str) -> None:  # noqa: D105
+    with self.lock:
+      if url not in self.urls:
+        self.log("+", url)
+      self.urls[url] = value
+
+  def __delitem__(self: Self, url: str) -> None:  # noqa: D105
+    with self.lock:
+      del self.urls[url]
+      self.log("-", url)
+
+  def __contains__(self: Self, url: object) -> bool:  # noqa: D105
+    return url in self.urls
+
+  def __iter__(self: Self) -> Iterator[str]:  # noqa: D105
+    with self.lock:  # a snapshot, as URLs are added and completed while others (i.e., print) go through it
+      return iter(list(self.urls))
+
+  def __len__(self: Self) -> int:  # noqa: D105
+    return len(self.urls)
+
+  def extend(self: Self, urls: Iterable[str], *, front: bool = False) -> None:
+    """Add URLs to the end of the queue, or move them to the front (in the order given)."""
+    with self.lock:
+      if not front:
+        for url in urls:
+          self[url] = url
+        return
+      urls = list(urls)
+      for url in reversed(urls):
+        self.log("^", url)
+      self.urls = {url: url for url in urls} | self.urls
+
+  def complete(self: Self, url: str) -> None:
+    """Take a URL that's been downloaded off the queue."""
+    with self.lock:
+      if self.urls.pop(url, None) is not None:
+        self.log("=", url)
+
+  def clear(self: Self) -> None:
+    """Empty the queue, journaling it as removing each URL (so its file's only emptied once it's compacted)."""
+    with self.lock:
+      for url in self.urls:
+        self.log("-", url)
+      self.urls.clear()
+      self.keys = None
+
+  def sync(self: Self) -> None:
+    """Make sure the journal's on disk, compacting it if it's outgrown the queue."""
+    with self.lock:
+      if self.journal is None:
+        return
+      if self.records > len(self.urls) + 1024:
+        self.compact()
+      else:
+        os.fsync(self.journal.fileno())
+
+  def compact(self: Self) -> None:
+    """Write the queue to its file (via a temporary file, so it's replaced atomically) and empty the journal."""
+    with self.lock:
+      if self.path is None or self.journal is None:
+        return
+      temp = self.path.with_name(f"{self.path.name}.tmp")
+      with temp.open("w", encoding="utf8", newline="\n") as f:
+        f.writelines(f"{url}\n" for url in self.urls)
+        f.flush()
+        os.fsync(f.fileno())
+      temp.replace(self.path)
+      self.journal.truncate(0)
+      self.journal.seek(0)
+      self.records = 0
+
+
+class WorkQueue:
+  """
+  A queue shared by worker processes (see worker), in an SQLite database, each claiming URLs from it on a lease.
+
+  Claiming is one write transaction, so no two workers are given the same URL. A worker renews its leases while it
+  works, and should it die they expire, for another worker to claim. Done URLs are deleted, and those that fail
+  max_tries times are kept as failed. Its due times and leases are by the clock, so workers' clocks must agree.
+  """
+
+  max_tries = 3
+  "How many times a URL's claimed (other than while it's live) before we give up on it"
+
+  def __init__(self: Self) -> None:  # noqa: D107
+    self.db: sqlite3.Connection | None = None
+    self.path: Path | None = None
+    self.lock = threading.RLock()
+
+  def open(self: Self, path: Path) -> None:
+    """Share the SQLite database at path (which must be on a local filesystem, for its WAL)."""
+    with self.lock:
+      if self.path == path:
+        return
+      if self.db is not None:
+        self.db.close()
+      path.parent.mkdir(parents=True, exist_ok=True)
+      self.db = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+      self.db.executescript(
+        """
+        PRAGMA journal_mode=WAL;
+        PRAGMA synchronous=NORMAL;
+        CREATE TABLE IF NOT EXISTS work (
+          url TEXT PRIMARY KEY,
+          position INTEGER NOT NULL,
+          state TEXT NOT NULL DEFAULT 'queued',
+          owner TEXT,
+          due REAL NOT NULL DEFAULT 0,
+          tries INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS work_position ON work (state, position);
+        """
+      )
+      self.path = path
+
+  @contextmanager
+  def transaction(self: Self) -> Iterator[sqlite3.Connection]:
+    """A write transaction, taking the database's write lock up front (so what we read in it can't change)."""
+    with self.lock:
+      if self.db is None:
+        raise sqlite3.ProgrammingError  # as we've not been opened
+      self.db.execute("BEGIN IMMEDIATE")
+      try:
+        yield self.db
+      except BaseException:
+        self.db.execute("ROLLBACK")
+        raise
+      self.db.execute("COMMIT")
+
+  def add(self: Self, urls: Iterable[str], *, front: bool = False) -> int:
+    """Add URLs to the end of the queue (or the front, in the order given), returning how many weren't there."""
+    urls = list(urls)
+    with self.transaction() as db:
+      first, last = db.execute("SELECT min(position), max(position) FROM work").fetchone()
+      start = (first or 0) - len(urls) if front else (last or 0) + 1
+      before = db.total_changes
+      db.executemany("INSERT OR IGNORE INTO work (url, position) VALUES (?, ?)", zip(urls, count(start), strict=False))
+      return db.total_changes - before
+
+  def claim(self: Self, owner: str, n: int, lease: float) -> list[str]:
+    """
+    Claim the first n URLs that are due (or whose lease has expired) for lease seconds.
+
+    Those whose leases expired on their last try (i.e., they keep killing their workers) are failed instead.
+    """
+    now = time()
+    with self.transaction() as db:
+      db.execute(
+        "UPDATE work SET state='failed', owner=NULL WHERE state='leased' AND due <= ? AND tries >= ?",
+        (now, self.max_tries),
+      )
+      urls = [
+        url
+        for (url,) in db.execute(
+          "SELECT url FROM work WHERE state IN ('queued', 'leased') AND due <= ? AND tries < ?"
+          " ORDER BY position LIMIT ?",
+          (now, self.max_tries, n),
+        )
+      ]
+      db.executemany(
+        "UPDATE work SET state='leased', owner=?, due=?, tries=tries+1 WHERE url=?",
+        ((owner, now + lease, url) for url in urls),
+      )
+      return urls
+
+  def renew(self: Self, owner: str, urls: Iterable[str], lease: float) -> list[str]:
+    """Renew our leases on URLs for another lease seconds, returning any we'd lost (as they'd expired)."""
+    with self.transaction() as db:
+      renew = "UPDATE work SET due=? WHERE url=? AND owner=? AND state='leased'"
+      return [url for url in urls if not db.execute(renew, (time() + lease, url, owner)).rowcount]
+
+  def complete(self: Self, url: str) -> None:
+    """Take a URL that's been downloaded off the queue."""
+    with self.transaction() as db:
+      db.execute("DELETE FROM work WHERE url=?", (url,))
+
+  def release(self: Self, owner: str, url: str, due: float, *, tried: bool = True) -> None:
+    """
+    Let a URL we'd claimed be claimed again once it's due, or count it as failed if it's been tried max_tries times.
+
+    If it wasn't really tried (i.e., it's still live), it's not counted.
+    """
+    with self.transaction() as db:
+      db.execute(
+        "UPDATE work SET state=CASE WHEN tries>=? THEN 'failed' ELSE 'queued' END, owner=NULL, due=?, tries=tries-?"
+        " WHERE url=? AND owner=? AND state='leased'",
+        (self.max_tries + (not tried), due, int(not tried), url, owner),
+      )
+
+  def fail(self: Self, url: str) -> None:
+    """Give up on a URL (leaving it in the database, as failed)."""
+    with self.transaction() as db:
+      db.execute("UPDATE work SET state='failed', owner=NULL WHERE url=?", (url,))
+
+  def next_due(self: Self) -> float | None:
+    """When the next URL that's not claimed is due (i.e., one that was live), if any are left."""
+    with self.lock:
+      if self.db is None:
+        return None
+      return self.db.execute("SELECT min(due) FROM work WHERE state='queued'").fetchone()[0]
+
+  def counts(self: Self) -> dict[str, int]:
+    """How many URLs are queued, leased, and failed."""
+    with self.lock:
+      if self.db is None:
+        return {}
+      return dict(self.db.execute("SELECT state, count(*) FROM work GROUP BY state").fetchall())
+
+
+class Playlists:
+  """
+  How far we've expanded each playlist (or channel) into the queue, and the playlist fields of the entries we queued.
+
+  Kept in a JSON file, so an expansion that's interrupted resumes where it left off, and each entry still downloads
+  into the playlist's outtmpl (with its playlist_index) even though it's downloaded on its own.
+  """
+
+  save_every = 100
+  "How many entries we queue between saves"
+
+  def __init__(self: Self) -> None:  # noqa: D107
+    self.path: Path | None = None
+    self.state: dict[str, dict[str, Any]] = {}
+    self.entries: dict[str, dict[str, Any]] = {}
+    self.unsaved = 0
+    self.lock = threading.RLock()
+
+  def open(self: Self, path: Path) -> None:
+    """Load what we'd expanded from path."""
+    with self.lock:
+      if self.path == path:
+        return
+      self.path = path
+      with suppress(OSError, ValueError, KeyError):
+        saved = json.loads(path.read_text(encoding="utf8"))
+        self.state, self.entries = saved["playlists"], saved["entries"]
+
+  def save(self: Self) -> None:
+    """Save how far we've expanded each playlist (via a temporary file, so it's replaced atomically)."""
+    with self.lock:
+      self.unsaved = 0
+      if self.path is None:
+        return
+      self.path.parent.mkdir(parents=True, exist_ok=True)
+      temp = self.path.with_name(f"{self.path.name}.tmp")
+      temp.write_text(json.dumps({"playlists": self.state, "entries": self.entries}), encoding="utf8")
+      temp.replace(self.path)
+
+  def progress(self: Self, url: str) -> dict[str, Any]:
+    """How far we've expanded a playlist: how many entries we've "fetched", and whether that's all ("complete")."""
+    with self.lock:
+      return self.state.setdefault(url, {"fetched": 0, "complete": False})
+
+  def add(self: Self, url: str, fields: dict[str, Any]) -> None:
+    """Remember the playlist fields of an entry we've queued."""
+    with self.lock:
+      self.entries[url] = fields
+      self.unsaved += 1
+      if self.unsaved >= self.save_every:
+        self.save()
+
+  def done(self: Self, url: str) -> None:
+    """Forget an entry that's been downloaded."""
+    with self.lock:
+      if self.entries.pop(url, None) is not None:
+        self.unsaved += 1
+
+
+class ExtractorIndex:
+  """
+  Which of yt-dlp's extractors handles a URL, answered offline by matching only the extractors for words it has.
+
+  Extractors are indexed by words every URL their _VALID_URL patterns match must have (see url_options), with those
+  we can't index always checked. The index is cached to disk for each version of yt-dlp, as building it means parsing
+  all their patterns.
+  """
+
+  FORMAT = 2
+  "The version of how we index extractors, so we rebuild indexes we cached before it changed"
+
+  def __init__(self: Self) -> None:  # noqa: D107
+    self.path: Path | None = None
+    self.keys: list[str] = []
+    self.index: dict[str, list[int]] = {}
+    self.fallback: list[int] = []
+    self.extractors: dict[int, type] = {}
+    self.extra: list[type] = []  # tried before those indexed, as PYTDL's extra_extractors are
+    self.lock = threading.Lock()
+
+  def load(self: Self) -> None:
+    """Load the index for our version of yt-dlp from path, building (and saving) it if we must."""
+    with self.lock:
+      if self.keys:
+        return
+      if self.path is not None and self.path.is_file():
+        with suppress(ValueError, KeyError):
+          cached = json.loads(self.path.read_text(encoding="utf8"))
+          if cached["version"] == ytdlp_version() and cached.get("format") == self.FORMAT:
+            self.keys, self.index, self.fallback = cached["keys"], cached["index"], cached["fallback"]
+            return
+      from yt_dlp.extractor import gen_extractor_classes  # noqa: PLC0415
+
+      options: dict[int, list[list[set[str]]]] = {}
+      for i, ie in enumerate(ie for ie in gen_extractor_classes() if ie.ie_key() != "Generic"):
+        self.keys.append(ie.ie_key())
+        patterns = getattr(ie, "_VALID_URL", None) or ()
+        options[i] = list(map(url_options, [patterns] if isinstance(patterns, str) else patterns))
+        if not options[i] or not all(options[i]):  # as some URL it matches could have none of its words
+          self.fallback.append(i)
+          del options[i]
+      # each's indexed by its rarest words (i.e., "ted" rather than "www" or "com" for www\.ted\.com)
+      counts = Counter(token for ways in options.values() for token in set().union(*chain(*ways)))
+      index: dict[str, list[int]] = {}
+      for i, ways in options.items():
+        tokens = (
+          min(way, key=lambda tokens: (max(map(counts.__getitem__, tokens)), vagueness(tokens))) for way in ways
+        )
+        for token in set().union(*tokens):
+          index.setdefault(token, []).append(i)
+      # words most URLs have would have us checking a good share of them, so we always check those indexed by them
+      too_common = {token for token, ies in index.items() if len(ies) > len(self.keys) // 40}
+      self.fallback = sorted({*self.fallback, *(i for token in too_common for i in index[token])})
+      fallback = set(self.fallback)
+      self.index = {
+        token: [i for i in ies if i not in fallback] for token, ies in index.items() if token not in too_common
+      }
+      if self.path is not None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.path.write_text(
+          json.dumps(
+            {
+              "version": ytdlp_version(),
+              "format": self.FORMAT,
+              "keys": self.keys,
+              "index": self.index,
+              "fallback": self.fallback,
+            }
+          ),
+          encoding="utf8",
+        )
+
+  def extractor(self: Self, i: int) -> type:
+    """The i'th extractor class."""
+    if (ie := self.extractors.get(i)) is None:
+      from yt_dlp.extractor import get_info_extractor  # noqa: PLC0415
+
+      ie = self.extractors[i] = get_info_extractor(self.keys[i])
+    return ie
+
+  def find(self: Self, url: str) -> type | None:
+    """Which extractor (class) handles a URL, if any does other than the generic one."""
+    if not URL.can_parse(url):
+      return None
+    if (ie := next((ie for ie in self.extra if ie.suitable(url)), None)) is not None:
+      return ie
+    self.load()
+    candidates = url_candidates(self.index, self.fallback, url)
+    return next((ie for i in candidates if (ie := self.extractor(i)).suitable(url)), None)
+
+  def match(self: Self, url: str) -> str | None:
+    """The key of the extractor that handles a URL (i.e., "Youtube"), if any does other than the generic one."""
+    return None if (ie := self.find(url)) is None else ie.ie_key()
+
+  def is_single_video(self: Self, url: str) -> bool | None:
+    """Is a URL for a single video (or a playlist), by what its extractor returns, or None if that could be either."""
+    return None if (ie := self.find(url)) is None else ie.is_single_video(url)
+
+  def archive_id(self: Self, url: str) -> str | None:
+    """The ID yt-dlp's download archive would have for a URL (i.e., "youtube dQw4w9WgXcQ"), if it's in the URL."""
+    if (ie := self.find(url)) is None or (vid := ie.get_temp_id(url)) is None:
+      return None
+    from yt_dlp.utils import make_archive_id  # noqa: PLC0415
+
+    return make_archive_id(ie.ie_key(), vid)
+
+
+class Chars(NamedTuple):
+  """Which characters part of a parsed regex can match: those in chars, or (if negated) any but them."""
+
+  negated: bool = False
+  "Whether it's any character but those in chars"
+  chars: frozenset[str] = frozenset()
+  'The characters (in lower case), with "" for the start or end of the URL'
+
+  @classmethod
+  def of(cls: type[Self], op: Any, av: Any) -> Self:  # noqa: ANN401
+    """Which characters a (single character) item of a parsed regex matches, or any if it isn't one."""
+    match op.name:
+      case "LITERAL":
+        return cls(chars=frozenset(chr(av).lower()))
+      case "NOT_LITERAL":
+        return cls(negated=True, chars=frozenset(chr(av).lower()))
+      case "CATEGORY":
+        return CATEGORIES.get(av.name, cls(negated=True))
+      case "IN":
+        chars = cls()
+        for item_op, item_av in av:
+          if item_op.name == "RANGE":  # of which only ASCII matters, as words in URLs are only ASCII
+            chars |= cls(chars=frozenset(chr(c).lower() for c in range(item_av[0], min(item_av[1], 0x7F) + 1)))
+          elif item_op.name != "NEGATE":
+            chars |= cls.of(item_op, item_av)
+        return cls(not chars.negated, chars.chars) if av and av[0][0].name == "NEGATE" else chars
+    return cls(negated=True)
+
+  def __or__(self: Self, other: "Chars") -> "Chars":  # type: ignore[override] (as it's a union, not a concatenation)
+    """The characters either can match."""
+    match self.negated, other.negated:
+      case False, False:
+        return Chars(chars=self.chars | other.chars)
+      case True, True:
+        return Chars(negated=True, chars=self.chars & other.chars)
+      case True, False:
+        return Chars(negated=True, chars=self.chars - other.chars)
+    return Chars(negated=True, chars=other.chars - self.chars)
+
+  def has(self: Self, char: str) -> bool:
+    """Can it match char?"""
+    return (char in self.chars) != self.negated
+
+  def avoids(self: Self, chars: frozenset[str]) -> bool:
+    """Can it match none of the given characters?"""
+    return not self.negated and self.chars.isdisjoint(chars)
+
+
+class CleanRule(NamedTuple):
+  """A compiled rule for cleaning URLs, either one of PYTDL's url_rules or a ClearURLs provider."""
+
+  pattern: re.Pattern | None = None
+  "Which URLs it applies to (if it's not dispatched to by hostname)"
+  exceptions: tuple[re.Pattern, ...] = ()
+  "Which URLs it doesn't apply to after all"
+  redirect: tuple[tuple[re.Pattern, str], ...] = ()
+  "Rewrites of the whole URL, as (pattern, replacement)"
+  unwrap: tuple[re.Pattern, ...] = ()
+  "Patterns whose first group is the (percent-encoded) URL we're really being sent to"
+  raw: tuple[re.Pattern, ...] = ()
+  "Patterns to remove from the whole URL"
+  host: str | None = None
+  "The canonical hostname to switch to"
+  scope: str = "/"
+  "Which paths (by prefix) we clean the query of"
+  rename: dict[str, str] = {}  # noqa: RUF012
+  "Query parameters to rename (unless the new name's already there)"
+  keep: dict[str, str] | None = None
+  "If given, the only query parameters to keep, and which paths (by prefix) to keep each on"
+  deny: re.Pattern | None = None
+  "Which query parameters to remove"
+
+
+class UrlCleaner:
+  """
+  Cleans URLs by rules: PYTDL's own url_rules (for sites by hostname), then ClearURLs' if we have its data.
+
+  PYTDL's rules are dispatched to by exact hostname, and ClearURLs' are indexed by the words in their URL patterns
+  (as with the ExtractorIndex), so each URL is only checked against the rules that could apply to it.
+  """
+
+  def __init__(self: Self) -> None:  # noqa: D107
+    self.rules: dict[str, CleanRule] = {}
+    self.providers: list[CleanRule] = []
+    self.index: dict[str, list[int]] = {}
+    self.fallback: list[int] = []
+
+  def load(self: Self, rules: dict[str, dict[str, Any]], site_hosts: dict[str, list[str]], clearurls: Path) -> None:
+    """Compile our rules (with the hosts of each from site_hosts, unless they say), and ClearURLs' (if we have them)."""
+    self.rules.clear()
+    for site, rule in rules.items():
+      compiled = CleanRule(
+        redirect=tuple((re.compile(pattern), repl) for pattern, repl in rule.get("redirect", [])),
+        host=rule.get("host"),
+        scope=rule.get("scope", "/"),
+        rename=rule.get("rename", {}),
+        keep=rule.get("keep"),
+        deny=re.compile(f"^(?:{'|'.join(rule['deny'])})$", re.IGNORECASE) if rule.get("deny") else None,
+      )
+      for host in rule.get("hosts", site_hosts.get(site, [])):
+        self.rules[host] = compiled
+    self.providers, self.index, self.fallback = [], {}, []
+    if not clearurls.is_file():
+      return
+    for name, provider in json.loads(clearurls.read_text(encoding="utf8"))["providers"].items():
+      try:
+        rules = [*provider.get("rules", []), *provider.get("referralMarketing", [])]
+        compiled = CleanRule(
+          pattern=re.compile(provider["urlPattern"], re.IGNORECASE),
+          exceptions=tuple(re.compile(pattern, re.IGNORECASE) for pattern in provider.get("exceptions", [])),
+          unwrap=tuple(re.compile(pattern, re.IGNORECASE) for pattern in provider.get("redirections", [])),
+          raw=tuple(re.compile(pattern, re.IGNORECASE) for pattern in provider.get("rawRules", [])),
+          deny=re.compile(f"^(?:{'|'.join(rules)})$", re.IGNORECASE) if rules else None,
+        )
+      except re.error as err:
+        logging.warning(f"Skipping ClearURLs provider {name} as we couldn't compile its rules ({err})")
+        continue
+      for token in min(url_options(provider["urlPattern"], anchored=False), key=vagueness, default=["*"]):
+        if token == "*":
+          self.fallback.append(len(self.providers))
+        else:
+          self.index.setdefault(token, []).append(len(self.providers))
+      self.providers.append(compiled)
+
+  def clean(self: Self, url: str) -> str:
+    """Clean a URL (or return it as it is, if it isn't one)."""
+    return self.clean_parsed(URL(url)).href if URL.can_parse(url) else url
+
+  def clean_parsed(self: Self, url: URL) -> URL:
+    """Clean a parsed URL (in place, unless it redirects elsewhere)."""
+    if (rule := self.rules.get(url.hostname)) is not None:
+      url = self.apply(rule, url)
+    if self.providers:
+      for i in url_candidates(self.index, self.fallback, url.href):
+        url = self.apply(self.providers[i], url)
+    return url
+
+  def apply(self: Self, rule: CleanRule, url: URL) -> URL:  # noqa: C901
+    """Apply a rule to a URL, returning the cleaned URL."""
+    href = url.href
+    if rule.pattern is not None and (
+      not rule.pattern.search(href) or any(exception.search(href) for exception in rule.exceptions)
+    ):
+      return url
+    for pattern in rule.unwrap:
+      if (match := pattern.search(href)) and URL.can_parse(target := unquote(match[1])):
+        return self.clean_parsed(URL(target))
+    rewritten = href
+    for pattern, repl in rule.redirect:
+      rewritten = pattern.sub(repl, rewritten)
+    for pattern in rule.raw:
+      rewritten = pattern.sub("", rewritten)
+    if rewritten != href and URL.can_parse(rewritten):
+      url = URL(rewritten)
+    if rule.host is not None:
+      url.hostname = rule.host
+    if url.search and url.pathname.startswith(rule.scope):
+      pairs = [pair.partition("=") for pair in url.search.removeprefix("?").split("&")]
+      present = {key for key, _, _ in pairs}
+      query = []
+      for key, eq, val in pairs:
+        if (renamed := rule.rename.get(key, key)) != key and renamed in present:
+          continue
+        if rule.keep is not None and not url.pathname.startswith(rule.keep.get(renamed, "\0")):
+          continue
+        if rule.deny is not None and rule.deny.match(unquote_plus(renamed)):
+          continue
+        query.append(f"{renamed}{eq}{val}")
+      url.search = "&".join(query)
+    return url
+
+
+class Classified(NamedTuple):
+  """What we know about a URL just from parsing it."""
+
+  url: str
+  "The clean URL"
+  host: str
+  "Its canonical hostname"
+  site: str | None
+  "Which site's template it uses, if any"
+  categories: frozenset[str]
+  "Which categories (show, podcast, playlist) it's in"
+
+
+class RateLimiter:
+  """
+  A token bucket for each host, so we only wait between downloads from the same host, and never on an idle one.
+
+  Each host's bucket refills at one download per naptime (on average), holding up to its concurrency. When a host
+  throttles us (HTTP 429, a bot check, or 403s for several URLs), its rate halves and it's left alone for an
+  exponentially growing while, then after a run of successes its rate doubles back up towards naptime.
+  """
+
+  ramp = 5
+  "How many downloads in a row must succeed before a host's rate doubles back up"
+  backoff = 30.0
+  "How many seconds we leave a host alone for after it first throttles us (doubling each time after)"
+  max_backoff = 1800.0
+  "The most seconds we leave a host alone for"
+  floor = 1.0
+  "The fewest seconds per download we allow a host that's throttled us, as halving a naptime of 0 wouldn't slow us"
+  forbidden_urls = 2
+  "How many different URLs a host must refuse (with a 403) within forbidden_window before we take it as throttling"
+  forbidden_window = 300.0
+  "How many seconds we remember a host's 403s for"
+
+  def __init__(self: Self) -> None:  # noqa: D107
+    self.naptime = 3.0
+    self.tokens: dict[str, float] = {}
+    self.updated: dict[str, float] = {}
+    self.strikes: Counter[str] = Counter()
+    self.streak: Counter[str] = Counter()
+    self.until: dict[str, float] = {}
+    self.refused: dict[str, dict[str, float]] = {}
+    self.lock = threading.Lock()
+
+  def interval(self: Self, host: str) -> float:
+    """How many seconds per download we're allowing a host at the moment."""
+    if not (strikes := self.strikes[host]):
+      return self.naptime
+    return max(self.naptime, self.floor) * 2**strikes
+
+  def refill(self: Self, host: str, burst: int, now: float) -> float:
+    """Top up a host's bucket for the time since we last did, returning its tokens."""
+    if host not in self.tokens:
+      self.tokens[host] = burst
+    elif (interval := self.interval(host)) > 0:
+      self.tokens[host] = min(burst, self.tokens[host] + (now - self.updated[host]) / interval)
+    else:
+      self.tokens[host] = burst
+    self.updated[host] = now
+    return self.tokens[host]
+
+  def delay(self: Self, host: str, burst: int) -> float:
+    """How many seconds until we may start a download from a host (0 if we can now)."""
+    now = monotonic()
+    with self.lock:
+      tokens = self.refill(host, burst, now)
+      wait = max(self.until.get(host, 0) - now, 0)
+      if tokens < 1:
+        wait = max(wait, (1 - tokens) * self.interval(host))
+      return wait
+
+  def take(self: Self, host: str, burst: int) -> None:
+    """Spend a token on a download from a host (going into debt if need be, so the average rate holds)."""
+    with self.lock:
+      self.refill(host, burst, monotonic())
+      self.tokens[host] -= 1 + random() / 2  # a little jitter, so we don't look like clockwork
+
+  def refund(self: Self, host: str, burst: int) -> None:
+    """Give back the token spent on what turned out not to be a download after all (i.e., we had it already)."""
+    with self.lock:
+      self.tokens[host] = min(self.refill(host, burst, monotonic()) + 1, burst)
+
+  def throttled(self: Self, host: str) -> None:
+    """A host's throttling us, so halve its rate and leave it alone for a while."""
+    with self.lock:
+      self.strikes[host] += 1
+      self.streak[host] = 0
+      self.tokens[host], self.updated[host] = 0, monotonic()
+      self.until[host] = monotonic() + min(self.backoff * 2 ** (self.strikes[host] - 1), self.max_backoff)
+
+  def forbidden(self: Self, host: str, url: str) -> bool:
+    """A host refused us a URL (with a 403), returning whether it's refused enough others lately to be throttling us."""
+    now = monotonic()
+    with self.lock:
+      refused = self.refused.setdefault(host, {})
+      refused[url] = now
+      for old in [old for old, when in refused.items() if now - when > self.forbidden_window]:
+        del refused[old]
+      return len(refused) >= self.forbidden_urls
+
+  def succeeded(self: Self, host: str) -> None:
+    """A download from a host went fine, so after enough of those, double its rate back up."""
+    with self.lock:
+      self.streak[host] += 1
+      if self.strikes[host] and self.streak[host] >= self.ramp:
+        self.strikes[host] -= 1
+        self.streak[host] = 0
+
+  def rates(self: Self) -> dict[str, tuple[float, float]]:
+    """The seconds per download we're allowing each host we've downloaded from, and how long until it's allowed."""
+    now = monotonic()
+    with self.lock:
+      return {host: (self.interval(host), max(self.until.get(host, 0) - now, 0)) for host in sorted(self.tokens)}
+
+
+class Entry(NamedTuple):
+  """An entry of a playlist (or channel), as listed flat."""
+
+  index: int
+  "Where it is in the playlist (from 1)"
+  url: str | None
+  "Its (clean) URL, if it has one"
+  archive_id: str | None
+  "Its archive ID (i.e., 'youtube dQw4w9WgXcQ'), if it's listed with its extractor and ID"
+  date: str | int | None
+  "When it was uploaded (as upload_date or timestamp), if it's listed with that"
+  fields: dict[str, Any]
+  "The playlist fields to download it with (i.e., playlist_title and playlist_index)"
+
+
+class Prefetcher:
+  """
+  Extracts info for the next few URLs in line on background threads, so that it's cached by the time we need it.
+
+  URLs are taken as they start downloading, and we only look as far ahead as the next few that haven't been taken.
+  """
+
+  def __init__(self: Self, extract: Callable[[str], Any], urls: Iterable[str], ahead: int) -> None:  # noqa: D107
+    self.extract = extract
+    self.upcoming = deque(urls)
+    self.ahead = ahead
+    self.started: set[str] = set()
+    self.taken: set[str] = set()
+    self.pool = ThreadPoolExecutor(max_workers=max(ahead, 1), thread_name_prefix="pytdl-prefetch")
+
+  def __enter__(self: Self) -> Self:  # noqa: D105
+    return self
+
+  def __exit__(self: Self, *_exc: object) -> None:  # noqa: D105
+    self.pool.shutdown(wait=False, cancel_futures=True)
+
+  def add(self: Self, url: str) -> None:
+    """Another URL's joined the line."""
+    self.upcoming.append(url)
+
+  def take(self: Self, url: str) -> None:
+    """A URL has started downloading, so we needn't look ahead to it."""
+    self.taken.add(url)
+
+  def top_up(self: Self) -> None:
+    """Start extracting any of the next URLs in line that we haven't yet."""
+    while self.upcoming and self.upcoming[0] in self.taken:
+      self.upcoming.popleft()
+    for url in islice((url for url in self.upcoming if url not in self.taken), self.ahead):
+      if url not in self.started:
+        self.started.add(url)
+        self.pool.submit(self.extract, url)
+
+
+class Metrics:
+  """
+  Counters and histograms of where PYTDL spends its time, cheap enough to always keep.
+
+  Each thread counts into its own shard, so counting never waits on a lock, and the shards are only summed when read.
+  Once a thread's ended, its shard's folded into a base shard, so they don't pile up over many thread pools.
+  Histograms are bucketed by powers of two (from 2**-10 to 2**32), which is plenty to tell 50ms from 5s.
+  """
+
+  LOWEST = -10
+  "The power of two that the first bucket's up to"
+  BUCKETS = 43
+  "How many buckets each histogram has (the last taking everything bigger)"
+
+  def __init__(self: Self) -> None:  # noqa: D107
+    self.local = threading.local()
+    self.base: tuple[dict[str, float], dict[str, list[float]]] = {}, {}
+    self.shards: dict[threading.Thread, tuple[dict[str, float], dict[str, list[float]]]] = {}
+    self.lock = threading.Lock()
+    self.exporter: threading.Thread | None = None
+    self.stopping = threading.Event()
+
+  def shard(self: Self) -> tuple[dict[str, float], dict[str, list[float]]]:
+    """This thread's counters and histograms."""
+    try:
+      return self.local.shard
+    except AttributeError:
+      shard = self.local.shard = {}, {}
+      with self.lock:
+        self.retire()
+        self.shards[threading.current_thread()] = shard
+      return shard
+
+  def retire(self: Self) -> None:
+    """Fold the shards of the threads that have ended into base (holding the lock), as they'll count no more."""
+    counters, hists = self.base
+    for thread in [thread for thread in self.shards if not thread.is_alive()]:
+      ended_counters, ended_hists = self.shards.pop(thread)
+      for name, n in ended_counters.items():
+        counters[name] = counters.get(name, 0) + n
+      for name, hist in ended_hists.items():
+        hists[name] = [a + b for a, b in zip(hists.get(name, repeat(0.0)), hist, strict=False)]
+
+  def count(self: Self, name: str, n: float = 1) -> None:
+    """Add n to a counter."""
+    counters = self.shard()[0]
+    counters[name] = counters.get(name, 0) + n
+
+  def observe(self: Self, name: str, value: float) -> None:
+    """Add a value to a histogram."""
+    hists = self.shard()[1]
+    if (hist := hists.get(name)) is None:
+      hist = hists[name] = [0.0] * (self.BUCKETS + 1)  # its sum, then its buckets
+    hist[0] += value
+    hist[1 + min(max(frexp(value)[1] - self.LOWEST, 0), self.BUCKETS - 1)] += 1
+
+  @contextmanager
+  def timer(self: Self, name: str) -> Iterator[None]:
+    """Observe how many seconds something takes."""
+    start = monotonic()
+    try:
+      yield
+    finally:
+      self.observe(name, monotonic() - start)
+
+  def progress_hook(self: Self, status: dict[str, Any]) -> None:
+    """A yt-dlp progress hook, counting the bytes (and seconds) of what it finishes downloading."""
+    match status["status"]:
+      case "finished":
+        size = status.get("total_bytes") or status.get("downloaded_bytes") or 0
+        self.count("downloaded_bytes", size)
+        if elapsed := status.get("elapsed"):
+          self.observe("transfer_seconds", elapsed)
+          self.observe("transfer_bytes_per_second", size / elapsed)
+      case "error":
+        self.count("transfer_errors")
+
+  def postprocessor_hook(self: Self, status: dict[str, Any]) -> None:
+    """A yt-dlp postprocessor hook, timing each postprocessor (on the thread it runs on)."""
+    match status["status"]:
+      case "started":
+        self.local.postprocessing = monotonic()
+      case "finished" if (start := getattr(self.local, "postprocessing", None)) is not None:
+        self.observe("postprocess_seconds", monotonic() - start)
+        self.count(f'postprocessed{{postprocessor="{status.get("postprocessor")}"}}')
+
+  def clear(self: Self) -> None:
+    """Forget everything we've counted (in every thread)."""
+    with self.lock:
+      for counters, hists in (self.base, *self.shards.values()):
+        counters.clear()
+        hists.clear()
+
+  def snapshot(self: Self) -> tuple[dict[str, float], dict[str, list[float]]]:
+    """Every thread's counters and histograms, summed."""
+    counters: Counter[str] = Counter()
+    hists: dict[str, list[float]] = {}
+    with self.lock:
+      self.retire()
+      shards = [self.base, *self.shards.values()]
+    for shard_counters, shard_hists in shards:
+      counters.update(shard_counters.copy())  # copying being atomic, whereas iterating as it's counted into isn't
+      for name, hist in shard_hists.copy().items():
+        hists[name] = [a + b for a, b in zip(hists.get(name, repeat(0.0)), hist.copy(), strict=False)]
+    return dict(sorted(counters.items())), dict(sorted(hists.items()))
+
+  def quantile(self: Self, hist: list[float], q: float) -> float:
+    """Roughly (i.e., up to its bucket's upper bound) the q'th quantile of a histogram."""
+    rank, seen = q * sum(hist[1:]), 0.0
+    for i, n in enumerate(hist[1:]):
+      seen += n
+      if seen >= rank and n:
+        return 2.0 ** (i + self.LOWEST)
+    return 0.0
+
+  def summary(self: Self) -> dict[str, dict[str, float]]:
+    """The count, total, mean, and rough median, 95th, and 99th percentiles of each histogram."""
+    summary = {}
+    for name, hist in self.snapshot()[1].items():
+      n = sum(hist[1:])
+      summary[name] = {
+        "count": n,
+        "total": hist[0],
+        "mean": hist[0] / n if n else 0.0,
+        **{f"p{q}": self.quantile(hist, q / 100) for q in (50, 95, 99)},
+      }
+    return summary
+
+  def prometheus(self: Self) -> str:
+    """Our metrics in Prometheus' text format (i.e., for node_exporter's textfile collector)."""
+    counters, hists = self.snapshot()
+    lines, typed = [], set()
+    for key, val in counters.items():
+      name, labels = key.partition("{")[::2]
+      if name not in typed:
+        typed.add(name)
+        lines.append(f"# TYPE pytdl_{name} counter")
+      lines.append(f"pytdl_{name}{'{' if labels else ''}{labels} {val}")
+    for name, hist in hists.items():
+      lines.append(f"# TYPE pytdl_{name} histogram")
+      cumulative = 0.0
+      for i, n in enumerate(hist[1:-1]):
+        cumulative += n
+        lines.append(f'pytdl_{name}_bucket{{le="{2.0 ** (i + self.LOWEST)}"}} {cumulative}')
+      lines.append(f'pytdl_{name}_bucket{{le="+Inf"}} {sum(hist[1:])}')
+      lines.append(f"pytdl_{name}_sum {hist[0]}")
+      lines.append(f"pytdl_{name}_count {sum(hist[1:])}")
+    return "\n".join(lines) + "\n"
+
+  def export(self: Self, path: Path) -> None:
+    """Write our metrics to path (atomically), as JSON if it ends in .json, otherwise in Prometheus' text format."""
+    if path.suffix == ".json":
+      text = json.dumps({"counters": self.snapshot()[0], "histograms": self.summary()}, indent=2)
+    else:
+      text = self.prometheus()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f"{path.name}.tmp")
+    tmp.write_text(text, encoding="utf8")
+    tmp.replace(path)
+
+  def export_every(self: Self, path: Path, interval: float) -> None:
+    """Export our metrics to path every interval seconds in the background (stopping any we were already), if > 0."""
+    if self.exporter is not None:
+      self.stopping.set()
+      self.exporter.join()
+      self.stopping.clear()
+      self.exporter = None
+    if interval > 0:
+
+      def exporting() -> None:
+        while not self.stopping.wait(interval):
+          with suppress(OSError):
+            self.export(path)
+
+      self.exporter = threading.Thread(target=exporting, name="pytdl-metrics", daemon=True)
+      self.exporter.start()
+
+
+class Tracer:
+  """
+  Spans of what happens to each URL, buffered in memory to save in Chrome's trace-event format (i.e., for Perfetto).
+
+  Tracing is opt-in; when it's off, span is a shared no-op, so the spans we'd record cost next to nothing.
+  Spans go on a track for each thread name (not each thread), so a thread pool that's started again on every wake
+  reuses the tracks of the last, rather than adding more for as long as we run.
+  """
+
+  limit = 1_000_000
+  "How many events we keep (the oldest being dropped first), so tracing a long run doesn't eat all our memory"
+
+  def __init__(self: Self) -> None:  # noqa: D107
+    self.enabled = False
+    self.events: deque[dict[str, Any]] = deque(maxlen=self.limit)
+    self.threads: dict[str, int] = {}
+    self.tids = count(1)
+    self.local = threading.local()
+
+  def record(self: Self, name: str, start: int, end: int, args: dict[str, Any]) -> None:
+    """Record a span on this thread, from start to end (in perf_counter_ns)."""
+    if (tid := getattr(self.local, "tid", None)) is None:
+      tid = self.local.tid = self.threads.setdefault(threading.current_thread().name, next(self.tids))
+    self.events.append(
+      {"name": name, "ph": "X", "ts": start / 1000, "dur": (end - start) / 1000, "pid": 1, "tid": tid, "args": args}
+    )
+
+  @contextmanager
+  def recording(self: Self, name: str, args: dict[str, Any]) -> Iterator[None]:
+    """Record a span of what's done within."""
+    start = perf_counter_ns()
+    try:
+      yield
+    finally:
+      self.record(name, start, perf_counter_ns(), args)
+
+  def span(self: Self, name: str, **args: Any) -> AbstractContextManager[None]:  # noqa: ANN401
+    """Record a span of what's done within, if we're tracing."""
+    return self.recording(name, args) if self.enabled else NOTHING
+
+  def progress_hook(self: Self, status: dict[str, Any]) -> None:
+    """
+    A yt-dlp progress hook, recording a span for each fragment it downloads.
+
+    A fragment's span ends when the next starts, or when the download stops (i.e., it's finished, or failed).
+    """
+    now, local = perf_counter_ns(), self.local
+    index = status.get("fragment_index") if status["status"] == "downloading" else None
+    if index == (fragment := getattr(local, "fragment", None)):
+      return
+    if fragment is not None:
+      self.record(f"fragment {fragment}", local.since, now, {"url": local.url})
+    local.fragment, local.since, local.url = index, now, status.get("info_dict", {}).get("webpage_url")
+
+  def postprocessor_hook(self: Self, status: dict[str, Any]) -> None:
+    """A yt-dlp postprocessor hook, recording a span for each postprocessor."""
+    match status["status"]:
+      case "started":
+        self.local.postprocessing = perf_counter_ns()
+      case "finished" if (start := getattr(self.local, "postprocessing", None)) is not None:
+        url = status.get("info_dict", {}).get("webpage_url")
+        self.record(status.get("postprocessor") or "postprocessor", start, perf_counter_ns(), {"url": url})
+        self.local.postprocessing = None
+
+  def save(self: Self, path: Path) -> int:
+    """Save (atomically) what we've traced to path, returning how many spans that was."""
+    events = list(self.events)
+    names = [
+      {"name": "thread_name", "ph": "M", "pid": 1, "tid": tid, "args": {"name": name}}
+      for name, tid in self.threads.copy().items()
+    ]
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f"{path.name}.tmp")
+    tmp.write_text(json.dumps({"traceEvents": names + events, "displayTimeUnit": "ms"}), encoding="utf8")
+    tmp.replace(path)
+    return len(events)
+
+
+class Replies:
+  """
+  What stands in for sys.stdout while we're serving, so what a command prints goes back to the client that sent it.
+
+  Each thread replying to a client writes to it, and the rest (i.e., the background downloads) to the terminal.
+  """
+
+  def __init__(self: Self, terminal: TextIO) -> None:  # noqa: D107
+    self.terminal = terminal
+    self.local = threading.local()
+
+  @contextmanager
+  def to(self: Self, write: Callable[[str], object]) -> Iterator[None]:
+    """Send what this thread prints within to write."""
+    self.local.write = write
+    try:
+      yield
+    finally:
+      self.local.write = None
+
+  def write(self: Self, s: str) -> int:  # noqa: D102
+    if (write := getattr(self.local, "write", None)) is None:
+      return self.terminal.write(s)
+    write(s)
+    return len(s)
+
+  def flush(self: Self) -> None:  # noqa: D102
+    if getattr(self.local, "write", None) is None:
+      self.terminal.flush()
+
+  def __getattr__(self: Self, name: str) -> Any:  # noqa: ANN401, D105
+    return getattr(self.terminal, name)
+
+
+class ControlHandler(StreamRequestHandler):
+  """
+  Runs each line a client sends us as a command, replying with what it prints, until it's done or we're to stop.
+
+  Over TCP, the first line must be the server's token (which only its port file says), and we hang up on anything
+  that looks like HTTP, as a web page could otherwise have a browser send us commands.
+  """
+
+  def handle(self: Self) -> None:  # noqa: D102
+    run: Callable[[str], bool] = self.server.run  # type: ignore[attr-defined] (see control_server)
+    replies: Replies = self.server.replies  # type: ignore[attr-defined]
+    token: str | None = self.server.token  # type: ignore[attr-defined]
+    lines = (raw.decode("utf8", "replace").strip() for raw in self.rfile)
+    try:
+      if token is not None and not compare_digest(next(lines, "").encode("utf8"), token.encode("utf8")):
+        logging.warning("Refused a client that didn't have our token")
+        return
+      with replies.to(lambda s: self.wfile.write(s.encode("utf8"))):
+        for line in filter(None, lines):
+          if HTTP_REQUEST.match(line):
+            logging.warning("Refused an HTTP request (i.e., from a web page)")
+            return
+          try:
+            stop = run(line)
+          except Exception as e:
+            logging.exception(f"Exception serving {line!r}")
+            print(f"Error: {e}")  # noqa: T201
+            continue
+          if stop:
+            self.server.shutdown()
+            return
+    except OSError:
+      logging.debug("A client hung up before we'd replied")
+
+
+class ControlTCPServer(ThreadingTCPServer):
+  """Serves ControlHandler on a port, which we take back straight away after a restart, as it's only on localhost."""
+
+  allow_reuse_address = True
+
+
+class Secret(NamedTuple):
+  """One of our secrets, in a template, only looked up (and the secrets file loaded) when that template's used."""
+
+  site: str
+  "Which table of the secrets file it's in"
+  key: str
+  "Which it is (i.e., username)"
+
+
 class PYTDL(Cmd):
   """
   PYTDL itself.
@@ -72,14 +1827,60 @@ class PYTDL(Cmd):
 
   intro = "Download videos iteractively or from files. Type help or ? for a list of commands."
   prompt = "PYTDL> "
-  queue: dict[str, str]
+  queue: Queue
   "Which URLs will we download from next"
-  history: set[str]
+  work: WorkQueue
+  "The queue we share with other workers, while we're one (see worker)"
+  history: History
   "Which URLs have we downloaded from (successfully) already"
+  archive: History
+  "The archive IDs (i.e., 'youtube dQw4w9WgXcQ') of what we've downloaded, which yt-dlp uses as its download_archive"
   deleted: set[str]
   "Which URLs have we deleted from the queue or history"
-  info_cache: dict[str, dict[str, Any]]
-  "URL info we can save between uses"
+  unverified: set[str]
+  "Which URLs failed to download, so need checking before we try them again"
+  info_cache: InfoCache
+  "URL info we can save between uses (persisted to cache_file)"
+  extractors: ExtractorIndex
+  "Which extractor handles a URL, without going online"
+  classified: dict[str, Classified]
+  "What we've parsed from URLs we've seen (by raw and clean URL)"
+  hosts: dict[str, str]
+  "Which site (template) each hostname in site_hosts is for"
+  cleaner: UrlCleaner
+  "How we clean URLs, compiled from url_rules and clearurls_file"
+  extracting: dict[str, Future]
+  "The URLs we're currently extracting info for, and the infodict they'll result in"
+  extracting_lock: threading.Lock
+  "Held while we check or change what we're extracting"
+  retrying: set[str]
+  "The URLs we've been told to download again, which we mustn't let yt-dlp skip as in the archive"
+  probed: dict[str, bool]
+  "Whether each URL we've had to extract flat to tell (see is_playlist) is a playlist"
+  limiter: RateLimiter
+  "How long we wait between downloads from each host"
+  playlists: Playlists
+  "How far we've expanded each playlist into the queue, and the playlist fields of their entries"
+  library: Library
+  "What's in our output directories, by video ID"
+  metrics: Metrics
+  "Where we've been spending our time (see stats)"
+  tracer: Tracer
+  "What's been happening to each URL, when is_tracing (see trace)"
+  planned: dict[str, Path]
+  "Where we've planned to save each URL (that we had the infodict of), until it's downloaded"
+  channels: dict[str, dict[str, Any]]
+  "The newest entry (and when we synced) of each channel we sync, saved alongside history_file"
+  serve_lock: threading.Lock
+  "Held while we run a command sent to us, or the background downloads take the queue, while serving"
+  wake: threading.Event
+  "Set when there's more for the background downloads to get while serving"
+  stopping: threading.Event
+  "Set once we're to stop serving, so the background downloads only finish what's running"
+  downloading: set[str]
+  "The URLs the background downloads have in line while serving"
+  arrivals: deque[str]
+  "URLs queued while serving, for the background downloads to take into line"
   local: str | Path = Path(__file__).parent / "local"
   "The path where queue.txt, config.toml, cookies/, etc., are stored"
   home: str | Path = Path.home()
@@ -103,11 +1904,23 @@ class PYTDL(Cmd):
   "Do we use ASCII only progress bars?"
   is_quiet: bool = True
   "Do we try to avoid continuous printouts?"
+  is_tracing: bool = False
+  "Do we trace what happens to each URL (saving it to trace_file)?"
   is_dated: bool = False
   "Do we use a dated output by default? (Excludes site-specific downloads i.e. twitch.tv)"
 
   naptime: int = 3
-  "Average wait-time between downloads"
+  "Average wait-time between downloads (from the same host)"
+  exit_pause: float = 2.0
+  "Seconds to leave the exit message up for (i.e., before the terminal window closes)"
+  extra_extractors: list[type["InfoExtractor"]] = []  # noqa: RUF012
+  "yt-dlp extractors to try before its own (i.e., a stand-in for a site, to test or benchmark against)"
+  workers: int = 4
+  "How many downloads we run at once (capped per host by each template's concurrency)"
+  prefetch: int = 4
+  "How many of the next URLs in line we extract info for while downloading (0 to not prefetch)"
+  watchers: int = 4
+  "How many live streams we check on at once while waiting on them"
   maxres: int = 0
   "Highest resolution for videos, if any (0 is uncapped)"
 
@@ -115,10 +1928,40 @@ class PYTDL(Cmd):
   "Where to save download queue"
   history_file: str | Path = local / "history.txt"
   "Where to save download history"
+  archive_file: str | Path = local / "archive.txt"
+  "Where to save the archive IDs of what we've downloaded (in the format of yt-dlp's --download-archive)"
+  playlists_file: str | Path = local / "playlists.json"
+  "Where to save how far we've expanded each playlist into the queue"
+  library_file: str | Path = local / "library.sqlite"
+  "Where to index what's in our output directories (by video ID)"
+  unverified_file: str | Path = local / "unverified.txt"
+  "Where to save URLs that failed to download"
+  clearurls_file: str | Path = local / "clearurls.json"
+  "ClearURLs' rules to clean URLs with, if present (from https://rules2.clearurls.xyz/data.minify.json)"
   config_file: str | Path = local / "config.toml"
   "Configuration file to load"
-  secrets: str | Path | dict[str, str | dict[str, str]] = rtoml.load(local / "secrets.toml")
-  "Where to load secrets (usernames/passwords, etc)"
+  cache_file: str | Path = local / "info.sqlite"
+  "Where to keep URL info between uses"
+  cache_size: int = 256 * 1024 * 1024
+  "How many bytes of (compressed) URL info we keep on disk"
+  cache_ttl: dict[str, int] = {"live": 30, "vod": 30 * 24 * 3600, "formats": 3600}  # noqa: RUF012
+  "How many seconds we keep URL info for livestreams, VODs, and format URLs that don't say when they expire"
+  metrics_file: str | Path = local / "metrics.prom"
+  "Where to export our metrics to (as JSON if it ends in .json, otherwise for Prometheus' textfile collector)"
+  metrics_interval: int = 0
+  "How often (in seconds) to export our metrics to metrics_file in the background, if at all"
+  trace_file: str | Path = local / "trace.json"
+  "Where to save what we've traced (in Chrome's trace-event format, for Perfetto or chrome://tracing)"
+  secrets: str | Path | dict[str, str | dict[str, str]] = local / "secrets.toml"
+  "Where to load secrets (usernames/passwords, etc) from, when a template first needs them"
+  serve_socket: str | Path = local / "pytdl.sock"
+  "Where we take commands while serving (a Unix socket, or a file saying which port on localhost we're serving on)"
+  serve_port: int = 0
+  "Which port on localhost to serve on instead of a Unix socket, if any (0 picks one where there aren't Unix sockets)"
+  work_file: str | Path = local / "work.sqlite"
+  "The queue shared between workers (see worker), which must be on a local filesystem"
+  lease: int = 300
+  "How many seconds a worker's claim on a URL lasts (it's renewed every third of that while the worker's running)"
 
   fmt_timestamp = "%(timestamp>%Y-%m-%d-%H-%M-%S,release_date>%Y-%m-%d,upload_date>%Y-%m-%d|20xx-xx-xx)s"
   fmt_date_only = "%(timestamp>%Y-%m-%d,release_date>%Y-%m-%d,upload_date>%Y-%m-%d|20xx-xx-xx)s"
@@ -176,9 +2019,10 @@ class PYTDL(Cmd):
       # "embed_metadata": True, # hopefully added in a future update
       # "trim_file_name": True, # figure out how to do this better
       # "logger": log, # TODO(alex): this
-      # "download_archive": # set/path of already downloaded files, TODO(alex): look into this
+      # "download_archive": is our archive (in archive_file), added by params
       "windowsfilenames": True,
       "consoletitle": True,  # dlp sets progress in the console title
+      "concurrency": 2,  # how many downloads we run at once from any one host (unknown to yt-dlp)
     },
     "audio": {
       "format": "bestaudio/best",
@@ -215,12 +2059,12 @@ class PYTDL(Cmd):
       "outtmpl": str(home / "Videos" / "Podcasts" / f"{fmt_title} %(webpage_url_basename)s [%(id)s].%(ext)s")
     },
     "nebula": {
-      "username": secrets["nebula"]["username"],
-      "password": secrets["nebula"]["password"],
+      "username": Secret("nebula", "username"),
+      "password": Secret("nebula", "password"),
     },
     "twitter": {
-      "username": secrets["twitter"]["username"],
-      "password": secrets["twitter"]["password"],
+      "username": Secret("twitter", "username"),
+      "password": Secret("twitter", "password"),
       "cookiefile": str(cookies / "twitter.txt"),
       "outtmpl": str(
         home / "Videos" / f"%(uploader_id,uploader|Unknown)s {fmt_timestamp} {fmt_title} [%(id)s].%(ext)s"
@@ -228,6 +2072,7 @@ class PYTDL(Cmd):
       # switch around so it used uploader_id,uploader bc display names are funky
     },
     "twitch": {
+      "concurrency": 1,
       # "wait_for_video": (3,10) # TODO(alex): how does this one work? should I use it?
       # "live_from_start": True # TODO(alex): is this how I want it to handle it?
       "fixup": "never",
@@ -236,6 +2081,7 @@ class PYTDL(Cmd):
       ),
     },
     "youtube": {
+      "concurrency": 2,
       "embed_chapters": True,
       "embed_thumbnail": True,
       "subtitleslangs": ["en", "eng", "gb", "enGB", "enUK", "enUS", "en-GB", "en-UK", "en-US"],
@@ -250,8 +2096,8 @@ class PYTDL(Cmd):
       "postprocessors": [
         {"key": "FFmpegEmbedSubtitle"},  # --embed-subs
       ],
-      "username": secrets["crunchyroll"]["username"],
-      "password": secrets["crunchyroll"]["password"],
+      "username": Secret("crunchyroll", "username"),
+      "password": Secret("crunchyroll", "password"),
       "cookiefile": str(cookies / "crunchyroll.txt"),
       "user-agent": str(cookies / "useragent.txt"),
       "outtmpl": str(
@@ -265,37 +2111,111 @@ class PYTDL(Cmd):
   }
   "The templates that control yt-dlp, such as output file templates, formats, and such settings."
 
+  site_hosts = {  # noqa: RUF012
+    "crunchyroll": ["crunchyroll.com", "www.crunchyroll.com"],
+    "nebula": ["nebula.tv", "www.nebula.tv"],
+    "twitch": ["twitch.tv", "www.twitch.tv"],
+    "twitter": ["twitter.com", "www.twitter.com", "x.com", "www.x.com"],
+    "youtube": [
+      "www.youtube.com",
+      "youtube.com",
+      "youtu.be",
+      "m.youtube.com",
+      "www.youtube-nocookie.com",
+      "piped.video",
+      "piped.projectsegfau.lt",
+    ],
+  }
+  "The hostnames of each site we have a template for"
+
+  url_rules = {  # noqa: RUF012
+    "youtube": {
+      "redirect": [
+        [r"^https?://youtu\.be/([\w-]+).*$", r"https://www.youtube.com/watch?v=\1"],
+        [r"^(https?://[^/]+)/(?:shorts|live|embed|e|v)/([\w-]+).*$", r"\1/watch?v=\2"],
+      ],
+      "host": "www.youtube.com",
+      "rename": {"vi": "v"},
+      "keep": {"v": "/", "list": "/playlist"},
+    },
+    "twitch": {
+      # clean "www.twitch.tv/videos/1234567890?filter=archives&sort=time" -> "www.twitch.tv/videos/1234567890"
+      "scope": "/videos/",
+      "keep": {},
+    },
+    "imgur": {
+      "hosts": ["imgur.artemislena.eu"],
+      "redirect": [
+        [r"^https?://imgur\.artemislena\.eu/(gallery/.*)$", r"https://imgur.com/\1"],
+        [r"^https?://imgur\.artemislena\.eu/(.*)$", r"https://i.imgur.com/\1"],
+      ],
+    },
+  }
+  """
+  How we clean URLs for each site (on site_hosts, unless given hosts), by:
+  - redirect: rewriting the whole URL, as [pattern, replacement]
+  - host: switching to a canonical hostname
+  - rename: renaming query parameters
+  - keep: keeping only these query parameters (each on paths that start with the given prefix)
+  - deny: removing query parameters that match any of these patterns
+  - scope: only cleaning the query on paths that start with this prefix
+  """
+
   ###############################
   ## Format/Template Selection ##
   ###############################
 
-  def site_params(self: Self, url: str) -> dict[str, str | bool] | None:
+  def secret(self: Self, secret: Secret) -> str | None:
+    """Look up one of our secrets, loading the secrets file (if we haven't yet) to do so."""
+    if not isinstance(self.secrets, dict):  # self.secrets must be a dict as if loaded from TOML
+      path = Path(self.secrets).expanduser()
+      self.secrets = load_toml(path) if path.is_file() else {}
+    table = self.secrets.get(secret.site)
+    return table.get(secret.key) if isinstance(table, dict) else None
+
+  def site_template(self: Self, site: str) -> dict[str, Any]:
+    """A site's template, with its secrets looked up (leaving out any we don't have)."""
+    template = self.template[site]
+    if not any(isinstance(val, Secret) for val in template.values()):
+      return template
+    resolved = {key: self.secret(val) if isinstance(val, Secret) else val for key, val in template.items()}
+    return {key: val for key, val in resolved.items() if val is not None}
+
+  def site_params(self: Self, url: str) -> dict[str, Any] | None:
     """Specific parameters for known sites, including credentials."""
-    if self.is_crunchyroll(url):
-      return self.template["crunchyroll"]
-    if self.is_nebula(url):
-      return self.template["nebula"]
-    if self.is_twitter(url):
-      return self.template["twitter"]
-    if self.is_twitch(url):
-      return self.template["twitch"]
-    if self.is_youtube(url):
-      return self.template["youtube"]
-    return None
+    site = self.classify(url).site
+    return None if site is None else self.site_template(site)
 
-  def params(self: Self, url: str, *, take_input: bool = True) -> ChainMap[str, str | bool]:
+  def params(self: Self, url: str, *, take_input: bool = True) -> ChainMap[str, Any]:  # noqa: C901, PLR0912
     """YT-DLP parameters for a given url according to our current config."""
-    maps: list[dict[str, str | bool]] = [{"quiet": self.is_quiet}]
+    maps: list[dict[str, Any]] = [
+      {
+        "quiet": self.is_quiet,
+        "progress_hooks": [self.metrics.progress_hook],
+        "postprocessor_hooks": [self.metrics.postprocessor_hook],
+      }
+    ]
+    if self.tracer.enabled:
+      maps[0]["progress_hooks"].append(self.tracer.progress_hook)
+      maps[0]["postprocessor_hooks"].append(self.tracer.postprocessor_hook)
+    if not self.is_forced and url not in self.retrying:  # so yt-dlp skips what we have before extracting formats
+      maps.append({"download_archive": self.archive})
+    if (archive_id := self.extractors.archive_id(url)) is not None:  # so the library knows which extractor it's from
+      extractor = archive_id.split(" ", 1)[0]
+      maps[0]["post_hooks"] = [lambda path: self.library.record(Path(path), extractor)]
+    classified = self.classify(url)
 
-    if (site_param := self.site_params(url)) is not None:
-      maps.append(site_param)
+    if classified.site is not None:
+      maps.append(self.site_template(classified.site))
 
     # Category specific params (shows, podcasts, playlists, etc.)
-    if self.is_show(url):
+    if "show" in classified.categories:
       maps.append(self.template["show"])
-    if self.is_podcast(url):
+    if "podcast" in classified.categories:
       maps.append(self.template["podcast"])
-    if self.is_playlist(url):
+    if url in self.playlists.entries:  # an entry we expanded from a playlist, which we know the order of already
+      maps.append(self.template["playlist"])
+    elif self.is_playlist(url):
       if take_input:
         maps.append({"playlistreverse": yesno("Should we reverse the ordering playlist order?", accept_return=False)})
       maps.append(self.template["playlist"])
@@ -313,226 +2233,688 @@ class PYTDL(Cmd):
 
     return ChainMap(*maps)
 
+  def host_key(self: Self, url: str) -> str:
+    """Which host a URL counts against when limiting concurrent downloads, by template name where we have one."""
+    if not URL.can_parse(url):
+      return ""
+    classified = self.classify(url)
+    return classified.site or classified.host
+
+  def concurrency(self: Self, host: str) -> int:
+    """How many downloads we may run at once from a host, according to its template (if any)."""
+    return max(int(self.template.get(host, {}).get("concurrency", self.template["default"]["concurrency"])), 1)
+
   ###########################
   ## URL/Video Information ##
   ###########################
 
-  def filter_info(self: Self, info: dict) -> dict[str, dict[str, Any]]:
-    """Cleans an infodict of useless fields."""
-    # TODO(alex): remove useless info (fragments, etc.) so we have less mem. footprint
-    return info
+  def filter_info(self: Self, info: dict) -> Info:
+    """Cleans an infodict of useless fields, and compacts it."""
+    entries = info["entries"] if isinstance(info.get("entries"), list) else []
+    for entry in [info, *filter(None, entries)]:
+      for key in ("automatic_captions", "heatmap", "requested_formats", "requested_subtitles"):
+        entry.pop(key, None)
+      if "formats" in entry:  # storyboards are images with thousands of fragments we'd never download
+        entry["formats"] = [fmt for fmt in entry["formats"] if fmt.get("protocol") != "mhtml"]
+    return Info(info, self.formats_expire(info))
 
   def is_url(self: Self, url: str) -> bool:
     """Is this a URL?"""
     return URL.can_parse(url)
 
-  def url_info(self: Self, url: str) -> dict[str, dict[str, Any] | Any]:
-    """Get the infodict for a URL."""
-    if url in self.info_cache and not ("is_live" in self.info_cache[url] and self.info_cache[url]["is_live"]):
-      return self.info_cache[url]
-    info: dict[str, dict[str, Any] | Any] = {}
+  def ydl(self: Self, params: Mapping[str, Any]) -> "YoutubeDL":
+    """A YoutubeDL with params, that tries our extra_extractors before yt-dlp's own."""
+    from yt_dlp import YoutubeDL  # noqa: PLC0415
+
+    if not self.extra_extractors:
+      return YoutubeDL(params)
+    ydl = YoutubeDL(params, auto_init=False)
+    for ie in self.extra_extractors:
+      ydl.add_info_extractor(ie())
+    ydl.add_default_info_extractors()
+    return ydl
+
+  def url_info(self: Self, url: str, *, fresh: bool = False) -> Info | dict[str, Any]:
+    """Get the infodict for a URL (extracting it again if it must be fresh)."""
+    if not fresh:
+      with suppress(KeyError):
+        info = self.info_cache[url]
+        self.metrics.count("cache_hits")
+        return info
+      self.metrics.count("cache_misses")
+    with self.extracting_lock:  # if it's already being extracted (i.e. prefetched), we wait on that instead
+      if extracting := url in self.extracting:
+        pending = self.extracting[url]
+      else:
+        pending = self.extracting[url] = Future()
+    if extracting:
+      return pending.result()
+    info: Info | dict[str, Any] = {}
     try:
-      with YoutubeDL(
-        params={
-          **(self.site_params(url) or self.template["default"]),
-          "simulate": True,
-          "quiet": True,
-          "no_warnings": True,
-          "consoletitle": True,
-        }
-      ) as ydl:
+      with (
+        self.metrics.timer("extract_seconds"),
+        self.tracer.span("url_info", url=url),
+        self.ydl(
+          {
+            **(self.site_params(url) or self.template["default"]),
+            "simulate": True,
+            "quiet": True,
+            "no_warnings": True,
+            "consoletitle": True,
+          }
+        ) as ydl,
+      ):
         extracted = ydl.extract_info(url, download=False)
-      if isinstance(extracted, dict):
-        info = self.filter_info(extracted)
-        self.info_cache[url] = info
+      info = self.keep_info(url, extracted)
     except Exception:
       logging.exception(f"Exception on {url}")
+    finally:
+      with self.extracting_lock:
+        del self.extracting[url]
+      pending.set_result(info)
+    return info
+
+  def keep_info(self: Self, url: str, extracted: Any) -> Info | dict[str, Any]:  # noqa: ANN401
+    """Cache what yt-dlp extracted for a URL (if it's an infodict), returning it as we'd get it from the cache."""
+    if not isinstance(extracted, dict):
+      return {}
+    extracted.setdefault("epoch", int(time()))  # when we extracted it, so we know when formats expire
+    info = self.info_cache[url] = self.filter_info(extracted)
     return info
 
+  def formats_expire(self: Self, info: dict[str, Any]) -> float:
+    """When (in seconds since the epoch) an infodict's format URLs will have likely stopped working."""
+    expiries = [
+      int(expire[1])
+      for fmt in info.get("formats") or []
+      if (expire := EXPIRES.search(fmt.get("url") or fmt.get("manifest_url") or ""))
+    ]
+    return min(expiries, default=info.get("epoch", 0) + self.cache_ttl["formats"])
+
+  def is_fresh(self: Self, info: Info | dict[str, Any]) -> bool:
+    """Can we still download from an infodict, or do we need to extract it again?"""
+    return isinstance(info, Info) and time() < info.expires - 60  # leave a minute to actually start downloading
+
+  def info_ttl(self: Self, url: str, info: Info) -> float:
+    """How long we keep a URL's info, according to cache_ttl and the site's template (which may override it)."""
+    ttl = ChainMap(self.template.get(self.host_key(url), {}).get("cache_ttl", {}), self.cache_ttl)
+    return ttl["live"] if info.get("is_live") else ttl["vod"]
+
   def is_supported(self: Self, url: str) -> bool:
-    """Check if the URL is supported."""
-    # TODO(alex): speedup, url_info is way too slow rn, probably better to cache a
-    # domain to disk so we can just say "it's on this site, so it's probably
-    # viable", perhaps as part of history, just as a quick check? or I do a
-    # better system where when we process them, if we find it's now no-longer
-    # supported (since this assumes it remains) then we kick that URL to a
-    # different track to handle it
-    info = None
-    with suppress(Exception):
-      info = self.url_info(url)
-    if info is None:
-      if not self.is_quiet:
-        print(url, "is not supported")  # noqa: T201
-      return False
-    return True
+    """
+    Check if the URL is supported.
+
+    If one of yt-dlp's extractors (or our extra_extractors) claims it, we assume it is without going online (any that
+    then fail to download are demoted to unverified), otherwise we see if yt-dlp's generic extractor can extract any
+    info for it at all.
+    """
+    if self.extractors.match(url) is not None or self.url_info(url):
+      return True
+    if not self.is_quiet:
+      print(url, "is not supported")  # noqa: T201
+    return False
 
   def is_show(self: Self, url: str) -> bool:
     """Is a URL for a show? If so, it'll have a different folder structure."""
     # info = self.url_info(url)
-    return self.is_crunchyroll(url)
+    return "show" in self.classify(url).categories
 
   def is_playlist(self: Self, url: str) -> bool:
-    """Is a URL actually a playlist? If so, it'll be downloaded differently."""
+    """
+    Is a URL actually a playlist? If so, it'll be downloaded differently.
+
+    We tell offline where we can (by its category, what its extractor returns, or its cached info), otherwise by
+    extracting it flat, which for a channel only lists its first page rather than extracting every video on it.
+    """
     with suppress(Exception):
-      info = self.url_info(url)
-      return ("playlist" in url or "youtube.com/c/" in url) or (
-        info.get("playlist") is not None
-        or info.get("playlist_title") is not None
-        or info.get("playlist_id") is not None
-      )
+      if "playlist" in self.classify(url).categories:
+        return True
+      if (single := self.extractors.is_single_video(url)) is not None:
+        return not single
+      with suppress(KeyError):
+        return self.info_cache[url].get("_type") in PLAYLIST_TYPES
+      if (playlist := self.probed.get(url)) is None:
+        with self.ydl(self.flat_params(url)) as ydl:
+          result = self.extract_flat(ydl, url)
+          playlist = result is not None and result.get("_type") in PLAYLIST_TYPES
+          if result is not None and result.get("_type", "video") == "video":  # so we needn't extract it again
+            self.keep_info(url, ydl.process_ie_result(result, download=False))
+        self.probed[url] = playlist
+      return playlist
     return False
 
-  def is_live(self: Self, url: str) -> bool:
+  def is_live(self: Self, url: str, *, fresh: bool = False) -> bool:
     """Is a video currently live? If so, we may need to wait until it's not."""
     with suppress(Exception):
-      info = self.url_info(url)
+      info = self.url_info(url, fresh=fresh)
       if "is_live" in info:
         return info["is_live"]
     return False
 
   def is_podcast(self: Self, url: str | URL) -> bool:
     """Is a URL a podcast?"""
-    url = URL(str(url))
-    return "podcast" in str(url)  # TODO(alex): this is very basic
+    return "podcast" in self.classify(url).categories
 
   def is_crunchyroll(self: Self, url: str | URL) -> bool:
     """Is a URL for Crunchyroll?"""
-    url = URL(str(url))
-    return url.hostname in {
-      "crunchyroll.com",
-      "www.crunchyroll.com",
-    }
+    return self.classify(url).site == "crunchyroll"
 
   def is_nebula(self: Self, url: str | URL) -> bool:
     """Is a URL for nebula.tv?"""
-    url = URL(str(url))
-    return url.hostname in {
-      "nebula.tv",
-      "www.nebula.tv",
-    }
+    return self.classify(url).site == "nebula"
 
   def is_twitch(self: Self, url: str | URL) -> bool:
     """Is a URL for twitch.tv?"""
-    url = URL(str(url))
-    return url.hostname in {
-      "twitch.tv",
-      "www.twitch.tv",
-    }
+    return self.classify(url).site == "twitch"
 
   def is_twitter(self: Self, url: str | URL) -> bool:
     """Is a URL for twitter.com?"""
-    url = URL(str(url))
-    return url.hostname in {
-      "twitter.com",
-      "www.twitter.com",
-      "x.com",
-      "www.x.com",
-    }
+    return self.classify(url).site == "twitter"
 
   def is_youtube(self: Self, url: str | URL) -> bool:
     """Is a URL for Youtube?"""
-    url = URL(str(url))
-    return url.hostname in {
-      "www.youtube.com",
-      "youtube.com",
-      "youtu.be",
-      "m.youtube.com",
-      "www.youtube-nocookie.com",
-      "piped.video",
-      "piped.projectsegfau.lt",
-    }
+    return self.classify(url).site == "youtube"
 
   #########
   ## I/O ##
   #########
 
-  def ensure_dir(self: Self, url: str | Path) -> None:
-    """Ensure we can place a URL's resultant file in its expected directory, recursively (ignoring templates)."""
-    # Path(self.config(url, take_input=False)["outtmpl"]).expanduser().parent.mkdir(
-    #   parents=True, exist_ok=True
-    # )  # can't use bc. template's parents
-    for parent in [
-      parent
-      for parent in Path(self.params(url, take_input=False)["outtmpl"]).expanduser().parents
-      if not parent.exists() and "%(" not in parent.name and ")s" not in parent.name
-    ][::-1]:
-      parent.mkdir()
+  def ensure_dir(self: Self, url: str) -> None:
+    """Ensure we can place a URL's resultant file in its expected directory (as planned, or up to its templates)."""
+    if (path := self.planned.pop(url, None)) is None:
+      parts = Path(self.params(url, take_input=False)["outtmpl"]).expanduser().parts[:-1]
+      path = Path(*takewhile(lambda part: "%(" not in part and ")s" not in part, parts), "_")
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+  def plan(self: Self, urls: Iterable[str]) -> dict[str, Path]:
+    """
+    Resolve where each of the URLs we've cached the infodicts of will be saved, in one go before downloading any.
+
+    Their directories are each made just the once, and those that'd be saved over one another (or whose paths are too
+    long for the filesystem) are pointed out, while we can still do something about them.
+    """
+    planned: dict[str, Path] = {}
+    with ExitStack() as stack:
+      ydls: dict[str, YoutubeDL] = {}
+      for raw_url in urls:
+        url = self.clean_url(raw_url)
+        try:
+          info = self.info_cache[url]
+        except KeyError:
+          continue
+        params = self.params(url, take_input=False)
+        naming = {key: params[key] for key in OUTTMPL_PARAMS if key in params}
+        if (ydl := ydls.get(key := json.dumps(naming, default=str, sort_keys=True))) is None:
+          ydl = ydls[key] = stack.enter_context(self.ydl({**naming, "quiet": True, "no_warnings": True}))
+        with suppress(Exception):  # i.e., a field the outtmpl needs that's missing, so we'll find out when we get it
+          planned[url] = Path(ydl.prepare_filename({**info.full, **self.playlists.entries.get(url, {})})).expanduser()
+    saved_as: dict[Path, list[str]] = {}
+    for url, path in planned.items():
+      saved_as.setdefault(path, []).append(url)
+    for path, clashing in saved_as.items():
+      if len(clashing) > 1:
+        print(f"{', '.join(clashing)} would all be saved as {path}")  # noqa: T201
+      if len(path.name.encode()) > NAME_MAX or len(bytes(path)) > PATH_MAX:
+        print(f"{clashing[0]} would be saved as {path}, which is too long a path")  # noqa: T201
+    for directory in {path.parent for path in saved_as}:
+      with suppress(OSError):
+        directory.mkdir(parents=True, exist_ok=True)
+    self.planned.update(planned)
+    return planned
 
   def readfile(self: Self, path: str | Path) -> list[str]:
     """Reads lines from a file."""
     if (f := Path(path).expanduser()).is_file():
-      return unique_list(map(self.clean_url, filter(None, map(str.strip, f.read_text(encoding="utf8").splitlines()))))
+      return unique_list(self.clean_many(filter(None, map(str.strip, f.read_text(encoding="utf8").splitlines()))))
     return []
 
   def writefile(self: Self, path: str | Path, lines: list[str]) -> None:
     """Writes lines to a file."""
-    writelines(path, unique_list(map(self.clean_url, filter(None, lines))))
+    writelines(path, unique_list(self.clean_many(filter(None, lines))))
 
   def update_history(self: Self) -> None:
-    """Update the history file."""
-    self.history |= set(self.readfile(self.history_file))
-    self.writefile(self.history_file, sorted(self.history))
+    """Update the history file (appending what's new to it, and taking in what's been appended to it elsewhere)."""
+    self.history.sync()
+    self.archive.sync()
+
+  def library_roots(self: Self) -> list[Path]:
+    """The directories our templates download to (up to where their outtmpls have fields), outermost only."""
+    roots: list[Path] = []
+    for template in self.template.values():
+      outtmpls = template.get("outtmpl") or {}
+      for outtmpl in outtmpls.values() if isinstance(outtmpls, dict) else [outtmpls]:
+        parts = Path(outtmpl).expanduser().parts[:-1]
+        roots.append(Path(*takewhile(lambda part: "%(" not in part, parts)))
+    outermost: list[Path] = []
+    for root in sorted(set(roots), key=lambda root: len(root.parts)):
+      if root.parts and not any(root.is_relative_to(outer) for outer in outermost):
+        outermost.append(root)
+    return outermost
+
+  def on_disk(self: Self, url: str) -> Path | None:
+    """Where we already have a URL's video in our output directories, if we do (by archive ID, worked out offline)."""
+    if (archive_id := self.extractors.archive_id(url)) is None:
+      return None
+    extractor, vid = archive_id.split(" ", 1)
+    return self.library.find(vid, extractor)
+
+  def sync_file(self: Self) -> Path:
+    """Where we save what we last saw of each channel we sync, which is alongside history_file."""
+    return Path(self.history_file).expanduser().with_name("sync.json")
+
+  def is_done(self: Self, url: str) -> bool:
+    """Have we downloaded this URL already, or the same content from any other URL (by its archive ID)?"""
+    return url in self.history or (
+      (archive_id := self.extractors.archive_id(url)) is not None and archive_id in self.archive
+    )
+
+  def classify(self: Self, url: str | URL) -> Classified:
+    """Parse a URL (once, as we remember it) to find its site, categories, canonical host, and clean form."""
+    if (classified := self.classified.get(key := str(url))) is not None:
+      return classified
+    with self.tracer.span("classify", url=key):
+      if not self.hosts:
+        self.hosts = {host: site for site, hosts in self.site_hosts.items() if site in self.template for host in hosts}
+      parsed = URL(key)
+      site = self.hosts.get(parsed.hostname)
+      parsed = self.cleaner.clean_parsed(parsed)
+      cleaned = parsed.href
+      categories = set()
+      if site == "crunchyroll":
+        categories.add("show")
+      if "podcast" in cleaned:  # TODO(alex): this is very basic
+        categories.add("podcast")
+      if "playlist" in cleaned or "youtube.com/c/" in cleaned:
+        categories.add("playlist")
+      classified = Classified(cleaned, parsed.hostname, site, frozenset(categories))
+      if len(self.classified) > 1 << 16:  # so a long-running PYTDL doesn't remember everything forever
+        self.classified.clear()
+    self.classified[key] = self.classified[cleaned] = classified
+    return classified
 
-  def clean_url(self: Self, url: str | URL):  # noqa: ANN201, C901, D102
-    # TODO(alex): https://github.com/ClearURLs/Addon
+  def clean_url(self: Self, url: str | URL):  # noqa: ANN201, D102
     if isinstance(url, URL) or URL.can_parse(url):
-      url = URL(str(url))
-      if self.is_youtube(url):
-        if url.hostname in {"youtu.be"}:
-          search = URLSearchParams(f"v={url.pathname.removeprefix('/')}")
-          url.search = str(search)
-          url.pathname = "/watch"
-        url.hostname = "www.youtube.com"
-        if not any(url.pathname.startswith(pn) for pn in ("/watch", "/playlist", "/@", "/channel/", "/c/", "/user/")):
-          url.pathname = "/watch"
-          vid = url.pathname.split("/")[-1]
-          url.search = f"v={vid}"
-        if url.search:
-          search = URLSearchParams(url.search)
-          if search.has("vi") and not search.has("v"):
-            search.set("v", search.get("vi"))
-          for key in search.keys():
-            if key not in {"v", "list"}:
-              search.delete(key)
-          if url.pathname != "/playlist":
-            search.delete("list")
-          url.search = str(search)
-      elif self.is_twitch(url):
-        # clean "www.twitch.tv/videos/1234567890?filter=archives&sort=time" -> "www.twitch.tv/videos/1234567890"
-        if url.search and url.pathname.startswith("/videos/"):
-          url.search = ""
-      elif url.hostname in {"imgur.artemislena.eu"}:
-        if "/gallery/" in url.pathname:
-          url.hostname = "imgur.com"
-        else:
-          url.hostname = "i.imgur.com"
-      url = url.href
+      url = self.classify(url).url
     else:
       print(
         f"Was unable to parse {url!r} as a URL. If you believe this is a bug, bring it up with the WHATWG URL spec."
       )
     return url
 
-  def download(self: Self, raw_url: str) -> None:
-    """Actually download something."""
-    url = self.clean_url(raw_url)
-    with YoutubeDL(self.params(url)) as ydl:
-      # ydl.evaluate_outtmpl(ydl.params["outtmpl"], ydl.extract_info(url)) # TODO(alex): for better ensure_dir?
-      self.ensure_dir(url)
+  def clean_many(self: Self, urls: Iterable[str]) -> Iterator[str]:
+    """Clean lots of URLs as we go, without remembering them as classify (and so clean_url) does."""
+    clean = self.cleaner.clean
+    for url in urls:
+      yield clean(url)
+
+  def download(self: Self, raw_url: str) -> bool:  # noqa: C901
+    """Actually download something, returning whether its host throttled us (so we should try again later)."""
+    from yt_dlp.utils import DownloadError  # noqa: PLC0415
+
+    with self.tracer.span("clean", url=raw_url):
+      url = self.clean_url(raw_url)
+    host, failure = self.host_key(url), ""
+    playlist = self.playlists.entries.get(url, {})  # i.e., playlist_index, if we expanded it from a playlist
+    if (info := self.url_info(url)) and not self.is_fresh(info):
+      info = self.url_info(url, fresh=True)
+    with (
+      self.ydl(self.params(url)) as ydl,
+      self.metrics.timer("download_seconds"),
+      self.tracer.span("download", url=url),
+    ):
+      with self.metrics.timer("ensure_dir_seconds"), self.tracer.span("ensure_dir", url=url):
+        self.ensure_dir(url)
       try:
-        r = ydl.download(url)
+        # what fails raises DownloadError (or, if a template has yt-dlp ignore errors, extracts as None)
+        if info:  # we reuse the infodict we already extracted, rather than have yt-dlp extract it all again
+          try:
+            got = ydl.process_ie_result({**info.full, **playlist}, download=True)
+          except DownloadError as err:  # i.e., the formats expired early, so we start over the usual way
+            ydl.report_warning(f"Could not download {url} from its cached info ({err}), extracting it again")
+            got = ydl.extract_info(url, extra_info=playlist)
+          r = int(got is None)
+        elif playlist:
+          r = int(ydl.extract_info(url, extra_info=playlist) is None)
+        else:
+          r = ydl.download(url)
       except KeyboardInterrupt:
         raise
       except SystemExit:
         raise
       except Exception as err:  # noqa: BLE001
         print(err)  # noqa: T201
-        r = 1
-    if r:
-      if not self.is_idle and yesno(f"Did {url} download properly?"):
-        self.history.add(raw_url)
+        r, failure = 1, str(err)
+    if r and (THROTTLED.search(failure) or (FORBIDDEN.search(failure) and self.limiter.forbidden(host, url))):
+      self.metrics.count(f'throttled{{host="{host}"}}')
+      self.limiter.throttled(host)
+      return True
+    if r and (self.is_idle or not yesno(f"Did {url} download properly?")):
+      self.metrics.count(f'failures{{host="{host}"}}')
+      self.demote(raw_url)
     else:
-      self.history.add(raw_url)
+      self.limiter.succeeded(host)
+      with self.tracer.span("history", url=url):
+        self.history.add(raw_url)
+        if (archive_id := self.extractors.archive_id(url)) is not None:
+          self.archive.add(archive_id)
+        self.queue.complete(raw_url)
+        self.playlists.done(url)
+    return False
+
+  def demote(self: Self, url: str) -> None:
+    """Move a URL that failed to download from the queue to unverified, until we check it with verify."""
+    if url not in self.unverified:
+      self.unverified.add(url)
+      writelines(Path(self.unverified_file).expanduser(), url, mode="a")
+    self.queue.pop(url, None)
+
+  def fetch(
+    self: Self, url: str, i: int, n: int, found: Callable[[str], Any] | None = None
+  ) -> Literal["done", "live", "skip", "throttled", "expanded"]:
+    """
+    Download the i'th of n URLs if it's due, otherwise say whether it was skipped, is still live, or throttled.
+
+    Playlists are instead expanded into the queue, calling found with each new entry as it's queued.
+    """
+    with self.tracer.span("fetch", url=url):
+      retry, supported = False, self.is_supported(url)
+      if (
+        supported
+        and (
+          not self.is_done(url) or self.is_forced or (retry := not self.is_idle and yesno(f"Try download {url} again?"))
+        )
+      ) or "playlist" in url:
+        set_title(f"[{i}/{n}] {url}")
+        if self.is_playlist(url):
+          try:
+            for entry in self.expand(url):
+              self.queue[entry] = entry
+              if found is not None:
+                found(entry)
+          except Exception:
+            logging.exception(f"Exception expanding {url}")
+            return "skip"
+          if self.playlists.progress(url)["complete"]:
+            self.history.add(url)
+            self.queue.complete(url)
+          return "expanded"
+        with self.tracer.span("live check", url=url):
+          live = self.is_live(url)
+        if live and (self.is_idle or yesno("Currently live, shall we skip and try again later?")):
+          return "live"
+        if retry:  # so yt-dlp's download_archive doesn't skip it after all
+          self.retrying.add(url)
+        try:
+          return "throttled" if self.download(url) else "done"
+        finally:
+          self.retrying.discard(url)
+      if not supported and not self.is_done(url):
+        self.demote(url)
+      return "skip"
+
+  def flat_params(self: Self, url: str) -> dict[str, Any]:
+    """The params to extract a URL flat with, listing a playlist's entries (lazily, page by page) but not their info."""
+    return {
+      **(self.site_params(url) or self.template["default"]),
+      "extract_flat": "in_playlist",
+      "lazy_playlist": True,
+      "simulate": True,
+      "quiet": True,
+      "no_warnings": True,
+    }
+
+  def extract_flat(self: Self, ydl: "YoutubeDL", url: str) -> dict[str, Any] | None:
+    """What a URL extracts to with flat_params, following where it points (i.e., a channel to its videos tab)."""
+    result = ydl.extract_info(url, download=False, process=False)
+    for _ in range(3):
+      if not isinstance(result, dict) or result.get("_type") != "url":
+        break
+      result = ydl.extract_info(result["url"], ie_key=result.get("ie_key"), download=False, process=False)
+    return result if isinstance(result, dict) else None
+
+  def prefetch_info(self: Self, url: str) -> None:
+    """Extract a URL's info before we get to it, unless it's a playlist, which we only list (see expand)."""
+    if not self.is_playlist(url):
+      self.url_info(url)
+
+  def listing(self: Self, url: str, start: int = 0) -> Iterator[Entry]:
+    """The entries of a playlist (or channel) from the start'th on, extracted flat and lazily (page by page)."""
+    from yt_dlp.utils import make_archive_id  # noqa: PLC0415
+
+    with self.ydl(self.flat_params(url)) as ydl:
+      result = self.extract_flat(ydl, url)
+      if result is None or result.get("entries") is None:
+        return
+      title = result.get("title") or result.get("id")
+      for index, entry in enumerate(page_through(result["entries"], start), start + 1):
+        if not entry or not URL.can_parse(entry_url := entry.get("webpage_url") or entry.get("url") or ""):
+          yield Entry(index, None, None, None, {})
+          continue
+        yield Entry(
+          index,
+          self.clean_url(entry_url),
+          make_archive_id(entry["ie_key"], entry["id"]) if entry.get("ie_key") and entry.get("id") else None,
+          entry.get("upload_date") or entry.get("timestamp"),
+          {"playlist": title, "playlist_title": title, "playlist_id": result.get("id"), "playlist_index": index},
+        )
+
+  def is_known(self: Self, entry: Entry) -> bool:
+    """Have we already queued or downloaded a playlist's entry (unless we're forcing downloads)?"""
+    return entry.url in self.queue or (
+      not self.is_forced and (entry.url in self.history or entry.archive_id in self.archive)
+    )
+
+  def expand(self: Self, url: str) -> Iterator[str]:
+    """
+    Expand a playlist (or channel) into the URLs of its entries, lazily (page by page), skipping what we've got.
+
+    We pick up from the last entry we got to, unless we got to the end, in which case we look again from the start.
+    """
+    progress = self.playlists.progress(url)
+    if progress["complete"]:
+      progress.update(fetched=0, complete=False)
+    for entry in self.listing(url, progress["fetched"]):
+      progress["fetched"] = entry.index
+      if entry.url is not None and not self.is_known(entry):
+        self.playlists.add(entry.url, entry.fields)
+        yield entry.url
+    progress["complete"] = True
+    self.playlists.save()
+
+  def sync_channel(self: Self, url: str) -> list[str]:
+    """
+    The entries of a channel (or playlist) that are new since we last synced it, newest first.
+
+    We stop at the first entry we've seen before, queued, or downloaded (so yt-dlp's break_on_existing, but for the
+    queue too), so a channel with nothing new costs us its first page.
+    """
+    seen, newest, new = self.channels.get(url, {}), None, []
+    for entry in self.listing(url):
+      if entry.url is None:
+        continue
+      if newest is None:
+        newest = {"id": entry.archive_id or entry.url, "date": entry.date}
+      if (entry.archive_id or entry.url) == seen.get("id") or self.is_known(entry):
+        break
+      self.playlists.add(entry.url, entry.fields)
+      new.append(entry.url)
+    self.channels[url] = {**(newest or seen), "synced": int(time())}
+    return new
+
+  def run_downloads(  # noqa: C901, PLR0912, PLR0915
+    self: Self, urls: list[str], still_live: list[str], found: deque[str] | None = None
+  ) -> None:
+    """
+    Fetch URLs on a pool of workers, keeping to each host's concurrency and rate limit.
+
+    URLs from the same host keep their relative order, and any that are still live are added to still_live.
+    Those whose host throttled us are tried again (after it's backed off) a few times before we give up on them,
+    and the entries of playlists (or any appended to found meanwhile) join the line as they're expanded.
+    Any queued for the same content (by archive ID) as another queued URL are first dropped from the queue, and any
+    whose video we already have on disk are skipped (unless we're after their audio or captions, which that isn't).
+    Once we're to stop serving, only those running are finished.
+    """
+    from tqdm import tqdm  # noqa: PLC0415
+
+    queued = {url: first for url in urls if url in self.queue and (first := self.queue.find(url)) not in {None, url}}
+    for url, first in queued.items():
+      logging.debug(f"Not getting {url} as the same content's queued as {first}")
+      del self.queue[url]
+    urls = [url for url in urls if url not in queued]
+    if not (self.is_forced or self.is_audio or self.is_captions):
+      self.library.freshen(self.library_roots())
+      have = {url: path for url in urls if (path := self.on_disk(url)) is not None}
+      for url, path in have.items():
+        print(f"Already have {url} at {path}")  # noqa: T201
+        self.history.add(url)
+        self.queue.complete(url)
+      urls = [url for url in urls if url not in have]
+      if not urls:
+        return
+    self.plan(urls)
+    waiting: dict[str, deque[tuple[int, str]]] = {}
+    for i, url in enumerate(urls, 1):
+      waiting.setdefault(self.host_key(url), deque()).append((i, url))
+    found = deque() if found is None else found  # appended to by the workers expanding playlists
+    lined = set(urls)  # as what's found may already be in line
+    total = len(urls)
+    running: dict[Future, tuple[str, int, str]] = {}
+    active: Counter[str] = Counter()
+    throttled: Counter[str] = Counter()
+    workers = max(self.workers, 1) if self.is_idle else 1  # we can't have several workers prompting at once
+    with (
+      ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pytdl") as pool,
+      Prefetcher(self.prefetch_info, urls, self.prefetch) as prefetcher,
+      tqdm(total=len(urls), ascii=self.is_ascii, ncols=100, unit="vid") as progress,
+    ):
+      try:
+        while waiting or running or found:
+          if self.stopping.is_set():
+            waiting.clear()
+            found.clear()
+          while found:
+            if (url := found.popleft()) in lined:
+              continue
+            lined.add(url)
+            total += 1
+            waiting.setdefault(self.host_key(url), deque()).append((total, url))
+            prefetcher.add(url)
+            progress.total = total
+            progress.refresh()
+          naps = []
+          for host in list(waiting):
+            queued = waiting[host]
+            while queued and len(running) < workers and active[host] < (burst := self.concurrency(host)):
+              if (nap := self.limiter.delay(host, burst)) > 0:
+                naps.append(nap)
+                break
+              i, url = queued.popleft()
+              running[pool.submit(self.fetch, url, i, total, found.append)] = (host, i, url)
+              self.limiter.take(host, burst)
+              active[host] += 1
+              prefetcher.take(url)
+            if not queued:
+              del waiting[host]
+          prefetcher.top_up()
+          if not running:
+            self.metrics.observe("nap_seconds", nap := min(naps, default=0))
+            sleep(nap)
+            continue
+          done, _ = wait(running, timeout=min(naps, default=1.0), return_when=FIRST_COMPLETED)  # or we've found more
+          for future in done:
+            host, i, url = running.pop(future)
+            active[host] -= 1
+            match future.result():
+              case "live":
+                still_live.append(url)
+                self.limiter.refund(host, self.concurrency(host))
+              case "skip":
+                self.limiter.refund(host, self.concurrency(host))
+              case "throttled" if throttled[url] < 3:  # noqa: PLR2004
+                throttled[url] += 1
+                waiting.setdefault(host, deque()).appendleft((i, url))
+                continue
+              case "throttled":
+                self.demote(url)
+            progress.update()
+      except KeyboardInterrupt:
+        if running:
+          print(f"Waiting on {len(running)} running download{'s' * (len(running) != 1)} to finish")  # noqa: T201
+        raise
+      finally:
+        if self.tracer.enabled:
+          self.tracer.save(Path(self.trace_file).expanduser())
+
+  def serve_command(self: Self, line: str) -> bool:
+    """
+    Run a command sent to us while serving (as onecmd would), returning whether it's to stop serving.
+
+    Only the commands in SERVED are run, and get and getall only queue their URLs, for the background downloads.
+    """
+    cmd, arg = served(line)
+    with self.serve_lock:
+      match cmd:
+        case "serve" if arg == "stop":
+          print("Stopping once the running downloads finish")  # noqa: T201
+          return True
+        case "serve":
+          print(f"Already serving on {self.serve_socket}")  # noqa: T201
+        case "get" if not arg.split():
+          print("No videos to download")  # noqa: T201
+          return False
+        case "get":
+          self.do_add(f"front {arg}")
+          print(f"Getting {len(arg.split())} URL{'s' * (len(arg.split()) != 1)} next")  # noqa: T201
+        case "getall":
+          if arg:
+            self.do_load(arg)
+          print(f"Getting the {len(self.queue)} URLs in the queue")  # noqa: T201
+        case _ if cmd in SERVED:
+          self.onecmd(f"{cmd} {arg}")
+        case _:
+          print(f"Only {', '.join(sorted(SERVED))} are taken while serving, not {cmd}")  # noqa: T201
+          return False
+      arrived = [url for url in self.queue if url not in self.downloading]
+      self.downloading.update(arrived)
+      self.arrivals.extend(arrived)
+    self.wake.set()
+    return False
+
+  def serve_downloads(self: Self, recheck: float = 60) -> None:
+    """Get the queue as it's added to, until we stop serving, trying those still live again every recheck seconds."""
+    live: dict[str, float] = {}  # when to try each again
+    while not self.stopping.is_set():
+      self.wake.clear()
+      now = monotonic()
+      with self.serve_lock:
+        urls = [url for url in self.queue if live.get(url, 0) <= now]
+        self.downloading = set(urls)
+        self.arrivals.clear()
+      if urls:
+        still_live: list[str] = []
+        try:
+          self.run_downloads(urls, still_live, self.arrivals)
+        except Exception:
+          logging.exception("Exception getting the queue while serving")
+        self.do_save()
+        live = {url: due for url, due in live.items() if url not in urls} | dict.fromkeys(
+          still_live, monotonic() + recheck
+        )
+      live = {url: due for url, due in live.items() if url in self.queue}
+      self.wake.wait(max(min(live.values()) - monotonic(), 0) if live else None)
+
+  def settle(self: Self, owner: str, claimed: list[str], still_live: list[str]) -> None:
+    """Tell the other workers how the URLs we claimed went, once we've tried them."""
+    self.history.flush()  # so they know what we've got
+    for url in claimed:
+      if url in still_live:
+        self.work.release(owner, url, time() + 60, tried=False)
+      elif self.is_done(url):
+        self.work.complete(url)
+      elif url in self.unverified:
+        self.work.fail(url)
+      else:  # i.e., it was throttled, or a playlist we've not expanded all of
+        self.work.release(owner, url, time() + self.naptime)
 
   def from_index(self: Self, i: str) -> str | None:
     """Gets the i'th URL in the queue."""
@@ -551,7 +2933,7 @@ class PYTDL(Cmd):
     def yesify(b: bool, /) -> Literal["Yes", "No"]:  # noqa: FBT001
       return "Yes" if b else "No"
 
-    print("Version:", YTDLPVersion)  # noqa: T201
+    print("Version:", ytdlp_version())  # noqa: T201
     print("Mode:", "Idle" if self.is_idle else "Interactive")  # noqa: T201
     print("ASCII:", yesify(self.is_ascii))  # noqa: T201
     print("Quiet:", yesify(self.is_quiet))  # noqa: T201
@@ -568,7 +2950,7 @@ class PYTDL(Cmd):
     config | config [path]
     """
     arg = Path(arg).expanduser()
-    config = rtoml.load(arg if arg.is_file() else Path(self.config_file).expanduser())
+    config = load_toml(arg if arg.is_file() else Path(self.config_file).expanduser())
 
     assert self.__annotations__ == self.__class__.__annotations__  # no shennanigans... for now  # noqa: S101
     for key, t in self.__annotations__.items():  # initialise annotated types
@@ -589,7 +2971,25 @@ class PYTDL(Cmd):
           setattr(self, key, val)
 
     # Some fields must be Paths # TODO(alex): these don't propagate!
-    for field in ("home", "local", "cookies", "queue_file", "history_file", "config_file", "secrets"):
+    for field in (
+      "home",
+      "local",
+      "cookies",
+      "queue_file",
+      "history_file",
+      "archive_file",
+      "playlists_file",
+      "library_file",
+      "unverified_file",
+      "clearurls_file",
+      "config_file",
+      "cache_file",
+      "metrics_file",
+      "trace_file",
+      "secrets",
+      "serve_socket",
+      "work_file",
+    ):
       match getattr(self, field):
         case str(is_str):
           setattr(self, field, Path(is_str))
@@ -598,17 +2998,22 @@ class PYTDL(Cmd):
         case _:
           raise TypeError
 
-    # self.secrets must be a dict as if loaded from TOML
-    match self.secrets:
-      case str(secrets_file):
-        self.secrets = rtoml.load(Path(secrets_file))
-      case Path() as secrets_file:
-        self.secrets = rtoml.load(Path(secrets_file))
-      case dict(secrets):
-        pass
-      case _:
-        raise TypeError
-
+    self.hosts.clear()  # as the templates or their hosts may have changed
+    self.classified.clear()
+    self.cleaner.load(self.url_rules, self.site_hosts, Path(self.clearurls_file).expanduser())
+    self.info_cache.open(Path(self.cache_file).expanduser(), self.info_ttl, self.cache_size)
+    self.history.open(Path(self.history_file).expanduser())
+    self.archive.open(Path(self.archive_file).expanduser())
+    self.playlists.open(Path(self.playlists_file).expanduser())
+    self.library.open(Path(self.library_file).expanduser())
+    with suppress(OSError, ValueError):
+      self.channels = json.loads(self.sync_file().read_text(encoding="utf8"))
+    self.queue.open(Path(self.queue_file).expanduser(), self.clean_many, self.extractors.archive_id)
+    self.extractors.path = Path(self.local).expanduser() / "extractors.json"
+    self.extractors.extra = self.extra_extractors
+    self.limiter.naptime = max(self.naptime, 0)
+    self.metrics.export_every(Path(self.metrics_file).expanduser(), self.metrics_interval)
+    self.tracer.enabled = self.is_tracing
     logging.config.dictConfig(self.log_config)
 
   def do_audio(self: Self, _arg: str = "") -> None:
@@ -626,6 +3031,24 @@ class PYTDL(Cmd):
     self.is_quiet = not self.is_quiet
     print("Shh" if self.is_quiet else "BOO!")  # noqa: T201
 
+  def do_trace(self: Self, arg: str = "") -> None:
+    """
+    Toggle whether PYTDL traces what happens to each URL, save the trace to trace_file (or a given path), or clear it:
+
+    >>> trace | trace save [path] | trace clear
+    """  # noqa: D415
+    match arg.split(maxsplit=1):
+      case []:
+        self.is_tracing = self.tracer.enabled = not self.is_tracing
+        print(f"Tracing to {self.trace_file}" if self.is_tracing else "Not tracing")  # noqa: T201
+      case ["save", *path]:
+        path = Path(path[0] if path else self.trace_file).expanduser()
+        print(f"Saved {self.tracer.save(path)} spans to {path}")  # noqa: T201
+      case ["clear"]:
+        self.tracer.events.clear()
+      case _:
+        print(f"Unknown trace command {arg!r}, expected save or clear")  # noqa: T201
+
   def do_date(self: Self, _arg: str = "") -> None:
     """Toggle whether PYTDL dates videos by default."""
     self.is_dated = not self.is_dated
@@ -642,11 +3065,18 @@ class PYTDL(Cmd):
     print("Idling" if self.is_idle else "Interactive")  # noqa: T201
 
   def do_naptime(self: Self, arg: str) -> None:
-    """How long do we sleep between downloads (on average)?"""
+    """
+    How long do we sleep between downloads from the same host (on average), and how long for each host right now?
+
+    >>> naptime | naptime [seconds]
+    """
     if arg.isdecimal():
       self.naptime = int(arg)
     self.naptime = max(self.naptime, 0)
+    self.limiter.naptime = self.naptime
     print(f"We sleep for {self.naptime}s on average.")  # noqa: T201
+    for host, (interval, backoff) in self.limiter.rates().items():
+      print(f"{host}: {interval:g}s per download{f', backing off for {backoff:.0f}s' if backoff else ''}")  # noqa: T201
 
   def do_res(self: Self, arg: str) -> None:
     """
@@ -710,7 +3140,49 @@ class PYTDL(Cmd):
     """  # noqa: D415
     for url in urls.split():
       info = self.url_info(url)
-      (self.local / "info" / f"{info.get('id') or 'dump'}.json").write_text(json.dumps(info))
+      (dumps := Path(self.local).expanduser() / "info").mkdir(parents=True, exist_ok=True)
+      full = info.full if isinstance(info, Info) else info
+      (dumps / f"{info.get('id') or 'dump'}.json").write_text(json.dumps(full), encoding="utf8")
+
+  def do_cache(self: Self, arg: str = "") -> None:
+    """
+    Show how much URL info we've cached, prune what's expired or over cache_size, or clear it entirely:
+
+    >>> cache | cache stats | cache prune | cache clear
+    """  # noqa: D415
+    match arg.strip():
+      case "" | "stats":
+        for key, val in self.info_cache.stats().items():
+          print(f"{key.capitalize()}: {val}")  # noqa: T201
+      case "prune":
+        print(f"Pruned {self.info_cache.prune()} entries")  # noqa: T201
+      case "clear":
+        if yesno("Do you want to clear all cached URL info?") and yesno("Are you sure about this?"):
+          self.info_cache.clear()
+      case _:
+        print(f"Unknown cache command {arg!r}, expected stats, prune, or clear")  # noqa: T201
+
+  def do_stats(self: Self, arg: str = "") -> None:
+    """
+    Show where we've been spending our time, export it to metrics_file (or a given path), or clear it:
+
+    >>> stats | stats export [path] | stats clear
+    """  # noqa: D415
+    match arg.split(maxsplit=1):
+      case []:
+        counters, _ = self.metrics.snapshot()
+        for key, val in counters.items():
+          print(f"{key}: {val:,.0f}")  # noqa: T201
+        if lookups := counters.get("cache_hits", 0) + counters.get("cache_misses", 0):
+          print(f"cache hit rate: {counters.get('cache_hits', 0) / lookups:.1%}")  # noqa: T201
+        for name, summary in self.metrics.summary().items():
+          print(f"{name}: " + ", ".join(f"{key} {val:,.3f}" for key, val in summary.items()))  # noqa: T201
+      case ["export", *path]:
+        self.metrics.export(Path(path[0] if path else self.metrics_file).expanduser())
+      case ["clear"]:
+        self.metrics.clear()
+      case _:
+        print(f"Unknown stats command {arg!r}, expected export or clear")  # noqa: T201
 
   def do_echo(self: Self, arg: str) -> None:
     """Echoes all URLs as it would try to download them (cleaned up and with potential fixes for common typos etc)."""
@@ -727,21 +3199,19 @@ class PYTDL(Cmd):
 
     >>> add [url] | [url] | [url] [url] [url] | add front [url] [url] [url]
     """  # noqa: D415
-    temp = None
-    if len(arg):
-      if len(q := arg.split(maxsplit=1)) > 1 and q[0] == "front":
-        arg = q[1]
-        temp = dict(self.queue)
-        self.queue = {}
-      # TODO(alex): better valid URL check, fix common input errors (https://a.bchttps://c.de, missing http, etc)
-      for url in arg.split():
-        if len(url) > 4 and (allow_unsupported or self.is_supported(url)):  # noqa: PLR2004
-          url = self.clean_url(url)
-          self.queue[url] = url
-    if temp:
-      self.queue |= temp
-    for url in self.queue:
-      self.deleted.discard(url)  # If we add it back, it should stay, unless we delete again, etc.
+    front = False
+    if len(q := arg.split(maxsplit=1)) > 1 and q[0] == "front":
+      arg, front = q[1], True
+    # TODO(alex): better valid URL check, fix common input errors (https://a.bchttps://c.de, missing http, etc)
+    # those for content that's already queued (by archive ID) are dropped once we get them, as working that out here
+    # would have adding a URL import all of yt-dlp
+    urls = {
+      url: url
+      for url in map(self.clean_url, arg.split())
+      if len(url) > 4 and (allow_unsupported or self.is_supported(url))  # noqa: PLR2004
+    }
+    self.queue.extend(urls, front=front)
+    self.deleted.difference_update(urls)  # If we add it back, it should stay, unless we delete again, etc.
 
   def do_del(self: Self, arg: str) -> None:
     """
@@ -757,6 +3227,8 @@ class PYTDL(Cmd):
           del self.info_cache[url]
       if len(url) and url in self.history and yesno(f"Do you want to remove {url} from the history?"):
         self.history -= {url}
+        if (archive_id := self.extractors.archive_id(url)) is not None:
+          self.archive.discard(archive_id)
         if url in self.info_cache:
           del self.info_cache[url]
 
@@ -768,7 +3240,8 @@ class PYTDL(Cmd):
     """  # noqa: D415
     if isinstance(arg, str) and len(arg) == 0:
       arg = self.queue_file
-    self.queue = {k: v for k, v in self.queue.items() if k not in self.history}
+    for url in [url for url in self.queue if url in self.history]:
+      self.queue.complete(url)
     if len(self.queue):
       print(f"There are {len(self.queue)} urls in the queue that have not been downloaded.")  # noqa: T201
     if yesno(f"Do you want to remove all {len(self.queue)} urls from the queue?") and yesno("Are you sure about this?"):
@@ -776,7 +3249,11 @@ class PYTDL(Cmd):
     if yesno(f"Do you want to remove all {len(self.readfile(arg))} urls the queue file?") and yesno(
       "Are you sure about this?"
     ):
-      self.writefile(arg, [])
+      if Path(arg).expanduser() == self.queue.path:
+        self.queue.clear()
+        self.queue.compact()
+      else:
+        self.writefile(arg, [])
     self.do_forget()
 
   def do_forget(self: Self, arg: str | Path = "") -> None:
@@ -789,9 +3266,39 @@ class PYTDL(Cmd):
       arg = self.history_file
     if yesno("Do you want to forget the history of dl'd URLs?") and yesno("Are you sure about this?"):
       self.history.clear()
+      self.archive.clear()
       self.info_cache.clear()
     if yesno("Do you want to forget the history file?") and yesno("Are you sure about this?"):
-      self.writefile(arg, [])
+      if Path(arg).expanduser() == self.history.path:
+        self.history.clear()
+        self.history.compact()
+        self.archive.clear()
+        self.archive.compact()
+      else:
+        self.writefile(arg, [])
+
+  def do_history(self: Self, arg: str = "") -> None:
+    """
+    Show the size of the history, compact its file, or import/export it from/to another history file:
+
+    >>> history | history compact | history import [file] | history export [file]
+    """  # noqa: D415
+    match arg.split(maxsplit=1):
+      case []:
+        print(f"{len(self.history)} URLs in the history, over {self.history.lines} lines of {self.history.path}")  # noqa: T201
+      case ["compact"]:
+        self.history.compact()
+      case ["import", path]:
+        pre = len(self.history)
+        self.history.update(self.readfile(path))
+        self.history.sync()
+        print(f"Imported {len(self.history) - pre} URLs from {path}")  # noqa: T201
+      case ["export", path]:
+        self.history.flush()
+        self.writefile(path, sorted(self.history))
+        print(f"Exported {len(self.history)} URLs to {path}")  # noqa: T201
+      case _:
+        print(f"Unknown history command {arg!r}, expected compact, import, or export")  # noqa: T201
 
   def do_get(self: Self, arg: str | list[str]) -> None:
     """
@@ -805,19 +3312,7 @@ class PYTDL(Cmd):
       set_title(f"downloading {len(urls)} URL{'s' * (len(urls) != 1)}")
       print(f"Getting {len(urls)} URL{'s' * (len(urls) != 1)}")  # noqa: T201
       try:
-        for i, url in tqdm(enumerate(urls, 1), ascii=self.is_ascii, ncols=100, unit="vid"):
-          if (
-            self.is_supported(url)
-            and (
-              url not in self.history or self.is_forced or (not self.is_idle and yesno(f"Try download {url} again?"))
-            )
-          ) or "playlist" in url:
-            set_title(f"[{i}/{len(urls)}] {url}")
-            if self.is_live(url) and (self.is_idle or yesno("Currently live, shall we skip and try again later?")):
-              still_live.append(url)
-              continue
-            self.download(url)
-            sleep(randint(0, self.naptime * 2) + random())
+        self.run_downloads(urls, still_live)
       except KeyboardInterrupt:
         print()  # noqa: T201
         print("Stopped by user")  # noqa: T201
@@ -867,48 +3362,243 @@ class PYTDL(Cmd):
     >>> save [file] | save- [file] | # [file] | #- [file]
     """  # noqa: D415
     set_title("saving")
-    path, queue, set_history = arg, dict(self.queue), True
+    path, set_history = arg, True
     if path.startswith("-"):
       path, set_history = path.removeprefix("-"), False
-    if len(path) == 0:
-      path = self.queue_file
-    if len(lines := self.readfile(path)):
-      queue |= {line: line for line in lines}
-    if len(queue):
-      self.writefile(path, [url for url in queue if url not in self.history and url not in self.deleted])
+    for url in [url for url in self.queue if url in self.history or url in self.unverified]:
+      self.queue.complete(url)
+    if len(path) == 0 or Path(path).expanduser() == self.queue.path:
+      self.queue.sync()  # the queue file is kept up to date by its journal, so there's only that to save
+    else:
+      queue = dict(self.queue)
+      if len(lines := self.readfile(path)):
+        queue |= {line: line for line in lines}
+      if len(queue):
+        self.writefile(
+          path,
+          [url for url in queue if url not in self.history and url not in self.deleted and url not in self.unverified],
+        )
     if set_history:
       self.update_history()
 
-  def do_wait(self: Self, arg: str = "") -> None:
+  def do_sync(self: Self, arg: str = "") -> None:
+    """
+    Queue what's new on channels (or playlists) since we last synced them, or on every channel we've synced before:
+
+    >>> sync | sync [url] [...]
+    """  # noqa: D415
+    from tqdm import tqdm  # noqa: PLC0415
+
+    urls = [self.clean_url(url) for url in arg.split()] or list(self.channels)
+    if not urls:
+      print("No channels to sync, give their URLs to start syncing them")  # noqa: T201
+      return
+    set_title(f"syncing {len(urls)} channel{'s' * (len(urls) != 1)}")
+    queued = 0
+    with ThreadPoolExecutor(max_workers=max(self.workers, 1), thread_name_prefix="pytdl-sync") as pool:
+      syncing = {url: pool.submit(self.sync_channel, url) for url in urls}
+      for url, future in tqdm(syncing.items(), ascii=self.is_ascii, ncols=100, unit="channel"):
+        try:
+          new = future.result()
+        except Exception:
+          logging.exception(f"Exception syncing {url}")
+          continue
+        self.queue.extend(reversed(new))  # oldest first
+        queued += len(new)
+    self.playlists.save()
+    sync_file = self.sync_file()
+    sync_file.parent.mkdir(parents=True, exist_ok=True)
+    temp = sync_file.with_name(f"{sync_file.name}.tmp")
+    temp.write_text(json.dumps(self.channels, indent=2), encoding="utf8")
+    temp.replace(sync_file)
+    print(f"Queued {queued} new URL{'s' * (queued != 1)} from {len(urls)} channel{'s' * (len(urls) != 1)}")  # noqa: T201
+
+  def do_verify(self: Self, arg: str = "") -> None:
+    """
+    Check whether URLs that failed to download can be extracted now, moving those that can back to the queue:
+
+    >>> verify | verify [url] [...]
+    """  # noqa: D415
+    from tqdm import tqdm  # noqa: PLC0415
+
+    urls = arg.split() or sorted(self.unverified)
+    print(f"Verifying {len(urls)} URL{'s' * (len(urls) != 1)}")  # noqa: T201
+    for url in tqdm(urls, ascii=self.is_ascii, ncols=100, unit="url"):
+      if self.url_info(url, fresh=True):
+        self.unverified.discard(url)
+        self.queue[url] = url
+    print(f"{len(self.unverified)} URL{'s' * (len(self.unverified) != 1)} still unverified")  # noqa: T201
+    self.writefile(self.unverified_file, sorted(self.unverified))
+
+  def do_wait(self: Self, arg: str = "") -> None:  # noqa: C901, PLR0912, PLR0915
     """
-    Wait on currently live videos, checking in slowing intervals from 10s to 10mins:
+    Wait on currently live videos, checking each in slowing intervals from 10s to 60s, and getting them once they end:
 
     >>> wait | wait [url] [...]
+
+    Those that have ended are got as their host's rate limit allows, and tried again (after it's backed off) if it
+    throttles us.
     """  # noqa: D415
-    urls, i = arg.split(), 0
-    if len(arg) == 0 or len(urls) == 0:
-      urls = list(self.queue)
-    elapsed, intervals = 0, [10, 30, 60]
-    wait_next = list(zip(intervals, intervals[1:] + [3600 * 24], strict=True))
-    while urls:
-      url = urls.pop(0)
-      set_title(f"waiting on {url}")
-      if self.is_live(url):
-        wait, next_wait = wait_next[i]
-        elapsed += wait
-        if elapsed > next_wait * 2 and i < len(intervals) - 1:
-          i += 1
-        set_title(f"waiting on {url}, checking in {naturaltime(wait, future=True)}")
+    from humanize import naturaltime  # noqa: PLC0415
+
+    urls = arg.split() or list(self.queue)
+    intervals, order, start = (10, 30, 60), count(), monotonic()
+    due = [(start, next(order), url) for url in urls]  # a heap of when we next check each URL
+    ended: list[tuple[float, int, str]] = []  # and a heap of when we may get each that's ended
+    since, position = dict.fromkeys(urls, start), {url: i for i, url in enumerate(urls, 1)}
+    checking: dict[Future, str] = {}
+    getting: dict[Future, str] = {}
+    throttled: Counter[str] = Counter()
+    watchers = max(self.watchers, 1)
+    checks = ThreadPoolExecutor(max_workers=watchers, thread_name_prefix="pytdl-wait")
+    gets = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pytdl-get")  # so one ending doesn't hold up the rest
+    try:
+      while due or checking or getting or ended:
+        now = monotonic()
+        while due and due[0][0] <= now and len(checking) < watchers:
+          _, _, url = heappop(due)
+          checking[checks.submit(self.is_live, url, fresh=True)] = url
+        while ended and ended[0][0] <= now:
+          host = self.host_key(url := ended[0][2])
+          if (backoff := self.limiter.delay(host, burst := self.concurrency(host))) > 0:
+            heapreplace(ended, (now + backoff, next(order), url))
+            continue
+          heappop(ended)
+          self.limiter.take(host, burst)
+          getting[gets.submit(self.fetch, url, position[url], len(urls))] = url
+        nap = min(
+          [when - now for when, _, _ in [*(due[:1] if len(checking) < watchers else ()), *ended[:1]]], default=None
+        )
+        nap = None if nap is None else max(nap, 0)
+        set_title(
+          f"waiting on {len(due) + len(checking)} live, getting {len(getting) + len(ended)}"
+          + (f", checking in {naturaltime(nap, future=True)}" if nap else "")
+        )
         try:
-          sleep(wait + randint(0, wait // 3) + random())  # w/ jitter
+          if not checking and not getting:
+            sleep(nap or 0)
+            continue
+          done, _ = wait([*checking, *getting], timeout=nap, return_when=FIRST_COMPLETED)
         except KeyboardInterrupt:
-          if not yesno("Test if the URL is currently livestreaming?") and not yesno("Do you want to continue waiting?"):
+          if yesno("Test if the URLs are currently livestreaming?"):
+            due = [(now, i, url) for _, i, url in due]
+            heapify(due)  # as it was a heap by when each was due, which is now the same for all
+          elif not yesno("Do you want to continue waiting?"):
+            break
+          continue
+        for future in done:
+          if (url := checking.pop(future, None)) is None:
+            url = getting.pop(future)
+            match future.result():
+              case "live" | "skip":
+                self.limiter.refund(host := self.host_key(url), self.concurrency(host))
+                if future.result() == "skip":
+                  continue
+              case "throttled" if throttled[url] < 3:  # noqa: PLR2004
+                throttled[url] += 1
+                heappush(ended, (monotonic(), next(order), url))  # for once its host has backed off
+                continue
+              case "throttled":
+                self.demote(url)
+                continue
+              case _:
+                continue
+          elif not future.result():  # it's over, so get it while we carry on waiting on the rest
+            heappush(ended, (monotonic(), next(order), url))
+            continue
+          waited = monotonic() - since[url]
+          wait_for = next((w for w, after in pairwise(intervals) if waited <= after * 2), intervals[-1])
+          heappush(due, (monotonic() + wait_for + randint(0, wait_for // 3) + random(), next(order), url))  # w/ jitter
+    finally:
+      checks.shutdown(wait=False, cancel_futures=True)
+      if getting:
+        print(f"Waiting on {len(getting)} running download{'s' * (len(getting) != 1)} to finish")  # noqa: T201
+      gets.shutdown(wait=True)
+      self.update_history()
+
+  def do_serve(self: Self, arg: str = "") -> None:
+    """
+    Keep running, getting the queue as it's added to, taking commands (see SERVED) sent to serve_socket, or stop that:
+
+    >>> serve | serve stop
+    """  # noqa: D415
+    path = Path(self.serve_socket).expanduser()
+    if arg == "stop":
+      if not send(path, ["serve stop"]):
+        print(f"Nothing's serving on {path}")  # noqa: T201
+      return
+    if (connected := connect(path)) is not None:
+      connected[0].close()
+      print(f"Already serving on {path}")  # noqa: T201
+      return
+    replies = Replies(sys.stdout)
+    server = control_server(path, self.serve_port, self.serve_command, replies)
+    self.is_idle = True  # as there's nobody to prompt
+    self.stopping.clear()
+    downloads = threading.Thread(target=self.serve_downloads, name="pytdl-serve", daemon=True)
+    print(f"Serving on {path}, stop with Ctrl+C or serve stop")  # noqa: T201
+    set_title("serving")
+    sys.stdout = replies
+    try:
+      downloads.start()
+      self.wake.set()  # to get what's queued already
+      server.serve_forever()
+    except KeyboardInterrupt:
+      print()  # noqa: T201
+    finally:
+      server.server_close()
+      path.unlink(missing_ok=True)
+      self.stopping.set()
+      self.wake.set()
+      downloads.join(1)
+      if downloads.is_alive():
+        print("Waiting on the running downloads to finish")  # noqa: T201
+        downloads.join()
+      sys.stdout = replies.terminal
+      self.do_save()
+
+  def do_worker(self: Self, arg: str = "") -> None:
+    """
+    Be one of the workers getting the queue shared in work_file (adding ours to it, unless given a -), in turns:
+
+    >>> worker | worker-
+    """  # noqa: D415
+    self.work.open(Path(self.work_file).expanduser())
+    if arg != "-" and (shared := self.work.add(self.queue)):
+      print(f"Shared {shared} URL{'s' * (shared != 1)} from our queue")  # noqa: T201
+    owner, claimed, stopping = f"{socket.gethostname()}:{os.getpid()}", [], threading.Event()
+
+    def heartbeat() -> None:
+      while not stopping.wait(self.lease / 3):
+        if lost := self.work.renew(owner, list(claimed), self.lease):
+          logging.warning(f"Lost our lease on {len(lost)} URLs, so another worker may be getting them too")
+
+    threading.Thread(target=heartbeat, name="pytdl-heartbeat", daemon=True).start()
+    set_title(f"worker {owner}")
+    try:
+      while True:
+        self.update_history()  # so we know what the other workers have got
+        claimed[:] = self.work.claim(owner, 2 * max(self.workers, 1), self.lease)
+        if not claimed:
+          if (due := self.work.next_due()) is None:
             break
-        if self.is_live(url):
-          urls.append(url)
-      if not self.is_live(url):
-        self.do_get(url)
-        elapsed, i = 0, 0  # reset since we just spent a chunk of time downloading
+          sleep(min(max(due - time(), 1), 60))  # for those that were live (the rest are the other workers')
+          continue
+        still_live: list[str] = []
+        self.run_downloads(list(claimed), still_live)
+        self.settle(owner, claimed, still_live)
+        claimed.clear()
+    except KeyboardInterrupt:
+      print()  # noqa: T201
+      print("Stopped by user")  # noqa: T201
+      for url in claimed:  # so another worker doesn't wait on the leases to expire to get them
+        self.work.release(owner, url, 0, tried=False)
+    finally:
+      stopping.set()
+      self.update_history()
+    counts = self.work.counts()
+    left, failed = counts.get("queued", 0) + counts.get("leased", 0), counts.get("failed", 0)
+    print(f"Left {left} URLs to the other workers, and {failed} failed")  # noqa: T201
 
   def do_merge(self: Self, arg: str = "") -> None:
     """
@@ -930,7 +3620,12 @@ class PYTDL(Cmd):
     >>> clean | clean [path-to-directory].
     """
     path = Path(arg).expanduser() if len(arg) else self.home / "Videos" / "Shows"
-    vids = list(filter(Path.is_file, path.rglob("*")))
+    roots = self.library_roots()
+    if any(path.is_relative_to(root) for root in roots):
+      self.library.refresh(roots)  # which only rescans what's changed
+      vids = self.library.files(path)
+    else:
+      vids = list(filter(Path.is_file, path.rglob("*")))
     for vid in vids:
       if vid.name.startswith("0 "):
         new_stem = vid.stem.removeprefix("0 ").strip().removesuffix(".").removesuffix(" -")
@@ -948,13 +3643,17 @@ class PYTDL(Cmd):
   def do_exit(self: Self, _arg: str = "") -> Literal[True]:
     """Exit PYTDL."""
     logging.debug("Exitting sequence started")
-    arg = Path(_arg).expanduser()
-    arg = arg if arg.is_file() else Path(self.queue_file).expanduser()
     self.do_save(_arg)
+    if self.queue.records:  # so the queue file's tidy for anyone editing it by hand, if it's not already
+      self.queue.compact()
+    if self.info_cache.stored:  # rather than on every start, as that costs a pass over the whole cache
+      self.info_cache.prune()
+    arg = Path(_arg.removeprefix("-")).expanduser()
+    arg, saved = (arg, len(self.readfile(arg))) if arg.is_file() else (self.queue.path, len(self.queue))
     set_title("exitting")
-    logging.debug(f"Exitting, saved {len(self.readfile(arg))} URLs to {arg}")
-    print(f"Exitting, saved {len(self.readfile(arg))} URLs to {arg}")  # noqa: T201
-    sleep(2.0)
+    logging.debug(f"Exitting, saved {saved} URLs to {arg}")
+    print(f"Exitting, saved {saved} URLs to {arg}")  # noqa: T201
+    sleep(self.exit_pause)
     logging.debug("Exit complete")
     return True
 
@@ -968,10 +3667,14 @@ class PYTDL(Cmd):
 
   def preloop(self: Self) -> None:  # noqa: D102
     set_title("starting up")
+    config_file = Path(self.config_file).expanduser()
     self.do_config()
-    self.do_config()  # in case of redirection
+    if Path(self.config_file).expanduser() != config_file:  # in case of redirection
+      self.do_config()
     logging.debug(f"Config file loaded ({self.config_file})")
-    self.do_load(allow_unsupported=True)
+    if len(self.queue):
+      print(f"Loaded {len(self.queue)} URLs from {self.queue.path}")  # noqa: T201
+    self.unverified |= set(self.readfile(self.unverified_file))
     self.do_mode()
 
   #########################
@@ -1004,6 +3707,275 @@ class PYTDL(Cmd):
 ## Regular Functions ##
 #######################
 
+OUTTMPL_PARAMS = (
+  "outtmpl",
+  "paths",
+  "restrictfilenames",
+  "windowsfilenames",
+  "trim_file_name",
+  "outtmpl_na_placeholder",
+)
+NAME_MAX, PATH_MAX = 255, 4096  # in bytes, as most filesystems limit them
+SIDECARS = (".vtt", ".srt", ".ass", ".lrc", ".json", ".description", ".jpg", ".png", ".webp", ".txt")
+FILE_ID = re.compile(r"\[([^\[\]]+)\](?:\.[\w-]+)*\.\w+$")  # from an outtmpl's [%(id)s].%(ext)s
+NOTHING = nullcontext()
+"A context manager that does nothing (i.e., a span when we're not tracing)"
+SERVED = frozenset({"add", "cache", "echo", "get", "getall", "info", "load", "mode", "print", "serve", "stats"})
+"The commands we take while serving (the rest either prompt or would compete with the background downloads)"
+SHORTHANDS = {".": "getall", "!": "get", "@": "print", ":": "load"}
+"The shorthand operators (see default) of the commands we take while serving"
+HTTP_REQUEST = re.compile(r"^[A-Z]+ \S+ HTTP/\d")
+"The request line of an HTTP request, which we never take commands from"
+THROTTLED = re.compile(r"HTTP Error 429|Too Many Requests|confirm you.re not a bot", re.IGNORECASE)
+"How a download fails when its host's throttling us (which we back off from, and try again after)"
+FORBIDDEN = re.compile(r"HTTP Error 403")
+"How a download fails when its host refuses us, which is only throttling if it refuses other URLs too"
+EXPIRES = re.compile(r"[?&/]expire[=/](\d+)")
+"Where a format URL says when it expires (as on YouTube)"
+PLAYLIST_TYPES = frozenset({"playlist", "multi_video"})
+"The _type of what yt-dlp extracts from a playlist (or channel), rather than a video"
+URL_EDGE = Chars(chars=frozenset({""}))
+'The start or end of a URL (as "" in Chars)'
+ANY_CHAR = Chars(negated=True)
+"Any character"
+CATEGORIES = {
+  "CATEGORY_DIGIT": Chars(chars=frozenset(string.digits)),
+  "CATEGORY_NOT_DIGIT": Chars(negated=True, chars=frozenset(string.digits)),
+  "CATEGORY_WORD": Chars(chars=frozenset(string.ascii_lowercase + string.digits + "_")),
+  "CATEGORY_NOT_WORD": Chars(negated=True, chars=frozenset(string.ascii_lowercase + string.digits + "_")),
+  "CATEGORY_SPACE": Chars(chars=frozenset(string.whitespace)),
+  "CATEGORY_NOT_SPACE": Chars(negated=True, chars=frozenset(string.whitespace)),
+}
+"Which characters each of a parsed regex's categories (i.e., \\d) matches (of those we care about, in ASCII)"
+URL_WORD_CHARS = frozenset(string.ascii_lowercase + string.digits + "-")
+"The characters of a word in a URL (so a hostname's labels are words)"
+URL_WORD = re.compile(r"[a-z0-9-]+")
+"A word in a (lower-cased) URL"
+
+
+def url_candidates(index: dict[str, list[int]], fallback: list[int], url: str) -> list[int]:
+  """Which of the things indexed by url_options could match a URL (in the order they were indexed)."""
+  candidates = set(fallback)
+  for word in set(URL_WORD.findall(url.lower())):
+    candidates.update(index.get(word, ()))
+    for n in range(2, len(word) + 1):  # patterns like br(?:-klassik)? and (?:we|sundance)tv
+      candidates.update(index.get(f"{word[:n]}*", ()))
+      candidates.update(index.get(f"*{word[-n:]}", ()))
+  return sorted(candidates)
+
+
+def url_options(pattern: str, *, anchored: bool = True) -> list[set[str]]:
+  r"""
+  Ways to index a URL regex: sets of words, at least one of which every URL it matches has.
+
+  So youtube\.com gives {"youtube"} and {"com"}, but a word that starts or ends with a group is partial, such as "*tv"
+  for (?:we|sundance)tv, or "br*" for br(?:-klassik)?. Regexes are anchored at the start of the URL (as yt-dlp matches
+  them), unless they aren't (as ClearURLs searches with them). If some URL it matches could have none of its words
+  (i.e., https?://[^/]+/), there are none, and it must always be checked.
+  """
+  try:
+    parsed = list(re._parser.parse(pattern))  # noqa: SLF001 (as it's what re compiles patterns with)
+  except (re.error, RecursionError):
+    return []
+  return words_options(parsed, URL_EDGE if anchored else ANY_CHAR, ANY_CHAR)
+
+
+def vagueness(tokens: set[str]) -> tuple[int, bool]:
+  """How vague tokens (see url_options) are to index by, as the length of the shortest (partial ones being vaguer)."""
+  return max((-len(token.strip("*")), "*" in token) for token in tokens)
+
+
+def words_options(items: list, before: "Chars", after: "Chars") -> list[set[str]]:
+  """
+  Ways (see url_options) to index what parsed regex items match, by the words they must match.
+
+  before and after are what can come before and after the items (i.e., outside the group they're in).
+  """
+  options: list[set[str]] = []
+  i = 0
+  while i < len(items):
+    op, av = items[i]
+    if op.name == "LITERAL" and chr(av).lower() in URL_WORD_CHARS:
+      j = i + 1
+      while j < len(items) and items[j][0].name == "LITERAL" and chr(items[j][1]).lower() in URL_WORD_CHARS:
+        j += 1
+      word = "".join(chr(av).lower() for _, av in items[i:j])
+      starts = edge(items[:i], before, first=False).avoids(URL_WORD_CHARS)
+      ends = edge(items[j:], after, first=True).avoids(URL_WORD_CHARS)
+      if starts and ends:
+        options.append({word})
+      elif len(word) > 1 and (starts or ends):
+        options.append({f"{word}*" if starts else f"*{word}"})
+      i = j
+      continue
+    if not nullable(op, av) and (alts := alternatives(op, av)) is not None:
+      start, end = edge(items[:i], before, first=False), edge(items[i + 1 :], after, first=True)
+      if op.name.endswith("REPEAT"):  # so each repetition's between the others
+        start, end = start | edge(av[2], Chars(), first=False), end | edge(av[2], Chars(), first=True)
+      covers = [min(words_options(list(alt), start, end), key=vagueness, default=None) for alt in alts]
+      if None not in covers:
+        options.append(set().union(*covers))  # type: ignore[arg-type]
+    i += 1
+  return options
+
+
+def alternatives(op: Any, av: Any) -> list | None:  # noqa: ANN401
+  """What a parsed regex group (or repeat) matches one of, or None if it isn't one."""
+  match op.name:
+    case "SUBPATTERN":
+      return [av[-1]]
+    case "ATOMIC_GROUP":
+      return [av]
+    case "BRANCH":
+      return av[1]
+    case "MAX_REPEAT" | "MIN_REPEAT" | "POSSESSIVE_REPEAT":
+      return [av[2]]
+  return None
+
+
+def nullable(op: Any, av: Any) -> bool:  # noqa: ANN401
+  """Can a parsed regex item match nothing?"""
+  match op.name:
+    case "LITERAL" | "NOT_LITERAL" | "ANY" | "IN" | "CATEGORY":
+      return False
+    case "MAX_REPEAT" | "MIN_REPEAT" | "POSSESSIVE_REPEAT" if av[0]:
+      return all(nullable(*item) for item in av[2])
+    case "SUBPATTERN" | "ATOMIC_GROUP" | "BRANCH":
+      return any(all(nullable(*item) for item in alt) for alt in alternatives(op, av) or ())
+  return True  # optional repeats, anchors, assertions, and group references (which we can't follow)
+
+
+def edge(items: Iterable, then: "Chars", *, first: bool) -> "Chars":
+  """Which characters can start (if first, otherwise end) what parsed regex items match, with then beyond them."""
+  seen = Chars()
+  for op, av in items if first else reversed(list(items)):
+    match op.name:
+      case "AT" if av.name in ({"AT_END", "AT_END_STRING"} if first else {"AT_BEGINNING", "AT_BEGINNING_STRING"}):
+        return seen | URL_EDGE
+      case "AT" | "ASSERT" | "ASSERT_NOT":
+        continue
+      case "GROUPREF" | "GROUPREF_EXISTS":
+        seen |= ANY_CHAR
+      case _ if (alts := alternatives(op, av)) is not None:
+        for alt in alts:
+          seen |= edge(alt, Chars(), first=first)
+      case _:
+        seen |= Chars.of(op, av)
+    if not nullable(op, av):
+      return seen
+  return seen | then
+
+
+@cache
+def ytdlp_version() -> str:
+  """yt-dlp's version, read from its version.py without importing it (which would import all of it)."""
+  with suppress(AttributeError, OSError, TypeError, ValueError):
+    version = Path(find_spec("yt_dlp").origin).with_name("version.py").read_text(encoding="utf8")
+    if match := re.search(r"^__version__ = ['\"]([^'\"]+)", version, re.MULTILINE):
+      return match[1]
+  from yt_dlp.version import __version__  # noqa: PLC0415
+
+  return __version__
+
+
+parsed_toml: dict[Path, tuple[tuple[int, int], dict[str, Any]]] = {}
+"What we've parsed of each TOML file, by its mtime and size when we did"
+
+
+def load_toml(path: Path) -> dict[str, Any]:
+  """Parse a TOML file, or reuse what we parsed of it last time if it hasn't changed since (by its mtime and size)."""
+  import rtoml  # noqa: PLC0415
+
+  stat = path.stat()
+  if (cached := parsed_toml.get(path)) is None or cached[0] != (stat.st_mtime_ns, stat.st_size):
+    cached = parsed_toml[path] = (stat.st_mtime_ns, stat.st_size), rtoml.load(path)
+  return deepcopy(cached[1])  # so what's loaded can be changed without changing what we've cached
+
+
+def served(line: str) -> tuple[str, str]:
+  """The command sent to us while serving (with any shorthand, i.e., "." for getall, spelled out) and its argument."""
+  if line[:1] in SHORTHANDS:
+    return SHORTHANDS[line[0]], line[1:].strip()
+  cmd, _, arg = line.partition(" ")
+  return cmd, arg.strip()
+
+
+def control_server(path: Path, port: int, run: Callable[[str], bool], replies: Replies) -> BaseServer:
+  """
+  A server running the commands sent to it with run, on a Unix socket at path, or on a port on localhost.
+
+  We use the port when it's given, or there aren't Unix sockets (as on Windows), in which case path says which it is,
+  and the token clients must send first (as anyone on this machine can connect to the port, but only we can read path).
+  """
+  path.parent.mkdir(parents=True, exist_ok=True)
+  token = None
+  if port or not hasattr(socket, "AF_UNIX"):
+    server: BaseServer = ControlTCPServer(("127.0.0.1", port), ControlHandler)
+    token = token_urlsafe(32)
+    with os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w", encoding="utf8") as f:
+      f.write(f"127.0.0.1:{server.server_address[1]}\n{token}\n")
+    path.chmod(0o600)  # in case it was there already
+  else:
+    from socketserver import ThreadingUnixStreamServer  # noqa: PLC0415 (only where there are Unix sockets)
+
+    path.unlink(missing_ok=True)  # left by a server that didn't stop cleanly, as nothing's answering on it
+    server = ThreadingUnixStreamServer(str(path), ControlHandler)
+    path.chmod(0o600)  # as whoever can connect can have us download (or load) anything
+  server.daemon_threads = True  # type: ignore[attr-defined] (so a client that's hung doesn't keep us from exiting)
+  server.run, server.replies, server.token = run, replies, token  # type: ignore[attr-defined] (for ControlHandler)
+  return server
+
+
+def connect(path: Path) -> tuple[socket.socket, list[str]] | None:
+  """
+  A connection to the server on path (a Unix socket, or a file saying which port on localhost), if one's running.
+
+  It comes with what to send first, which over TCP is the server's token.
+  """
+  if path.is_socket():
+    conn = socket.socket(socket.AF_UNIX)
+    try:
+      conn.connect(str(path))
+    except OSError:
+      conn.close()
+      return None
+    return conn, []
+  try:
+    address, token = path.read_text(encoding="utf8").split()
+    host, port = address.rsplit(":", 1)
+    conn = socket.create_connection((host, int(port)), timeout=1)
+  except (OSError, ValueError):
+    return None
+  conn.settimeout(None)  # as the commands may take a while
+  return conn, [token]
+
+
+def send(path: Path, lines: Iterable[str]) -> bool:
+  """Send commands to the server on path, printing its replies as they come, or return False if none's running."""
+  if (connected := connect(path)) is None:
+    return False
+  conn, first = connected
+  with conn:
+    conn.sendall("".join(f"{line}\n" for line in [*first, *lines]).encode("utf8"))
+    conn.shutdown(socket.SHUT_WR)
+    while chunk := conn.recv(1 << 16):
+      sys.stdout.buffer.write(chunk)
+      sys.stdout.flush()
+  return True
+
+
+def page_through(entries: "Iterable[dict] | PagedList", start: int = 0) -> Iterator[dict]:
+  """Go through a playlist's entries from the start'th, only fetching the pages of them we need as we need them."""
+  from yt_dlp.utils import PagedList  # noqa: PLC0415
+
+  if isinstance(entries, PagedList):
+    size = getattr(entries, "_pagesize", 1)
+    while page := entries.getslice(start, start + size - start % size):
+      yield from page
+      start += len(page)
+  else:
+    yield from islice(entries, start, None)
+
 
 def strict_dict_update(old: dict, new: dict, path: list[str]) -> None:
   """Recursively update a dictionary according to the implicit schema of its existing keys/structure and types."""
@@ -1034,6 +4006,27 @@ def unique_list(xs: Iterable) -> list:
   return list(dict.fromkeys(xs))
 
 
+@contextmanager
+def locked(path: Path) -> Iterator[None]:
+  """Hold an exclusive lock for changing the file at path (on its .lock file), against other processes that share it."""
+  try:
+    import fcntl  # noqa: PLC0415 (only on Unix)
+  except ImportError:  # i.e., on Windows, where we can't share files between workers so safely
+    yield
+    return
+  with path.with_name(f"{path.name}.lock").open("a") as lock:
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    yield
+
+
+def sidecar_extractor(path: Path) -> str | None:
+  """Which extractor (as in archive IDs) yt-dlp's info.json beside a file says it's from, if there's one."""
+  with suppress(OSError, ValueError, KeyError, AttributeError):
+    info = json.loads(path.with_suffix(".info.json").read_text(encoding="utf8"))
+    return info["extractor_key"].lower()
+  return None
+
+
 def writelines(
   fp: str | Path,
   lines: str | list[str],
@@ -1050,6 +4043,10 @@ def writelines(
       f.writelines(f"{line}{newline}" for line in lines)
 
 
+prompting = threading.Lock()
+"Held while asking the user something, so concurrent downloads don't talk over each other"
+
+
 def yesno(
   msg: str = "", *, accept_return: bool | None = True, yes: set[str] | None = None, no: set[str] | None = None
 ) -> bool:
@@ -1059,12 +4056,13 @@ def yesno(
   if yes is None:
     yes = {"y", "ye", "yes"}
   fmt = "[Y/n]" if accept_return else "[y/N]" if accept_return is not None else "[y/n]"
-  while True:
-    reply = input(f"\r{msg} {fmt}: ").strip().lower()
-    if reply in yes or (not reply and accept_return):
-      return True
-    if reply in no or (not reply and accept_return is not None):
-      return False
+  with prompting:
+    while True:
+      reply = input(f"\r{msg} {fmt}: ").strip().lower()
+      if reply in yes or (not reply and accept_return):
+        return True
+      if reply in no or (not reply and accept_return is not None):
+        return False
 
 
 def filter_maker(level: str) -> Callable[..., bool]:
@@ -1077,49 +4075,177 @@ def filter_maker(level: str) -> Callable[..., bool]:
   return fltr
 
 
-def merge_subs(path: Path = Path()) -> None:
-  """Merge .ass subtitles into .mp4 videos non-destructively (by switching to .mkv)."""
-  vids = list(filter(Path.is_file, path.rglob("*.mp4")))
-  subs = list(filter(Path.is_file, path.rglob("*.ass")))
-  _pair: dict[Path, Path | None] = dict.fromkeys(vids)
-  lang = {}
+def scan(path: Path) -> Iterator[os.DirEntry]:
+  """Every file under a directory, in one pass (without following symlinks to directories)."""
+  dirs = [path]
+  while dirs:
+    with suppress(OSError), os.scandir(dirs.pop()) as entries:
+      for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+          dirs.append(Path(entry.path))
+        elif entry.is_file():
+          yield entry
+
+
+def duration(path: Path) -> float | None:
+  """How many seconds long a video is, by ffprobe, if it can tell (i.e., it's not truncated)."""
+  r = run(  # noqa: S603
+    ["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0", str(path)],  # noqa: S607
+    check=False,
+    capture_output=True,
+    text=True,
+  )
+  with suppress(ValueError):
+    return float(r.stdout.strip()) if not r.returncode else None
+  return None
+
+
+def is_merged(mkv: Path, vid: Path) -> bool:
+  """Is a .mkv as long as the video it was merged from (so it's complete, and we can delete the video)?"""
+  return (
+    (mkv_length := duration(mkv)) is not None and (length := duration(vid)) is not None and mkv_length >= length - 1
+  )
+
+
+def merge_sub(vid: Path, sub: Path, lang: str, tries: int = 2) -> str | None:
+  """
+  Merge a .ass subtitle into a .mp4 video as a .mkv, returning what went wrong (if anything did).
+
+  ffmpeg writes to a .mkv.part that's only renamed to the .mkv once it's done, so an interrupted merge never leaves
+  a truncated .mkv that looks finished.
+  """
+  err = None
+  mkv = vid.with_suffix(".mkv")
+  part = mkv.with_name(f"{mkv.name}.part")
+  for _ in range(tries):
+    r = run(  # noqa: S603
+      [  # noqa: S607
+        "ffmpeg",
+        "-nostdin",
+        "-y",  # any .mkv.part that's there already is from a merge that was interrupted
+        "-v",
+        "warning",
+        "-i",
+        str(vid),
+        "-i",
+        str(sub),
+        "-map",
+        "0",
+        "-c:v",
+        "copy",
+        "-c:a",
+        "copy",
+        "-map",
+        "-0:s",
+        "-map",
+        "-0:d",
+        "-c:s",
+        "copy",
+        "-map",
+        "1:0",
+        "-metadata:s:s:0",
+        f"language={lang}",
+        "-f",
+        "matroska",
+        str(part),
+      ],
+      check=False,
+      capture_output=True,
+      text=True,
+    )
+    if not r.returncode:
+      part.replace(mkv)
+      return None
+    err = r.stderr.strip().splitlines()[-1:] or [f"ffmpeg exited with {r.returncode}"]
+  part.unlink(missing_ok=True)
+  return err[0] if err else None
+
+
+def merge_subs(path: Path = Path(), workers: int = 0) -> None:  # noqa: C901, PLR0912
+  """
+  Merge .ass subtitles into .mp4 videos non-destructively (by switching to .mkv).
+
+  We walk the directory once, skip any video that's already been merged (its .mkv is newer than it and its subtitles),
+  and run ffmpeg on as many workers as we have CPUs (or as given). We only skip (and delete the sources of) a video
+  whose .mkv ffprobe says is as long as it, so it's not truncated; otherwise it's merged again.
+  """
+  import langcodes  # noqa: PLC0415 (to convert IETF BCP 47, i.e. Crunchyroll's en-US, to ISO 639-2 for ffmpeg)
+  from tqdm import tqdm  # noqa: PLC0415
+
+  start = monotonic()
+  vids: dict[Path, os.stat_result] = {}
+  subs: dict[Path, os.stat_result] = {}
+  mkvs: dict[Path, os.stat_result] = {}
+  for entry in scan(path):
+    match Path(entry.name).suffix:
+      case ".mp4":
+        vids[Path(entry.path)] = entry.stat()
+      case ".ass":
+        subs[Path(entry.path)] = entry.stat()
+      case ".mkv":
+        mkvs[Path(entry.path)] = entry.stat()
+  pair: dict[Path, tuple[Path, str]] = {}
   for sub in subs:
     suffix = next(filter(langcodes.tag_is_valid, (s.removeprefix(".") for s in sub.suffixes)), None)
     if suffix:
       v = sub.with_stem(sub.stem.removesuffix(f".{suffix}")).with_suffix(".mp4")
-      if v in _pair:
-        lang[sub] = langcodes.get(suffix).to_alpha3()
-        _pair[v] = sub
+      if v in vids:
+        pair[v] = sub, langcodes.get(suffix).to_alpha3()
     else:
       print(f"We are missing a language code (i.e. en-US) on {sub}")  # noqa: T201
 
-  pair: dict[Path, Path] = {vid: sub for vid, sub in _pair.items() if sub is not None}
-  for vid, sub in pair.items():
-    for _ in range(2):  # how many tries
-      if (
-        r := run(
-          f'ffmpeg -v "warning" -i "{vid}" -i "{sub}" -map 0 -c:v copy -c:a copy -map "-0:s" -map "-0:d" -c:s copy -map "1:0" "-metadata:s:s:0" "language={lang[sub]}" "{vid.with_suffix(".mkv")}" ',  # noqa: E501
-          check=False,
-        )
-      ).returncode:
-        pprint(r)  # noqa: T203
-      else:
-        break
+  merged, skipped, failed = [], [], {}
+  todo = {}
+  for vid, (sub, lang) in pair.items():
+    mkv = mkvs.get(vid.with_suffix(".mkv"))
+    if (
+      mkv is not None
+      and mkv.st_mtime >= max(vids[vid].st_mtime, subs[sub].st_mtime)
+      and is_merged(vid.with_suffix(".mkv"), vid)  # as a merge that was killed (before .mkv.part) left it truncated
+    ):
+      skipped.append(vid)
     else:
-      continue  # couldn't merge
-    if vid.with_suffix(".mkv").is_file():
-      with suppress(Exception):
-        vid.unlink()
-        sub.unlink()
-      # we fail to unlink if, say, someone is already watching it!
+      todo[vid] = sub, lang
+  with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1, thread_name_prefix="pytdl-merge") as pool:
+    merging = {pool.submit(merge_sub, vid, sub, lang): vid for vid, (sub, lang) in todo.items()}
+    for future in tqdm(as_completed(merging), total=len(merging), ncols=100, unit="vid", disable=not merging):
+      vid = merging[future]
+      if (err := future.result()) is None:
+        merged.append(vid)
+      else:
+        failed[vid] = err
+
+  for vid in [*merged, *skipped]:
+    with suppress(Exception):
+      vid.unlink()
+      pair[vid][0].unlink()
+    # we fail to unlink if, say, someone is already watching it!
+
+  elapsed = monotonic() - start
+  size = sum(vids[vid].st_size for vid in merged)
+  rates = max(elapsed, 1e-9)  # as Windows' monotonic clock is coarse enough to not tick for an empty directory
+  print(  # noqa: T201
+    f"Merged {len(merged)} video{'s' * (len(merged) != 1)} in {elapsed:.1f}s"
+    f" ({len(merged) / rates:.2f} videos/s, {size / rates / 2**20:.1f} MiB/s),"
+    f" skipped {len(skipped)} already merged, {len(failed)} failed"
+  )
+  for vid, err in failed.items():
+    print(f"Failed to merge {vid}: {err}")  # noqa: T201
 
 
 if __name__ == "__main__":
   logging.Formatter.default_time_format = "%Y-%m-%d-%H-%M-%S"
   pytdl = PYTDL()
   if len(sys.argv) >= 2:  # noqa: PLR2004
+    ops = list(map(str.strip, " ".join(sys.argv[1:]).split(",")))
+    config = Path(PYTDL.config_file).expanduser()
+    serving = Path(
+      load_toml(config).get("serve_socket", PYTDL.serve_socket) if config.is_file() else PYTDL.serve_socket
+    )
+    if send(serving.expanduser(), ops):  # as only the server's to change the queue while it's serving
+      sys.exit(any(served(op)[0] not in SERVED for op in ops if op))  # failing if it refused any
     pytdl.preloop()
-    for op in map(str.strip, " ".join(sys.argv[1:]).split(",")):
+    for op in ops:
       if op.startswith("cd "):
         os.chdir(Path(op.removeprefix("cd ")))
       else:
@@ -0,0 +1,1016 @@
+"""
+Tests for PYTDL, run offline with pytest.
+
+The download pipeline is tested against bench's MediaServer (with FakeIE), with faults injected, as it's benchmarked.
+
+>>> uv run pytest test_pytdl.py
+
+Copyright 2019 Alex Blandin
+"""
+
+import json
+import os
+import socket
+import sqlite3
+import sys
+import threading
+from collections import Counter
+from collections.abc import Callable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from itertools import islice
+from pathlib import Path
+from random import Random
+from subprocess import CompletedProcess
+from time import sleep
+
+import pytest
+from ada_url import URL
+from yt_dlp.extractor import gen_extractor_classes
+from yt_dlp.utils import OnDemandPagedList
+
+from bench import Faults, MediaServer, media_pytdl, scratch_pytdl
+from pytdl import (
+  FORBIDDEN,
+  PYTDL,
+  THROTTLED,
+  Classified,
+  Entry,
+  ExtractorIndex,
+  History,
+  Info,
+  InfoCache,
+  Library,
+  Metrics,
+  Playlists,
+  Queue,
+  RateLimiter,
+  Replies,
+  Tracer,
+  UrlCleaner,
+  WorkQueue,
+  control_server,
+  filter_maker,
+  merge_sub,
+  merge_subs,
+  page_through,
+  send,
+)
+
+sys.modules["__main__"].filter_maker = filter_maker  # as PYTDL.log_config uses __main__.filter_maker
+
+
+@pytest.fixture
+def pytdl(tmp_path: Path) -> PYTDL:
+  """A PYTDL configured by an empty config_file, keeping all it would in local (its queue, etc.) in tmp_path."""
+  return scratch_pytdl(tmp_path)
+
+
+@pytest.fixture
+def media(tmp_path: Path) -> PYTDL:
+  """A PYTDL set up to download a MediaServer's videos (with FakeIE) into tmp_path / "Videos", quietly."""
+  pytdl = media_pytdl(4, tmp_path)
+  pytdl.is_quiet = True
+  return pytdl
+
+
+def open_cache(path: Path, ttl: float = 3600, max_bytes: int = 1 << 20) -> InfoCache:
+  """An InfoCache opened on path, keeping everything for ttl seconds."""
+  cache = InfoCache()
+  cache.open(path, lambda _url, _info: ttl, max_bytes)
+  return cache
+
+
+def random_info(vid: str) -> Info:
+  """An Info with a random description (so they're all about the same size compressed)."""
+  return Info({"id": vid, "title": f"Video {vid}", "description": os.urandom(512).hex()})
+
+
+def test_info_is_compact() -> None:
+  """An Info keeps the fields we read as attributes, and decompresses the rest (as sanitize_info left it) for others."""
+  infodict = {"id": "a", "fulltitle": "A", "is_live": False, "epoch": 1, "formats": [{"url": "https://a.com/a.mp4"}]}
+  info = Info(infodict, expires=1234)
+  assert (info.id, info.fulltitle, info.is_live, info.expires) == ("a", "A", False, 1234)
+  assert info["formats"] == infodict["formats"]
+  assert "playlist" not in info
+  with pytest.raises(KeyError):
+    info["playlist"]
+  assert dict(info) == info.full
+  assert info.full.items() >= infodict.items()
+  again = Info.from_blob(info.blob, info.expires)
+  assert (again.id, again.fulltitle, again.expires, again.full) == ("a", "A", 1234, info.full)
+
+
+def test_info_cache_persists(tmp_path: Path) -> None:
+  """Infodicts are read back from the database by another InfoCache, until they expire."""
+  cache = open_cache(tmp_path / "info.sqlite")
+  cache["a"] = Info(random_info("a").full, expires=1234)
+  cache.close()
+  cache = open_cache(tmp_path / "info.sqlite", ttl=-1)
+  assert "a" in cache
+  assert (cache["a"].id, cache["a"].expires) == ("a", 1234)  # as we need to know when its formats expire
+  cache["b"] = random_info("b")
+  assert "b" not in cache
+  with pytest.raises(KeyError):
+    cache["b"]
+
+
+def test_info_cache_evicts_least_recently_used(tmp_path: Path) -> None:
+  """Once the database outgrows max_bytes, the infodicts read or written longest ago are evicted."""
+  cache = open_cache(tmp_path / "info.sqlite")
+  for vid in "abc":
+    cache[vid] = random_info(vid)
+    sleep(0.01)
+  size = cache.stats()["bytes"] / 3
+  cache.close()
+  cache = open_cache(tmp_path / "info.sqlite", max_bytes=int(4.5 * size))
+  assert cache["a"].id == "a"  # so "b" is now the least recently used
+  sleep(0.01)
+  for vid in "de":
+    cache[vid] = random_info(vid)
+    sleep(0.01)
+  assert set(cache) == {"a", "c", "d", "e"}
+  assert cache.stats()["bytes"] <= 4.5 * size
+
+
+def test_info_cache_evicts_by_last_use_in_memory(tmp_path: Path) -> None:
+  """Reading an infodict from memory counts as using it, and replacing one only counts its new size."""
+  cache = open_cache(tmp_path / "info.sqlite")
+  for vid in "abc":
+    cache[vid] = random_info(vid)
+    sleep(0.01)
+  cache["c"] = random_info("c")
+  size = cache.stats()["bytes"] / 3
+  assert cache.bytes == cache.stats()["bytes"]
+  cache.max_bytes = int(4.5 * size)
+  assert cache["a"].id == "a"  # from memory, so "b" is now the least recently used
+  sleep(0.01)
+  for vid in "de":
+    cache[vid] = random_info(vid)
+    sleep(0.01)
+  assert set(cache) == {"a", "c", "d", "e"}
+
+
+def test_info_cache_bounds_memory(tmp_path: Path) -> None:
+  """Only the memory_size most recently used infodicts are kept in memory, and the rest read back from the database."""
+  cache = open_cache(tmp_path / "info.sqlite")
+  cache.memory_size = 2
+  for vid in "abc":
+    cache[vid] = random_info(vid)
+  assert cache["a"].id == "a"
+  assert list(cache.memory) == ["c", "a"]
+  assert set(cache) == {"a", "b", "c"}
+
+
+def test_info_cache_prunes_only_when_asked(tmp_path: Path) -> None:
+  """Opening an InfoCache leaves what's expired to prune (which PYTDL runs on exit), counting what's stored since."""
+  cache = open_cache(tmp_path / "info.sqlite", ttl=-1)
+  cache["a"] = random_info("a")
+  cache.close()
+  cache = open_cache(tmp_path / "info.sqlite")
+  assert (cache.stats()["on disk"], cache.stored) == (1, 0)
+  cache["b"] = random_info("b")
+  assert cache.stored == 1
+  assert cache.prune() == 1
+  assert (set(cache), cache.stored) == ({"b"}, 0)
+
+
+@pytest.fixture(scope="module")
+def extractors(tmp_path_factory: pytest.TempPathFactory) -> ExtractorIndex:
+  """An ExtractorIndex, built (once) for these tests."""
+  extractors = ExtractorIndex()
+  extractors.path = tmp_path_factory.mktemp("extractors") / "extractors.json"
+  extractors.load()
+  return extractors
+
+
+@pytest.mark.parametrize(
+  ("url", "key"),
+  [
+    ("https://www.youtube.com/watch?v=dQw4w9WgXcQ", "Youtube"),
+    ("https://vimeo.com/76979871", "Vimeo"),
+    ("https://www.twitch.tv/videos/1234567890", "TwitchVod"),
+    ("https://example.org/video", None),
+    ("not a url", None),
+  ],
+)
+def test_extractor_index(extractors: ExtractorIndex, url: str, key: str | None) -> None:
+  """URLs are matched to the extractor yt-dlp would use, without going online, and to none if only Generic would do."""
+  assert extractors.match(url) == key
+
+
+def test_extractor_index_is_cached(extractors: ExtractorIndex) -> None:
+  """Another ExtractorIndex loads the index saved to its path, rather than building it again."""
+  cached = ExtractorIndex()
+  cached.path = extractors.path
+  cached.load()
+  assert (cached.keys, cached.index, cached.fallback) == (extractors.keys, extractors.index, extractors.fallback)
+  assert cached.match("https://vimeo.com/76979871") == "Vimeo"
+
+
+def test_extractor_index_rebuilds_old_formats(extractors: ExtractorIndex, tmp_path: Path) -> None:
+  """An index cached in an older format (for the same yt-dlp) is rebuilt, rather than loaded."""
+  old = ExtractorIndex()
+  old.path = tmp_path / "extractors.json"
+  cached = json.loads(extractors.path.read_text(encoding="utf8"))
+  old.path.write_text(json.dumps({**cached, "format": ExtractorIndex.FORMAT - 1, "index": {}}), encoding="utf8")
+  old.load()
+  assert old.index == extractors.index
+  assert json.loads(old.path.read_text(encoding="utf8"))["format"] == ExtractorIndex.FORMAT
+
+
+def test_extractor_index_agrees_with_ytdlp(extractors: ExtractorIndex) -> None:
+  """Every URL yt-dlp tests its extractors with is matched to the first of them suitable for it, as yt-dlp would."""
+  ies = list(gen_extractor_classes())
+  for ie in ies:
+    for case in ie.get_testcases(include_onlymatching=True):
+      if URL.can_parse(url := case["url"]):
+        key = next(other.ie_key() for other in ies if other.suitable(url))
+        assert extractors.match(url) == (None if key == "Generic" else key), url
+
+
+def test_extra_extractors_are_matched_offline(media: PYTDL, monkeypatch: pytest.MonkeyPatch) -> None:
+  """A URL one of our extra_extractors claims is supported (with an archive ID) without extracting anything."""
+  monkeypatch.setattr(media, "url_info", lambda *_, **__: pytest.fail("extracted info"))
+  url = "http://127.0.0.1:9/watch/7"
+  assert media.is_supported(url)
+  assert media.extractors.archive_id(url) == "fake 7"
+
+
+@pytest.mark.parametrize(
+  ("url", "classified"),
+  [
+    (
+      "https://youtu.be/dQw4w9WgXcQ?si=abc",
+      Classified("https://www.youtube.com/watch?v=dQw4w9WgXcQ", "www.youtube.com", "youtube", frozenset()),
+    ),
+    (
+      "https://www.youtube.com/playlist?list=PL123&si=abc",
+      Classified("https://www.youtube.com/playlist?list=PL123", "www.youtube.com", "youtube", frozenset({"playlist"})),
+    ),
+    (
+      "https://www.crunchyroll.com/watch/G123/ep",
+      Classified(
+        "https://www.crunchyroll.com/watch/G123/ep", "www.crunchyroll.com", "crunchyroll", frozenset({"show"})
+      ),
+    ),
+    (
+      "https://example.com/podcast/1",
+      Classified("https://example.com/podcast/1", "example.com", None, frozenset({"podcast"})),
+    ),
+  ],
+)
+def test_classify(pytdl: PYTDL, url: str, classified: Classified) -> None:
+  """A URL is classified by its site, cleaned, and categorised, and remembered as it was given and once clean."""
+  assert pytdl.classify(url) == classified
+  assert pytdl.classify(url) is pytdl.classify(classified.url)
+
+
+CLEARURLS = {
+  "providers": {
+    "example": {
+      "urlPattern": r"^https?://(?:[a-z0-9-]+\.)*?example\.com",
+      "rules": [r"utm_\w+", "ref"],
+      "referralMarketing": ["aff"],
+      "rawRules": [r"/ref=[^/?]*"],
+      "exceptions": [r"^https?://(?:[a-z0-9-]+\.)*?example\.com/keep"],
+      "redirections": [r"^https?://(?:[a-z0-9-]+\.)*?example\.com/out\?to=([^&]+)"],
+    },
+    "everywhere": {"urlPattern": ".*", "rules": ["fbclid"]},
+  }
+}
+"A few ClearURLs providers, like those in its data"
+
+
+@pytest.fixture
+def cleaner(tmp_path: Path) -> UrlCleaner:
+  """A UrlCleaner with YouTube's rule from PYTDL's url_rules, and CLEARURLS."""
+  (tmp_path / "clearurls.json").write_text(json.dumps(CLEARURLS), encoding="utf8")
+  cleaner = UrlCleaner()
+  cleaner.load({"youtube": PYTDL.url_rules["youtube"]}, PYTDL.site_hosts, tmp_path / "clearurls.json")
+  return cleaner
+
+
+@pytest.mark.parametrize(
+  ("url", "clean"),
+  [
+    ("https://shop.example.com/item?id=1&utm_source=x&ref=y&aff=z", "https://shop.example.com/item?id=1"),
+    ("https://example.com/item/ref=abc?id=1", "https://example.com/item?id=1"),
+    ("https://example.com/keep?utm_source=x", "https://example.com/keep?utm_source=x"),
+    (
+      "https://example.com/out?to=https%3A%2F%2Fexample.com%2Fitem%3Fid%3D2%26utm_medium%3Dx",
+      "https://example.com/item?id=2",
+    ),
+    ("https://elsewhere.org/page?fbclid=abc&q=1", "https://elsewhere.org/page?q=1"),
+    ("https://youtu.be/dQw4w9WgXcQ?si=abc", "https://www.youtube.com/watch?v=dQw4w9WgXcQ"),
+    ("https://m.youtube.com/shorts/dQw4w9WgXcQ", "https://www.youtube.com/watch?v=dQw4w9WgXcQ"),
+    ("https://www.youtube.com/watch?vi=dQw4w9WgXcQ&list=x&fbclid=y", "https://www.youtube.com/watch?v=dQw4w9WgXcQ"),
+    ("not a url", "not a url"),
+  ],
+)
+def test_clean(cleaner: UrlCleaner, url: str, clean: str) -> None:
+  """URLs are cleaned by PYTDL's rules, then ClearURLs' (rules, raw rules, exceptions, and redirections)."""
+  assert cleaner.clean(url) == clean
+
+
+def open_history(path: Path) -> History:
+  """A History opened on path."""
+  history = History()
+  history.open(path)
+  return history
+
+
+def test_history_appends_in_batches(tmp_path: Path) -> None:
+  """URLs are only appended to the log once a batch is full (or on flush), and never twice."""
+  path = tmp_path / "history.txt"
+  history = open_history(path)
+  history.batch, history.interval = 3, float("inf")
+  history.add("a")
+  history.add("b")
+  history.add("a")
+  assert not path.exists()
+  history.add("c")
+  assert path.read_text(encoding="utf8").split() == ["a", "b", "c"]
+  history.update(["c", "d"])
+  history.flush()
+  assert path.read_text(encoding="utf8").split() == ["a", "b", "c", "d"]
+  assert set(open_history(path)) == {"a", "b", "c", "d"}
+
+
+def test_history_takes_in_what_others_append(tmp_path: Path) -> None:
+  """Two Historys sharing a log each pick up what the other appended when they sync, without appending it again."""
+  path = tmp_path / "history.txt"
+  ours, theirs = open_history(path), open_history(path)
+  ours.add("a")
+  ours.flush()
+  theirs.add("b")
+  theirs.sync()
+  ours.sync()
+  assert set(ours) == set(theirs) == {"a", "b"}
+  assert sorted(path.read_text(encoding="utf8").split()) == ["a", "b"]
+  open_history(path).flush()
+  assert sorted(path.read_text(encoding="utf8").split()) == ["a", "b"]
+
+
+def test_history_compacts(tmp_path: Path) -> None:
+  """A removal compacts the log on sync, sorted and without it, and another History rereads the rewritten log."""
+  path = tmp_path / "history.txt"
+  ours, theirs = open_history(path), open_history(path)
+  ours.update(["c", "a", "b", "a"])
+  ours.flush()
+  assert set(theirs) == {"a", "b", "c"}
+  ours.discard("b")
+  ours.sync()
+  assert path.read_text(encoding="utf8").split() == ["a", "c"]
+  ours.add("d")
+  ours.flush()
+  theirs.add("e")
+  theirs.flush()
+  assert set(theirs) == {"a", "b", "c", "d", "e"}  # as it only forgets "b" if told to
+  assert path.read_text(encoding="utf8").split() == ["a", "c", "d", "e"]
+  assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_history_reads_its_log_once_needed(tmp_path: Path) -> None:
+  """Opening (or syncing) a History leaves its log unread, until we ask what's in it or add to it."""
+  path = tmp_path / "history.txt"
+  path.write_text("a\nb\n", encoding="utf8")
+  history = open_history(path)
+  history.sync()
+  assert (history.loaded, history.urls) == (False, set())
+  assert "a" in history
+  history.add("c")
+  history.flush()
+  assert path.read_text(encoding="utf8").split() == ["a", "b", "c"]
+
+
+def as_is(urls: object) -> object:
+  """Clean URLs by leaving them as they are."""
+  return urls
+
+
+def no_key(_url: str) -> None:
+  """Key no URLs (as Queue.open takes)."""
+
+
+def open_queue(path: Path) -> Queue:
+  """A Queue opened on path, as a new PYTDL would (after a crash, without closing the last)."""
+  queue = Queue()
+  queue.open(path, as_is, no_key)
+  return queue
+
+
+def test_queue_replays_its_journal(tmp_path: Path) -> None:
+  """Every change to the queue survives a crash, in order, without it ever being compacted."""
+  queue = open_queue(tmp_path / "queue.txt")
+  queue.extend(["a", "b", "c", "d"])
+  queue.extend(["c"], front=True)
+  del queue["b"]
+  queue.complete("d")
+  queue["e"] = "e"
+  assert not (tmp_path / "queue.txt").exists()
+  assert list(open_queue(tmp_path / "queue.txt")) == ["c", "a", "e"]
+
+
+def test_queue_compacts_into_its_file(tmp_path: Path) -> None:
+  """Compacting writes the queue to its file and empties the journal, and changes after are journaled over it."""
+  queue = open_queue(tmp_path / "queue.txt")
+  queue.extend(["a", "b"])
+  queue.compact()
+  assert (tmp_path / "queue.txt").read_text(encoding="utf8").split() == ["a", "b"]
+  assert (tmp_path / "queue.txt.journal").read_text(encoding="utf8") == ""
+  queue.complete("a")
+  queue["c"] = "c"
+  assert list(open_queue(tmp_path / "queue.txt")) == ["b", "c"]
+
+
+def test_queue_clear_is_journaled(tmp_path: Path) -> None:
+  """Clearing the queue leaves its file alone until it's compacted, but stays cleared after a crash."""
+  queue = open_queue(tmp_path / "queue.txt")
+  queue.extend(["a", "b"])
+  queue.compact()
+  queue.clear()
+  queue["c"] = "c"
+  assert (tmp_path / "queue.txt").read_text(encoding="utf8").split() == ["a", "b"]
+  assert list(open_queue(tmp_path / "queue.txt")) == ["c"]
+
+
+def test_exit_only_compacts_a_journaled_queue(pytdl: PYTDL, capsys: pytest.CaptureFixture[str]) -> None:
+  """Exiting compacts the queue into its file if anything's been journaled since, and otherwise leaves it be."""
+  pytdl.exit_pause = 0
+  pytdl.queue.extend(["https://a.com/1", "https://a.com/2"])
+  pytdl.do_exit()
+  path = pytdl.queue.path
+  assert path.read_text(encoding="utf8").split() == ["https://a.com/1", "https://a.com/2"]
+  inode = path.stat().st_ino
+  pytdl.do_exit()
+  assert path.stat().st_ino == inode
+  assert "Exitting, saved 2 URLs" in capsys.readouterr().out
+
+
+def test_queue_finds_by_key(tmp_path: Path) -> None:
+  """The URL queued for the same content as another is found by their keys (i.e., archive IDs), while it's queued."""
+  queue = Queue()
+  queue.open(tmp_path / "queue.txt", as_is, lambda url: url.rsplit("/", 1)[-1] if "/" in url else None)
+  queue.extend(["https://a.com/1", "https://a.com/2", "3"])
+  assert queue.find("https://b.com/1") == "https://a.com/1"
+  assert queue.find("https://b.com/3") is None
+  assert queue.find("2") is None
+  queue.complete("https://a.com/1")
+  queue["https://c.com/2"] = "https://c.com/2"
+  assert queue.find("https://b.com/1") is None
+  assert queue.find("https://b.com/2") == "https://a.com/2"
+
+
+def test_playlists_resume(tmp_path: Path) -> None:
+  """How far each playlist got, and its entries' playlist fields, are read back by another Playlists."""
+  playlists = Playlists()
+  playlists.open(tmp_path / "playlists.json")
+  playlists.progress("list")["fetched"] = 2
+  playlists.add("a", {"playlist_title": "List", "playlist_index": 1})
+  playlists.add("b", {"playlist_title": "List", "playlist_index": 2})
+  playlists.done("a")
+  playlists.save()
+  resumed = Playlists()
+  resumed.open(tmp_path / "playlists.json")
+  assert resumed.progress("list") == {"fetched": 2, "complete": False}
+  assert resumed.entries == {"b": {"playlist_title": "List", "playlist_index": 2}}
+  assert resumed.progress("another") == {"fetched": 0, "complete": False}
+
+
+def test_page_through_fetches_only_the_pages_needed() -> None:
+  """Going through a paged playlist from an entry fetches pages from the one it's on, and only as they're reached."""
+  fetched = []
+
+  def page(n: int) -> list[dict]:
+    fetched.append(n)
+    return [{"id": str(i)} for i in range(3 * n, min(3 * n + 3, 10))]
+
+  entries = page_through(OnDemandPagedList(page, 3), 4)
+  assert [entry["id"] for entry in islice(entries, 2)] == ["4", "5"]
+  assert fetched == [1]
+  assert [entry["id"] for entry in entries] == ["6", "7", "8", "9"]
+  assert fetched == [1, 2, 3]
+
+
+def listed(*vids: str) -> Callable[..., Iterator[Entry]]:
+  """A stand-in for PYTDL.listing, of a playlist (or channel) of these videos, newest first."""
+
+  def listing(_url: str, start: int = 0) -> Iterator[Entry]:
+    for index, vid in enumerate(vids[start:], start + 1):
+      yield Entry(index, f"https://a.com/{vid}", f"a {vid}", None, {"playlist_index": index})
+
+  return listing
+
+
+def test_expand_resumes(pytdl: PYTDL) -> None:
+  """Expanding a playlist picks up from the entry it got to, skipping those we've got, and starts over once complete."""
+  pytdl.listing = listed("1", "2", "3", "4")
+  assert list(islice(pytdl.expand("list"), 2)) == ["https://a.com/1", "https://a.com/2"]
+  pytdl.history.add("https://a.com/3")
+  assert list(pytdl.expand("list")) == ["https://a.com/4"]
+  assert pytdl.playlists.progress("list") == {"fetched": 4, "complete": True}
+  assert pytdl.playlists.entries["https://a.com/4"] == {"playlist_index": 4}
+  assert list(pytdl.expand("list")) == ["https://a.com/1", "https://a.com/2", "https://a.com/4"]
+
+
+def test_sync_channel_stops_at_what_it_knows(pytdl: PYTDL) -> None:
+  """Syncing a channel takes its new entries, newest first, up to the first it synced last time, queued, or got."""
+  pytdl.listing = listed("5", "4", "3", "2", "1")
+  pytdl.archive.add("a 2")
+  assert pytdl.sync_channel("channel") == ["https://a.com/5", "https://a.com/4", "https://a.com/3"]
+  assert pytdl.channels["channel"]["id"] == "a 5"
+  pytdl.listing = listed("7", "6", "5", "4", "3", "2", "1")
+  assert pytdl.sync_channel("channel") == ["https://a.com/7", "https://a.com/6"]
+  pytdl.queue["https://a.com/8"] = "https://a.com/8"
+  pytdl.listing = listed("9", "8", "7")
+  assert pytdl.sync_channel("channel") == ["https://a.com/9"]
+
+
+def test_merge_subs(tmp_path: Path, monkeypatch: pytest.MonkeyPatch, capsys: pytest.CaptureFixture[str]) -> None:
+  """Subtitles are merged into their videos (tidying both away) unless they already have been, and failures are kept."""
+  merging = []
+
+  def merge_sub(vid: Path, sub: Path, lang: str) -> str | None:
+    merging.append((vid.name, sub.name, lang))
+    if vid.stem == "failing":
+      return "Invalid data found when processing input"
+    vid.with_suffix(".mkv").write_bytes(vid.read_bytes())
+    return None
+
+  monkeypatch.setattr("pytdl.merge_sub", merge_sub)
+  monkeypatch.setattr("pytdl.duration", lambda path: path.stat().st_size)  # as ffprobe would, by its size
+  shows = tmp_path / "Shows"
+  shows.mkdir()
+  for name in ("new", "old", "truncated", "failing"):
+    (shows / f"{name}.mp4").write_bytes(b"video")
+  for name in ("new.en.ass", "old.en-GB.ass", "truncated.ja.ass", "failing.fr.ass"):
+    (shows / name).touch()
+  for name in ("old", "truncated"):
+    os.utime(shows / f"{name}.mp4", (0, 0))
+    os.utime(next(shows.glob(f"{name}.*.ass")), (0, 0))
+  (shows / "old.mkv").write_bytes(b"video")  # so it's newer than both, and as long
+  (shows / "truncated.mkv").write_bytes(b"vi")  # as a merge that was killed leaves it
+  merge_subs(tmp_path, workers=2)
+  assert sorted(merging) == [
+    ("failing.mp4", "failing.fr.ass", "fra"),
+    ("new.mp4", "new.en.ass", "eng"),
+    ("truncated.mp4", "truncated.ja.ass", "jpn"),
+  ]
+  assert sorted(path.name for path in shows.iterdir()) == [
+    "failing.fr.ass",
+    "failing.mp4",
+    "new.mkv",
+    "old.mkv",
+    "truncated.mkv",
+  ]
+  assert (shows / "truncated.mkv").read_bytes() == b"video"
+  out = capsys.readouterr().out
+  assert "Merged 2 videos in" in out
+  assert "skipped 1 already merged, 1 failed" in out
+  assert f"Failed to merge {shows / 'failing.mp4'}: Invalid data found when processing input" in out
+
+
+def test_merge_subs_in_no_time(
+  tmp_path: Path, monkeypatch: pytest.MonkeyPatch, capsys: pytest.CaptureFixture[str]
+) -> None:
+  """An empty directory is summarised even if the clock doesn't tick while we look through it (as on Windows)."""
+  monkeypatch.setattr("pytdl.monotonic", lambda: 1.0)
+  merge_subs(tmp_path)
+  assert "Merged 0 videos in 0.0s (0.00 videos/s, 0.0 MiB/s)" in capsys.readouterr().out
+
+
+@pytest.mark.parametrize("returncode", [0, 1])
+def test_merge_sub_writes_a_part(tmp_path: Path, monkeypatch: pytest.MonkeyPatch, returncode: int) -> None:
+  """Ffmpeg merges into a .mkv.part, which only becomes the .mkv if it succeeds, and is removed if it fails."""
+  (tmp_path / "a.mkv").write_bytes(b"old")
+
+  def ffmpeg(args: list[str], **_kwargs: object) -> CompletedProcess[str]:
+    Path(args[-1]).write_bytes(b"new")
+    return CompletedProcess(args, returncode, "", "Invalid data found when processing input")
+
+  monkeypatch.setattr("pytdl.run", ffmpeg)
+  err = merge_sub(tmp_path / "a.mp4", tmp_path / "a.en.ass", "eng")
+  assert err == (None if not returncode else "Invalid data found when processing input")
+  assert [path.name for path in tmp_path.iterdir()] == ["a.mkv"]
+  assert (tmp_path / "a.mkv").read_bytes() == (b"new" if not returncode else b"old")
+
+
+def test_library_rescans_only_what_changed(tmp_path: Path) -> None:
+  """The library finds media files by the ID in their names, and only rescans directories that have changed."""
+  videos, shows = tmp_path / "Videos", tmp_path / "Videos" / "Shows"
+  shows.mkdir(parents=True)
+  (videos / "Someone 2020-01-01 Title [dQw4w9WgXcQ].mkv").write_bytes(b"video")
+  (videos / "Someone 2020-01-01 Title [dQw4w9WgXcQ].info.json").write_bytes(b"a sidecar, bigger than the video")
+  (videos / "Someone 2020-01-02 Other [xxxxxxxxxxx].mkv.part").write_bytes(b"still downloading")
+  library = Library()
+  library.open(tmp_path / "library.sqlite")
+  assert set(library.refresh([videos])) == {videos, shows}
+  assert library.find("dQw4w9WgXcQ", "youtube") == videos / "Someone 2020-01-01 Title [dQw4w9WgXcQ].mkv"
+  assert library.find("xxxxxxxxxxx", "youtube") is None
+  assert library.refresh([videos]) == []
+  (shows / "01 - Pilot [abc].mp4").write_bytes(b"video")
+  assert library.refresh([videos]) == [shows]
+  assert library.find("abc", "vimeo") == shows / "01 - Pilot [abc].mp4"
+  assert {path.name for path in library.files(videos)} == {
+    "Someone 2020-01-01 Title [dQw4w9WgXcQ].mkv",
+    "Someone 2020-01-01 Title [dQw4w9WgXcQ].info.json",
+    "01 - Pilot [abc].mp4",
+  }
+  (shows / "01 - Pilot [abc].mp4").unlink()
+  shows.rmdir()
+  assert library.refresh([videos]) == [videos]
+  assert library.find("abc", "vimeo") is None
+  assert library.files(shows) == []
+
+
+def test_library_matches_by_extractor(tmp_path: Path) -> None:
+  """IDs are matched with the extractor we recorded (which survives rescans), or else that their info.json names."""
+  videos = tmp_path / "Videos"
+  videos.mkdir()
+  (videos / "A [123].mp4").write_bytes(b"video")
+  (videos / "B [456].mp4").write_bytes(b"video")
+  (videos / "B [456].info.json").write_text(json.dumps({"extractor_key": "Vimeo"}), encoding="utf8")
+  (videos / "C [789].mp4").write_bytes(b"video")
+  library = Library()
+  library.open(tmp_path / "library.sqlite")
+  library.refresh([videos])
+  library.record(videos / "A [123].mp4", "twitch")
+  (videos / "D [000].mp4").write_bytes(b"video")  # so the directory's rescanned
+  assert library.refresh([videos]) == [videos]
+  assert library.find("123", "twitch") == videos / "A [123].mp4"
+  assert library.find("123", "youtube") is None
+  assert library.find("456", "vimeo") == videos / "B [456].mp4"
+  assert library.find("456", "youtube") is None
+  assert library.find("789", "youtube") == videos / "C [789].mp4"  # as nothing says it's not
+
+
+def test_library_refresh_waits_for_other_writers(tmp_path: Path) -> None:
+  """A refresh waits on another process writing to the library, rather than failing as it had read before it wrote."""
+  (tmp_path / "Videos").mkdir()
+  library = Library()
+  library.open(tmp_path / "library.sqlite")
+  other = sqlite3.connect(tmp_path / "library.sqlite", check_same_thread=False, isolation_level=None)
+  other.execute("BEGIN IMMEDIATE")
+  other.execute("INSERT INTO dirs VALUES (?, NULL, 0)", (str(tmp_path / "Elsewhere"),))
+  threading.Timer(0.2, other.execute, ["COMMIT"]).start()
+  assert library.refresh([tmp_path / "Videos"]) == [tmp_path / "Videos"]
+  other.close()
+
+
+def test_on_disk(pytdl: PYTDL, tmp_path: Path) -> None:
+  """A URL's video is found on disk by the extractor and ID in the URL, without extracting it."""
+  (tmp_path / "Videos").mkdir()
+  (tmp_path / "Videos" / "Someone 2020-01-01 Title [dQw4w9WgXcQ].mkv").write_bytes(b"video")
+  pytdl.library.refresh([tmp_path / "Videos"])
+  assert pytdl.on_disk("https://www.youtube.com/watch?v=dQw4w9WgXcQ") == next((tmp_path / "Videos").iterdir())
+  assert pytdl.on_disk("https://www.youtube.com/watch?v=xxxxxxxxxxx") is None
+  assert pytdl.on_disk("https://example.org/video") is None
+
+
+def test_plan(pytdl: PYTDL, tmp_path: Path, capsys: pytest.CaptureFixture[str]) -> None:
+  """Where each URL we have the info of will be saved is planned (making its directory), pointing out any problems."""
+  pytdl.template = deepcopy(pytdl.template)
+  pytdl.template["default"]["outtmpl"] = str(tmp_path / "Videos" / "%(uploader)s" / "%(title)s [%(id)s].%(ext)s")
+  urls = [f"https://www.youtube.com/watch?v={vid}" for vid in ("aaaaaaaaaaa", "bbbbbbbbbbb", "ccccccccccc", "ddd")]
+  infos = [("Title", "aaaaaaaaaaa"), ("Same", "bbbbbbbbbbb"), ("Same", "bbbbbbbbbbb"), ("Long" * 100, "ddd")]
+  for url, (title, vid) in zip(urls, infos, strict=True):
+    pytdl.info_cache[url] = Info({"id": vid, "title": title, "uploader": "Someone", "ext": "mkv"})
+  planned = pytdl.plan([*urls, "https://www.youtube.com/watch?v=eeeeeeeeeee"])  # whose info we don't have
+  videos = tmp_path / "Videos" / "Someone"
+  assert planned == {
+    urls[0]: videos / "Title [aaaaaaaaaaa].mkv",
+    urls[1]: videos / "Same [bbbbbbbbbbb].mkv",
+    urls[2]: videos / "Same [bbbbbbbbbbb].mkv",
+    urls[3]: videos / f"{'Long' * 100} [ddd].mkv",
+  }
+  assert videos.is_dir()
+  out = capsys.readouterr().out
+  assert f"{urls[1]}, {urls[2]} would all be saved as {planned[urls[1]]}" in out
+  assert f"{urls[3]} would be saved as {planned[urls[3]]}, which is too long a path" in out
+  assert pytdl.planned == planned
+
+
+def test_pipeline(media: PYTDL, tmp_path: Path) -> None:
+  """Getting a queue from a MediaServer downloads all its videos but the missing, even those throttled at first."""
+  faults = Faults(latency=0, throttled=0.2, failed=0.2, live=0)
+  with MediaServer(faults) as server:
+    urls = [f"{server.base}/watch/{i}" for i in range(12)]
+    media.queue.extend(dict.fromkeys(urls))
+    still_live: list[str] = []
+    media.run_downloads(list(media.queue), still_live)
+  failed = {url for url in urls if faults.failed > Random(url.rsplit("/", 1)[1]).random()}
+  assert failed
+  assert set(media.history) == set(urls) - failed
+  assert set(media.unverified) == failed
+  assert not still_live
+  assert not list(media.queue)
+  assert len(list((tmp_path / "Videos").iterdir())) == len(urls) - len(failed)
+
+
+def test_pipeline_drops_content_queued_twice(media: PYTDL, monkeypatch: pytest.MonkeyPatch) -> None:
+  """URLs added for content that's already queued (by archive ID) are queued, but dropped when the queue's got."""
+  fetched: list[str] = []
+  monkeypatch.setattr(media, "fetch", lambda url, *_: fetched.append(url) or "done")
+  monkeypatch.setattr(media, "prefetch_info", lambda _: None)
+  urls = ["http://127.0.0.1:9/watch/1", "http://127.0.0.1:9/watch/2", "https://127.0.0.1:9/watch/1"]
+  media.do_add(" ".join(urls))
+  assert list(media.queue) == urls
+  media.run_downloads(list(media.queue), [])
+  assert fetched == urls[:2]
+  assert urls[2] not in media.queue
+
+
+@pytest.mark.parametrize("mode", ["is_audio", "is_captions"])
+def test_pipeline_skips_only_videos_on_disk(
+  media: PYTDL, tmp_path: Path, monkeypatch: pytest.MonkeyPatch, mode: str
+) -> None:
+  """A video we already have on disk isn't downloaded again, unless we're after its audio or captions."""
+  fetched: list[str] = []
+  monkeypatch.setattr(media, "fetch", lambda url, *_: fetched.append(url) or "done")
+  monkeypatch.setattr(media, "prefetch_info", lambda _: None)
+  (tmp_path / "Videos").mkdir()
+  (tmp_path / "Videos" / "Had [1].mp4").write_bytes(b"video")
+  urls = ["http://127.0.0.1:9/watch/1", "http://127.0.0.1:9/watch/2"]
+  media.run_downloads(urls, [])
+  assert fetched == urls[1:]
+  assert urls[0] in media.history
+  setattr(media, mode, True)
+  media.run_downloads(urls[:1], [])
+  assert fetched == [*urls[1:], *urls[:1]]
+
+
+def test_pipeline_waits_out_live_videos(media: PYTDL) -> None:
+  """Videos that are live are left until they've ended, and then downloaded."""
+  with MediaServer(Faults(latency=0, throttled=0, failed=0, live=1, live_for=1)) as server:
+    urls = [f"{server.base}/watch/{i}" for i in range(3)]
+    still_live: list[str] = []
+    media.run_downloads(urls, still_live)
+    assert sorted(still_live) == sorted(urls)
+    assert not set(media.history)
+    for url in still_live:
+      del media.info_cache[url]  # as wait checks them again
+    live, still_live = still_live, []
+    media.run_downloads(live, still_live)
+  assert not still_live
+  assert set(media.history) == set(urls)
+
+
+def test_wait_gets_throttled_videos_again(media: PYTDL) -> None:
+  """Videos that wait finds have ended, but whose host throttles us, are got again once it's backed off."""
+  media.limiter.backoff = media.limiter.floor = 0.05  # so it backs off for a moment, not minutes
+  fetch, fetched = media.fetch, Counter[str]()
+
+  def throttled_first(url: str, *args: int) -> str:
+    fetched[url] += 1
+    if fetched[url] == 1:
+      media.limiter.throttled(media.host_key(url))
+      return "throttled"
+    return fetch(url, *args)
+
+  media.fetch = throttled_first
+  with MediaServer(Faults(latency=0, throttled=0, failed=0, live=0)) as server:
+    urls = [f"{server.base}/watch/{i}" for i in range(3)]
+    media.do_wait(" ".join(urls))
+  assert fetched == dict.fromkeys(urls, 2)
+  assert set(media.history) == set(urls)
+
+
+def test_metrics(tmp_path: Path) -> None:
+  """Counts and observations from every thread are summed, summarised by bucket, and exported."""
+  metrics = Metrics()
+
+  def work(i: int) -> None:
+    metrics.count("fetches")
+    metrics.count('fetched{outcome="done"}', 2)
+    metrics.observe("fetch_seconds", 0.75 if i % 2 else 3)
+
+  with ThreadPoolExecutor(4) as pool:
+    list(pool.map(work, range(10)))
+  with metrics.timer("fetch_seconds"):
+    pass
+  counters, _ = metrics.snapshot()
+  assert counters == {'fetched{outcome="done"}': 20, "fetches": 10}
+  summary = metrics.summary()["fetch_seconds"]
+  assert summary["count"] == 11
+  assert summary["total"] == pytest.approx(5 * 0.75 + 5 * 3, abs=0.01)
+  assert summary["p50"] == 1  # 0.75's bucket is up to 1s, and 3's up to 4s
+  assert summary["p99"] == 4
+  metrics.export(tmp_path / "metrics.prom")
+  text = (tmp_path / "metrics.prom").read_text(encoding="utf8")
+  assert '# TYPE pytdl_fetched counter\npytdl_fetched{outcome="done"} 20' in text
+  assert 'pytdl_fetch_seconds_bucket{le="1.0"} 6.0' in text
+  assert 'pytdl_fetch_seconds_bucket{le="+Inf"} 11.0' in text
+  metrics.export(tmp_path / "metrics.json")
+  assert json.loads((tmp_path / "metrics.json").read_text(encoding="utf8"))["counters"]["fetches"] == 10
+  metrics.clear()
+  assert metrics.snapshot() == ({}, {})
+
+
+def test_metrics_folds_ended_threads() -> None:
+  """What threads that have ended counted is kept, but their shards aren't, however many thread pools come and go."""
+  metrics = Metrics()
+
+  def work(_i: int) -> None:
+    metrics.count("fetches")
+    metrics.observe("fetch_seconds", 1)
+
+  for _ in range(5):
+    with ThreadPoolExecutor(4) as pool:
+      list(pool.map(work, range(8)))
+  metrics.count("fetches")
+  assert list(metrics.shards) == [threading.current_thread()]
+  counters, hists = metrics.snapshot()
+  assert (counters["fetches"], sum(hists["fetch_seconds"][1:])) == (41, 40)
+
+
+def test_tracer(tmp_path: Path) -> None:
+  """Spans are only recorded when tracing, and are saved as trace events, with their threads named."""
+  tracer = Tracer()
+  with tracer.span("fetch", url="https://a.com/1"):
+    pass
+  assert not tracer.events
+  tracer.enabled = True
+  with tracer.span("fetch", url="https://a.com/1"), tracer.span("extract", url="https://a.com/1"):
+    sleep(0.01)
+  info = {"webpage_url": "https://a.com/1"}
+  tracer.postprocessor_hook({"status": "started", "postprocessor": "FFmpegMerger", "info_dict": info})
+  tracer.postprocessor_hook({"status": "finished", "postprocessor": "FFmpegMerger", "info_dict": info})
+  assert tracer.save(tmp_path / "trace.json") == 3
+  events = json.loads((tmp_path / "trace.json").read_text(encoding="utf8"))["traceEvents"]
+  names, spans = events[:1], events[1:]
+  assert names[0]["ph"] == "M"
+  assert names[0]["args"]["name"] == "MainThread"
+  assert [span["name"] for span in spans] == ["extract", "fetch", "FFmpegMerger"]
+  assert all(span["args"]["url"] == "https://a.com/1" and span["tid"] == names[0]["tid"] for span in spans)
+  extract, fetch = spans[:2]
+  assert fetch["ts"] <= extract["ts"]
+  assert extract["ts"] + extract["dur"] <= fetch["ts"] + fetch["dur"]
+  assert extract["dur"] >= 10_000  # microseconds
+
+
+def test_tracer_reuses_tracks(tmp_path: Path) -> None:
+  """Threads with the same name (as each thread pool's are) share a track, however many thread pools come and go."""
+  tracer = Tracer()
+  tracer.enabled = True
+
+  def work(_i: int) -> None:
+    with tracer.span("fetch"):
+      sleep(0.001)
+
+  for _ in range(5):
+    with ThreadPoolExecutor(2, thread_name_prefix="pytdl") as pool:
+      list(pool.map(work, range(4)))
+  assert tracer.save(tmp_path / "trace.json") == 20
+  events = json.loads((tmp_path / "trace.json").read_text(encoding="utf8"))["traceEvents"]
+  names = {event["tid"]: event["args"]["name"] for event in events if event["ph"] == "M"}
+  assert sorted(names.values()) == ["pytdl_0", "pytdl_1"]
+  assert {event["tid"] for event in events} == set(names)
+
+
+def test_tracer_times_fragments() -> None:
+  """Each fragment's span is labelled with its index, and the last ends when the download does."""
+  tracer = Tracer()
+  tracer.enabled = True
+  info = {"webpage_url": "https://a.com/1"}
+  for index in (1, 1, 2, 3):
+    tracer.progress_hook({"status": "downloading", "fragment_index": index, "info_dict": info})
+  tracer.progress_hook({"status": "finished", "info_dict": info})
+  assert [event["name"] for event in tracer.events] == ["fragment 1", "fragment 2", "fragment 3"]
+  assert all(event["args"]["url"] == "https://a.com/1" for event in tracer.events)
+
+
+def test_serve(media: PYTDL, tmp_path: Path, capsys: pytest.CaptureFixture[str]) -> None:
+  """Serving gets what clients add in the background, refuses what it doesn't take, and stops when it's told to."""
+  path = media.serve_socket = tmp_path / "pytdl.sock"
+  with MediaServer(Faults(latency=0, throttled=0, failed=0, live=0)) as server:
+    serving = threading.Thread(target=media.do_serve, name="serve")
+    serving.start()
+    while not path.exists():
+      sleep(0.01)
+    assert path.stat().st_mode & 0o777 == 0o600
+    urls = [f"{server.base}/watch/{i}" for i in range(3)]
+    assert send(path, [f"add {url}" for url in urls])
+    assert send(path, ["move 1 2"])
+    assert send(path, ["get"])
+    for _ in range(1000):
+      if len(media.history) == len(urls):
+        break
+      sleep(0.01)
+    assert send(path, ["serve stop"])
+    serving.join(10)
+  assert not serving.is_alive()
+  assert set(media.history) == set(urls)
+  assert not path.exists()
+  assert not send(path, ["add https://a.com/1"])
+  out = capsys.readouterr().out
+  assert "Only add, cache, echo" in out
+  assert "not move" in out
+  assert "No videos to download" in out
+  assert "front" not in set(media.history) | set(media.queue)
+  assert "Stopping once the running downloads finish" in out
+
+
+def test_control_port_needs_the_token(tmp_path: Path) -> None:
+  """Over TCP, only clients that send the token from the port file first are taken, and never HTTP requests."""
+  path, ran = tmp_path / "pytdl.port", []
+
+  def run(line: str) -> bool:
+    ran.append(line)
+    return False
+
+  with socket.socket() as free:
+    free.bind(("127.0.0.1", 0))
+    port = free.getsockname()[1]
+  server = control_server(path, port, run, Replies(sys.stdout))
+  serving = threading.Thread(target=server.serve_forever, daemon=True)
+  serving.start()
+  try:
+    assert path.stat().st_mode & 0o777 == 0o600
+    address, token = path.read_text(encoding="utf8").split()
+    assert address == f"127.0.0.1:{port}"
+    for lines in (["echo nope"], ["wrong", "echo nope"], [token, "GET /?add%20https://a.com/1 HTTP/1.1"]):
+      with socket.create_connection(("127.0.0.1", port)) as conn:
+        conn.sendall("".join(f"{line}\n" for line in lines).encode("utf8"))
+        conn.shutdown(socket.SHUT_WR)
+        while conn.recv(1 << 16):
+          pass
+    assert send(path, ["echo hi", "add https://a.com/1"])
+  finally:
+    server.shutdown()
+    server.server_close()
+  assert ran == ["echo hi", "add https://a.com/1"]
+
+
+def open_work(path: Path) -> WorkQueue:
+  """A WorkQueue opened on path."""
+  work = WorkQueue()
+  work.open(path)
+  return work
+
+
+def test_work_is_claimed_once(tmp_path: Path) -> None:
+  """Workers sharing a work queue each claim different URLs, in order, until there are none left."""
+  ours, theirs = open_work(tmp_path / "work.sqlite"), open_work(tmp_path / "work.sqlite")
+  assert ours.add(["a", "b", "c"]) == 3
+  assert theirs.add(["c", "d"]) == 1
+  assert ours.claim("ours", 2, 60) == ["a", "b"]
+  assert theirs.claim("theirs", 5, 60) == ["c", "d"]
+  assert ours.claim("ours", 5, 60) == []
+  ours.complete("a")
+  assert ours.counts() == {"leased": 3}
+
+
+def test_work_leases_expire(tmp_path: Path) -> None:
+  """A lease that isn't renewed expires, for another worker to claim, and the worker that lost it is told."""
+  work = open_work(tmp_path / "work.sqlite")
+  work.add(["a", "b"])
+  assert work.claim("ours", 2, 0.2) == ["a", "b"]
+  assert work.renew("ours", ["a"], 60) == []
+  sleep(0.3)
+  assert work.claim("theirs", 2, 60) == ["b"]
+  assert work.renew("ours", ["a", "b"], 60) == ["b"]
+
+
+def test_work_fails_after_max_tries(tmp_path: Path) -> None:
+  """URLs released after max_tries tries fail, as do those whose leases keep expiring, but live ones aren't counted."""
+  work = open_work(tmp_path / "work.sqlite")
+  work.add(["a", "b", "c"])
+  for _ in range(work.max_tries):
+    assert work.claim("ours", 1, 60) == ["a"]
+    work.release("ours", "a", 0)
+  for _ in range(work.max_tries):
+    assert work.claim("ours", 1, -1) == ["b"]  # its lease expired as soon as it was claimed
+  for _ in range(work.max_tries + 1):
+    assert work.claim("ours", 1, 60) == ["c"]
+    work.release("ours", "c", 0, tried=False)
+  assert work.counts() == {"failed": 2, "queued": 1}
+  assert work.next_due() == 0
+
+
+@pytest.mark.parametrize(
+  ("failure", "throttled", "forbidden"),
+  [
+    ("ERROR: unable to download video data: HTTP Error 429: Too Many Requests", True, False),
+    ("ERROR: [youtube] x: Sign in to confirm you're not a bot", True, False),
+    ("ERROR: unable to download video data: HTTP Error 403: Forbidden", False, True),
+    ("ERROR: unable to download video data: HTTP Error 404: Not Found", False, False),
+  ],
+)
+def test_throttled(failure: str, throttled: bool, forbidden: bool) -> None:  # noqa: FBT001
+  """Only 429s and bot checks are throttling, while 403s may be."""
+  assert bool(THROTTLED.search(failure)) == throttled
+  assert bool(FORBIDDEN.search(failure)) == forbidden
+
+
+def test_limiter_backs_off() -> None:
+  """A host that throttles us is slowed down (even with no naptime), and 403s only count once they're for others."""
+  limiter = RateLimiter()
+  limiter.naptime = 0
+  assert limiter.interval("host") == 0
+  limiter.throttled("host")
+  assert limiter.interval("host") == 2 * limiter.floor
+  assert limiter.delay("host", 1) > limiter.backoff - 1
+  assert not limiter.forbidden("host", "a")
+  assert not limiter.forbidden("host", "a")
+  assert limiter.forbidden("host", "b")